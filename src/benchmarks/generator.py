@@ -0,0 +1,174 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Deterministic generator of hieroglyph-like test images.
+
+Glyphs are dark shapes on a white background laid out on a grid of cells,
+one glyph to a cell. Runs of cells can be enclosed in cartouches, which can
+be nested, and speckle noise can be scattered over the image. The same
+arguments always give the same image.
+
+'''
+
+import base64
+import math
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from models.images import get_image_bytes
+
+# Gap between a cartouche's border and whatever it encloses, which must be
+# wider than the DBSCAN eps so they are separate clusters
+CARTOUCHE_GAP = 4
+
+# Distance between the speckles of noise
+SPECKLE_SPACING = 5
+
+# Smallest glyph size in pixels
+MIN_GLYPH_SIZE = 3
+
+
+def draw_glyph(draw, rng, box):
+    '''Draw a random glyph shape.
+
+    Input parameters:
+
+    draw -- A PIL ImageDraw.
+    rng -- A numpy RandomState.
+    box -- The [x0, y0, x1, y1] box to draw within.
+
+    '''
+    x0, y0, x1, y1 = box
+    width = x1 - x0
+    height = y1 - y0
+    # A random part of the box
+    w = rng.randint(max(MIN_GLYPH_SIZE, width // 2), width + 1)
+    h = rng.randint(max(MIN_GLYPH_SIZE, height // 2), height + 1)
+    x = x0 + rng.randint(0, width - w + 1)
+    y = y0 + rng.randint(0, height - h + 1)
+    shape = rng.randint(5)
+    if shape == 0:
+        draw.ellipse([x, y, x + w - 1, y + h - 1], fill=0)
+    elif shape == 1:
+        draw.rectangle([x, y, x + w - 1, y + h - 1], fill=0)
+    elif shape == 2:
+        # Ring
+        draw.ellipse([x, y, x + w - 1, y + h - 1], outline=0, width=2)
+    elif shape == 3:
+        # Diagonal stroke
+        if rng.randint(2):
+            draw.line([x, y, x + w - 1, y + h - 1], fill=0, width=3)
+        else:
+            draw.line([x, y + h - 1, x + w - 1, y], fill=0, width=3)
+    else:
+        # Plural marks, three small strokes side by side
+        mark = max(1, w // 5)
+        for i in range(3):
+            mx = x + i * 2 * mark
+            draw.rectangle([mx, y, mx + mark - 1, y + h - 1], fill=0)
+
+
+def generate_image(seed,
+                   width=400,
+                   height=300,
+                   glyph_count=40,
+                   cartouches=0,
+                   nesting=1,
+                   noise=0.0):
+    '''Generate a hieroglyph-like test image.
+
+    Input parameters:
+
+    seed -- The random seed.
+    width -- The image width.
+    height -- The image height.
+    glyph_count -- The number of glyphs, which are laid out on a grid of
+                   roughly square cells.
+    cartouches -- The number of cartouches, each enclosing a run of at least
+                  four cells in a row of the grid.
+    nesting -- The depth of the cartouches. A cartouche deeper than one
+               encloses another cartouche around part of its run.
+    noise -- The density of speckles, from 0 to 1.
+
+    Output parameters:
+
+    An RGB PIL image.
+
+    '''
+    rng = np.random.RandomState(seed)
+    image = Image.new('RGB', (width, height), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+
+    columns = max(1, int(math.ceil(math.sqrt(glyph_count * width / height))))
+    rows = max(1, int(math.ceil(glyph_count / columns)))
+    cell_width = width // columns
+    cell_height = height // rows
+    # Room around each glyph for the cartouche borders
+    margin = CARTOUCHE_GAP * (nesting + 1) + 1
+    if min(cell_width, cell_height) < 2 * margin + MIN_GLYPH_SIZE:
+        raise ValueError('Too many glyphs for a {}x{} image.'.format(
+            width, height))
+
+    for i in range(glyph_count):
+        row, column = divmod(i, columns)
+        x0 = column * cell_width
+        y0 = row * cell_height
+        draw_glyph(draw, rng, [
+            x0 + margin, y0 + margin, x0 + cell_width - margin,
+            y0 + cell_height - margin
+        ])
+
+    # Cartouches go in distinct rows that have enough glyphs
+    full_rows = [
+        row for row in range(rows)
+        if min(columns, glyph_count - row * columns) >= 4
+    ]
+    for row in rng.permutation(full_rows)[:cartouches]:
+        length = min(columns, glyph_count - row * columns)
+        span = rng.randint(4, length + 1)
+        start = rng.randint(0, length - span + 1)
+        for depth in range(nesting):
+            inset = CARTOUCHE_GAP * depth + 1
+            draw.rectangle([
+                (start * cell_width) + inset, (row * cell_height) + inset,
+                ((start + span) * cell_width) - inset - 1,
+                ((row + 1) * cell_height) - inset - 1
+            ],
+                           outline=0)
+            # The inner cartouche encloses the first part of the run
+            span = max(4, span - 1)
+
+    if noise > 0:
+        # Speckles are 2x2 squares on a lattice, far enough apart that they
+        # don't join up into lines that have no convex hull
+        pixels = np.asarray(image).copy()
+        sites = rng.random_sample(
+            ((height - 1) // SPECKLE_SPACING + 1,
+             (width - 1) // SPECKLE_SPACING + 1)) < noise
+        ys, xs = np.nonzero(sites)
+        for dy in range(2):
+            for dx in range(2):
+                pixels[np.minimum(ys * SPECKLE_SPACING + dy, height - 1),
+                       np.minimum(xs * SPECKLE_SPACING + dx, width - 1)] = 0
+        image = Image.fromarray(pixels)
+    return image
+
+
+def get_data_url(image):
+    '''Encode an image as the data URL of a request payload.'''
+    return 'data:image/png;base64,' + base64.b64encode(
+        get_image_bytes(image)).decode('ascii')
@@ -0,0 +1,276 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Benchmarks of the cluster analysis pipeline.
+
+Every workload is analysed in every read direction, timing each pipeline
+stage with do_cluster_analysis()'s StageTimer and the whole
+/clusteranalysis endpoint through the Flask test client. The median of the
+repeats is reported. Run from the src directory:
+
+    python -m benchmarks.run --save
+
+to store a baseline, and then
+
+    python -m benchmarks.run
+
+to compare against it. The exit status is 1 if any timing is slower than the
+baseline by more than the tolerance. Baselines are only comparable on the
+same machine.
+
+'''
+
+import argparse
+import collections
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+import main
+from benchmarks.generator import generate_image, get_data_url
+from models.cache import ResultCache
+from models.images import get_image_bytes
+from models.metrics import StageTimer
+
+# The read orders main.get_direction() accepts
+DIRECTIONS = ['rtl', 'vrtl', 'ltr']
+
+# Arguments of generate_image() of each workload
+WORKLOADS = collections.OrderedDict([
+    ('small', {
+        'seed': 1,
+        'width': 200,
+        'height': 150,
+        'glyph_count': 12
+    }),
+    ('cartouches', {
+        'seed': 2,
+        'width': 600,
+        'height': 400,
+        'glyph_count': 80,
+        'cartouches': 3
+    }),
+    ('nested', {
+        'seed': 3,
+        'width': 600,
+        'height': 400,
+        'glyph_count': 80,
+        'cartouches': 3,
+        'nesting': 2
+    }),
+    ('noisy', {
+        'seed': 4,
+        'width': 600,
+        'height': 400,
+        'glyph_count': 80,
+        'noise': 0.05
+    }),
+    ('large', {
+        'seed': 5,
+        'width': 1600,
+        'height': 1000,
+        'glyph_count': 400,
+        'cartouches': 6
+    }),
+])
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Differences smaller than this are noise whatever the tolerance
+MIN_REGRESSION_SECONDS = 0.002
+
+
+def time_pipeline(imagebytes, direction):
+    '''Time the stages of one analysis of a png image.
+
+    Output parameters:
+
+    A dictionary of stage names to seconds.
+
+    '''
+    timer = StageTimer()
+    with timer.stage('decode'):
+        image = Image.open(BytesIO(imagebytes))
+        image.load()
+    main.do_cluster_analysis(image, direction, timer=timer)
+    return dict(timer.stages)
+
+
+def time_endpoint(client, payload):
+    '''Time one request to the /clusteranalysis endpoint.'''
+    start = time.perf_counter()
+    response = client.post('/clusteranalysis', json=payload)
+    seconds = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError('The endpoint failed with {}: {}'.format(
+            response.status, response.get_data(as_text=True)))
+    return seconds
+
+
+def run_workload(workload, direction, repeat, client):
+    '''Benchmark a workload in one direction.
+
+    Output parameters:
+
+    A dictionary of stage names, and "endpoint", to the median seconds of
+    the repeats.
+
+    '''
+    image = generate_image(**WORKLOADS[workload])
+    imagebytes = get_image_bytes(image)
+    payload = {'image': get_data_url(image), 'direction': direction}
+    samples = collections.defaultdict(list)
+    for _ in range(repeat):
+        for stage, seconds in time_pipeline(imagebytes, direction).items():
+            samples[stage].append(seconds)
+        samples['endpoint'].append(time_endpoint(client, payload))
+    return collections.OrderedDict(
+        (stage, statistics.median(values))
+        for stage, values in samples.items())
+
+
+def run(workloads=None, directions=None, repeat=5):
+    '''Run the benchmarks.
+
+    Output parameters:
+
+    A dictionary of the environment and the timings, keyed by workload and
+    then direction.
+
+    '''
+    # Every request must be analysed rather than answered from the cache
+    result_cache = main.result_cache
+    main.result_cache = ResultCache(max_entries=0)
+    client = main.app.test_client()
+    timings = collections.OrderedDict()
+    try:
+        for workload in workloads or WORKLOADS:
+            timings[workload] = collections.OrderedDict()
+            for direction in directions or DIRECTIONS:
+                timings[workload][direction] = run_workload(
+                    workload, direction, repeat, client)
+    finally:
+        main.result_cache = result_cache
+        main.pool.shutdown()
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count()
+        },
+        'timings': timings
+    }
+
+
+def compare(results, baseline, tolerance=0.25):
+    '''Compare results with a baseline.
+
+    Input parameters:
+
+    results -- The output of run().
+    baseline -- The output of an earlier run().
+    tolerance -- The fraction a timing may grow by before it is a
+                 regression.
+
+    Output parameters:
+
+    A list of (workload, direction, stage, baseline seconds, seconds) tuples
+    of the regressions.
+
+    '''
+    regressions = []
+    for workload, directions in results['timings'].items():
+        for direction, stages in directions.items():
+            base_stages = baseline['timings'].get(workload,
+                                                  {}).get(direction, {})
+            for stage, seconds in stages.items():
+                if stage not in base_stages:
+                    continue
+                base = base_stages[stage]
+                if (seconds > base * (1 + tolerance) and
+                        seconds - base > MIN_REGRESSION_SECONDS):
+                    regressions.append(
+                        (workload, direction, stage, base, seconds))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    for workload, directions in results['timings'].items():
+        for direction, stages in directions.items():
+            print('{} {}'.format(workload, direction))
+            for stage, seconds in stages.items():
+                line = '  {:<12} {:>9.2f} ms'.format(stage, seconds * 1000)
+                if baseline is not None:
+                    base = baseline['timings'].get(workload, {}).get(
+                        direction, {}).get(stage)
+                    if base:
+                        line += ' {:>+7.0%}'.format(seconds / base - 1)
+                print(line)
+
+
+def main_benchmarks(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the cluster analysis pipeline.')
+    parser.add_argument('--workload',
+                        action='append',
+                        choices=list(WORKLOADS),
+                        help='Workloads to run, all of them by default.')
+    parser.add_argument('--direction',
+                        action='append',
+                        choices=DIRECTIONS,
+                        help='Read directions to run, all of them by default.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save',
+                        action='store_true',
+                        help='Store the results as the baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    results = run(args.workload, args.direction, args.repeat)
+    if args.save:
+        print_results(results)
+        with open(args.baseline, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+        print('Saved the baseline to {}'.format(args.baseline))
+        return 0
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+    print_results(results, baseline)
+    if baseline is None:
+        print('No baseline at {}, run with --save to store one'.format(
+            args.baseline))
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for workload, direction, stage, base, seconds in regressions:
+        print('Regression: {} {} {} {:.2f} ms -> {:.2f} ms'.format(
+            workload, direction, stage, base * 1000, seconds * 1000))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_benchmarks())
@@ -15,27 +15,48 @@
 # limitations under the License.
 
 import base64
+import bisect
 import collections
-import copy
+import hmac
 import logging
 import os
 import re
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
 from functools import wraps
 from io import BytesIO
 
-import networkx as nx
+# Wall clock time before the third party and model modules are imported and
+# the app is set up, see import_seconds
+import_started = time.perf_counter()
+
 import numpy
-from flask import Flask, json, jsonify, request
+from flask import Flask, g, json, jsonify, request
 from flask_cors import CORS
 from PIL import Image
 from PIL.PngImagePlugin import PngImageFile
 from scipy.spatial import ConvexHull
 from scipy.spatial.qhull import QhullError
-from sklearn.cluster import DBSCAN
 from werkzeug.exceptions import (BadRequest, Forbidden, HTTPException,
-                                    InternalServerError)
-
+                                    InternalServerError, NotFound,
+                                    ServiceUnavailable)
+
+from models.cache import ResultCache, get_cache_key, get_image_digest
+from models.clusters import ClusterLayer, ClusterStore
+from models.dbscan import LatticeDBSCAN, TiledDBSCAN
+from models.encoding import (BINARY_MIMETYPE, GZIP_MIN_SIZE, JSON_MIMETYPE,
+                             NDJSON_MIMETYPE, encode_record,
+                             compress, encode_body, get_mimetypes)
+from models.geometry import ClusterGeometry
+from models.images import get_image_bytes
+from models.jobs import PENDING, JobStore
+from models.metrics import MetricsRegistry, StageTimer
 from models.polygon import Polygon
+from models.pool import AnalysisPool, PoolFull
+from models.sessions import SessionStore
+from models.threshold import ThresholdIndex
 
 
 # Define which port to run on.
@@ -46,20 +67,74 @@ DEBUG = os.environ.get('DEBUG', True)
 if DEBUG == 'False' or DEBUG == '0':
     DEBUG = False
 
+# Request body mimetypes of each kind of analysis input
+INPUT_MIMETYPES = {
+    'image/png': 'image',
+    'application/x-cluster-points': 'points',
+    'application/x-cluster-mask': 'mask'
+}
+
+POOL_FULL_MESSAGE = 'The service is busy, please try again later.'
+
 QHULL_ERROR_MESSAGE = 'Unable to process image do to pixel' + \
     ' dimensions or geometrical degeneracy. Please use the ' + \
     'marquee tool to refine your selection.'
 
-# Pixels limit
-pixel_limit = 50000
-# Threshold value for DBSCAN
-#dbscan_threshold = 160
+# Largest raster, in pixels, that the lattice backend clusters in one piece.
+# Pixels whose bounding box is larger are clustered in tiles, which is slower
+# but only rasterises one tile at a time.
+raster_area_limit = 25000000
+# Pixels limit for tiled clustering
+tiled_pixel_limit = 5000000
+# Default threshold value for DBSCAN
+default_dbscan_threshold = 160
 # DBSCAN eps
 dbscan_eps = 2
 # DBSCAN minimum samples
 dbscan_min_samples = 3
+# DBSCAN implementation, one of DBSCAN_BACKENDS
+dbscan_backend = os.environ.get('DBSCAN_BACKEND', 'lattice')
 # Minimum inner glyphs to qualify as a cartouche
 cartouche_min_glyph_count = 4
+# Number of results cached in memory
+cache_size = int(os.environ.get('CLUSTER_CACHE_SIZE', 128))
+# Directory of the on-disk result cache shared by worker processes, the disk
+# cache is off when this isn't set
+cache_dir = os.environ.get('CLUSTER_CACHE_DIR')
+# Number of results kept in the disk cache
+cache_disk_size = int(os.environ.get('CLUSTER_CACHE_DISK_SIZE', 4096))
+# Token of the administration endpoints, such as cache invalidation, which
+# are refused when this isn't set
+admin_token = os.environ.get('CLUSTER_ADMIN_TOKEN')
+# Number of image sessions each process keeps
+session_count = int(os.environ.get('CLUSTER_SESSION_COUNT', 16))
+# Bytes the sessions of a process can take together, least recently used
+# sessions are dropped beyond this
+session_memory_limit = int(
+    os.environ.get('CLUSTER_SESSION_MEMORY', 512 * 1024 * 1024))
+# Seconds an unused session is kept
+session_ttl = int(os.environ.get('CLUSTER_SESSION_TTL', 1800))
+# SQLite database of asynchronous jobs, shared by the processes of an
+# instance
+job_db = os.environ.get(
+    'CLUSTER_JOB_DB',
+    os.path.join(tempfile.gettempdir(), 'cluster_analysis_jobs.db'))
+# Seconds a job is kept after it was submitted or finished
+job_ttl = int(os.environ.get('CLUSTER_JOB_TTL', 3600))
+# Largest image, in pixels, that point or mask input can cover. Its pixels
+# are clustered on a raster of that size.
+input_area_limit = 16000000
+# Largest image, in pixels, that a session can be opened for. A session
+# keeps the image's grey raster and its threshold index in memory.
+session_area_limit = 16000000
+# Highest threshold covered by a session's threshold index
+session_max_threshold = 255
+# Worker processes that analyses run in, defaults to the CPU count
+pool_workers = int(os.environ.get('CLUSTER_POOL_WORKERS', 0)) or None
+# Analyses that can wait for a worker before requests are refused
+pool_queue_size = int(os.environ.get('CLUSTER_POOL_QUEUE_SIZE', 8))
+# Maximum number of images in a batch request
+batch_limit = 64
 
 
 # Define a new get_headers() function for the HTTPException class, to return application/json MIME type rather than plain HTML
@@ -83,11 +158,48 @@ def get_body(self, environ=None):
 
 HTTPException.get_body = get_body
 
+
+def get_sklearn_dbscan(**kwargs):
+    """
+    Get a scikit-learn DBSCAN estimator. scikit-learn takes longer to import
+    than the rest of the app together, so it is only imported when used
+    param kwargs: The estimator's parameters
+    return An unfitted DBSCAN estimator
+    """
+    from sklearn.cluster import DBSCAN
+    return DBSCAN(**kwargs)
+
+
+# Available DBSCAN implementations, as factories of estimators. They share the
+# sklearn estimator interface and produce identical labels for our integer
+# pixel coordinates.
+DBSCAN_BACKENDS = {
+    'lattice': LatticeDBSCAN,
+    'tiled': TiledDBSCAN,
+    'sklearn': get_sklearn_dbscan
+}
+
+
+def get_dbscan(backend=None):
+    """
+    Get a DBSCAN estimator configured with our eps and minimum samples
+    param backend: Key of DBSCAN_BACKENDS, defaults to dbscan_backend
+    return An unfitted DBSCAN estimator
+    """
+    if backend is None:
+        backend = dbscan_backend
+    if backend not in DBSCAN_BACKENDS:
+        raise ValueError('Unknown DBSCAN backend {}'.format(backend))
+    return DBSCAN_BACKENDS[backend](eps=dbscan_eps,
+                                    min_samples=dbscan_min_samples)
+
+
 def get_buffered_points(points, centroid=None, factor=2.0):
     """
     Add buffer to points in a plane. For example, to expand a convex hull
     param points: Points we want to buffer
-    param centroid: Centroid of the points
+    param centroid: Centroid of the points, or an array of the centroid to
+    use for each point
     param factor: Defines scalar product for point vectors
     return numpy array of new point coordinates
     """
@@ -95,15 +207,11 @@ def get_buffered_points(points, centroid=None, factor=2.0):
     if centroid is None:
         centroid = [0, 0]
 
-    buffered_points = []
+    points = numpy.asarray(points, dtype=float)
     if len(points) == 0:
-        return numpy.array(buffered_points)
-    centroid = numpy.array(centroid)
-    for p in numpy.array(points):
-        buffered_points.append(((p - centroid) * factor) + centroid)
-    buffered_points = [[numpy.rint(p[0]), numpy.rint(p[1])]
-                        for p in buffered_points]
-    return numpy.array(buffered_points)
+        return numpy.array([])
+    centroid = numpy.asarray(centroid, dtype=float)
+    return numpy.rint(((points - centroid) * factor) + centroid)
 
 
 # Create a wrapper for ensuring API requests have an
@@ -139,125 +247,362 @@ def require_json(params=None):
     return require_json_inner
 
 
-def do_cluster_analysis(image, direction, dbscan_threshold=160):
+def do_cluster_analysis(image,
+                        direction,
+                        dbscan_threshold=default_dbscan_threshold,
+                        backend=None,
+                        tiled=None,
+                        timer=None):
+    """
+    Extract an ordered sequence of candidate glyphs from an image
+    param image: A PIL image
+    param direction: The read order
+    param dbscan_threshold: Grey scale threshold for the pixels to cluster
+    param backend: Key of DBSCAN_BACKENDS, defaults to dbscan_backend
+    param tiled: Whether to cluster the image in tiles, see needs_tiles()
+    param timer: An optional StageTimer to time the stages with
+    return The response dictionary
+    """
+    if timer is None:
+        timer = StageTimer()
+    # Process our source image to extract pixels of interest
+    with timer.stage('threshold'):
+        pixels, image_size = get_source_image_pixels(
+            image, threshold=dbscan_threshold)
+    return analyse_pixels(pixels,
+                          direction,
+                          backend=backend,
+                          tiled=tiled,
+                          timer=timer)
+
+
+def check_pixels(pixels):
+    """
+    Raise a BadRequest if there are no pixels to cluster or too many
+    param pixels: The thresholded pixel coordinates
+    """
+    if len(pixels) == 0:
+        raise BadRequest(
+            'No pixels within the threshold range, please try a higher contrast image.'
+        )
+
+    if len(pixels) >= tiled_pixel_limit:
+        raise BadRequest(
+            'Pixel limit of {} was exceeded. Please refine the edge detection or use a smaller segment.'
+            .format(tiled_pixel_limit))
+
+
+def needs_tiles(pixels, backend=None):
+    """
+    Check whether pixels are too spread out for the lattice backend to
+    cluster in one piece. Tiling is only worth it to save memory, as tiles
+    are clustered one after the other, and other backends aren't tiled.
+    param pixels: An (N, 2) array of the [x, y] coordinates of the pixels
+    param backend: Key of DBSCAN_BACKENDS, defaults to dbscan_backend
+    return True to cluster the pixels in tiles
+    """
+    if (backend or dbscan_backend) != 'lattice' or len(pixels) == 0:
+        return False
+    width, height = (pixels.max(axis=0).astype(numpy.int64) -
+                     pixels.min(axis=0) + 1)
+    return width * height > raster_area_limit
+
 
+def analyse_pixels(pixels,
+                   direction,
+                   backend=None,
+                   tiled=None,
+                   db_attributes=None,
+                   timer=None):
+    """
+    Extract an ordered sequence of candidate glyphs from thresholded pixels
+    param pixels: An (N, 2) array of the [x, y] coordinates of the pixels
+    param direction: The read order
+    param backend: Key of DBSCAN_BACKENDS, defaults to dbscan_backend
+    param tiled: Whether to cluster the pixels in tiles, see needs_tiles()
+    param db_attributes: Attributes of an existing DBSCAN fit of the pixels,
+    which are clustered when this isn't given
+    param timer: An optional StageTimer to time the stages with
+    return The response dictionary
+    """
+    if timer is None:
+        timer = StageTimer()
+    job_dict = prepare_analysis(pixels,
+                                direction,
+                                backend=backend,
+                                tiled=tiled,
+                                db_attributes=db_attributes,
+                                timer=timer)
+    with timer.stage('sequence'):
+        set_groups_and_sequence(job_dict, labels_axis=0, direction=direction)
+    with timer.stage('response'):
+        return get_analysis_response(job_dict)
+
+
+def prepare_analysis(pixels,
+                     direction,
+                     backend=None,
+                     tiled=None,
+                     db_attributes=None,
+                     timer=None):
+    """
+    Cluster thresholded pixels and merge the clusters, ready to be grouped
+    and sequenced
+    param pixels: An (N, 2) array of the [x, y] coordinates of the pixels
+    param direction: The read order
+    param backend: Key of DBSCAN_BACKENDS, defaults to dbscan_backend
+    param tiled: Whether to cluster the pixels in tiles, see needs_tiles()
+    param db_attributes: Attributes of an existing DBSCAN fit of the pixels,
+    which are clustered when this isn't given
+    param timer: An optional StageTimer to time the stages with
+    return The job dictionary
+    """
+    if timer is None:
+        timer = StageTimer()
     job_dict = {
         'clusters_raw': {},
         'clusters_processed': {},
-        'bounding_boxes': [],
+        'bounding_boxes': {},
         'groups': [],
         'cartouches': [],
         'direction': direction
     }
 
-    # Process our source image to extract pixels of interest
-    pixels, image_size = get_source_image_pixels(image,
-                                                    threshold=dbscan_threshold)
-    if len(pixels) == 0:
-        raise BadRequest(
-            'No pixels within the threshold range, please try a higher contrast image.'
-        )
+    check_pixels(pixels)
+    timer.count('pixels', len(pixels))
 
-    if len(pixels) >= pixel_limit:
-        raise BadRequest(
-            'Pixel limit of {} was exceeded. Please refine the edge detection or use a smaller segment.'
-            .format(pixel_limit))
+    if tiled is None:
+        tiled = needs_tiles(pixels, backend)
+    if tiled:
+        backend = 'tiled'
 
     # Do the clustering on our thresholded pixel coordinates then
     # check to see if we have found any clusters
-    db_attributes = DBSCAN(eps=dbscan_eps,
-                            min_samples=dbscan_min_samples).fit(pixels)
+    if db_attributes is None:
+        with timer.stage('dbscan'):
+            db_attributes = get_dbscan(backend).fit(pixels)
     if not have_clusters(db_attributes):
         raise BadRequest('No clusters were found.')
 
-    # Create a dictionary of our raw clusters and a copy for the
+    # Create a store of our raw clusters and a copy-on-write layer for the
     # clusters we are going to process
-    job_dict['clusters_raw'] = get_clusters_dictionary(pixels, db_attributes)
-    job_dict['clusters_processed'] = copy.deepcopy(job_dict['clusters_raw'])
+    with timer.stage('clusters'):
+        job_dict['clusters_raw'] = get_clusters_dictionary(
+            pixels, db_attributes)
+        job_dict['clusters_processed'] = job_dict['clusters_raw'].copy()
+    timer.count('clusters', len(job_dict['clusters_raw']))
+    # Geometry of the processed clusters, which are the same as the raw
+    # clusters until they are merged
+    job_dict['geometry'] = ClusterGeometry(job_dict['clusters_processed'])
 
     # Cartouche identification and merging
     # 1. Build the merge dict
     # 2. Find cartouches
     # 3. Merge clusters in the merge dict
-    merge_dict = get_merge_dict(job_dict)
-    cartouche_list = get_cartouches(merge_dict,
-                                    min_glyph_count=cartouche_min_glyph_count)
+    with timer.stage('merge_dict'):
+        merge_dict = get_merge_dict(job_dict)
+    with timer.stage('cartouches'):
+        cartouche_list = get_cartouches(
+            merge_dict, min_glyph_count=cartouche_min_glyph_count)
     job_dict['cartouches'] = cartouche_list
-    merge(job_dict, merge_dict, cartouche_list)
-    set_groups_and_sequence(job_dict, labels_axis=0, direction=direction)
+    with timer.stage('merge'):
+        merge(job_dict, merge_dict, cartouche_list)
+    return job_dict
 
+
+def get_analysis_response(job_dict):
+    """
+    Assemble the response of an analysis
+    param job_dict: The job dictionary after set_groups_and_sequence()
+    return The response dictionary
+    """
     # Restructure response...
     # Going forward, this will be changes and we will simply generate the
     # response in the correct format, but this is the quickest way to achieve
     # this for now
-    response = {
-        'clusters': [],
-        'direction': direction,
+    return {
+        'clusters': get_cluster_records(job_dict, job_dict['sequence']),
+        'direction': job_dict['direction'],
         'cartouches': job_dict['cartouches'],
         'groups': job_dict['groups']
     }
-    for i, sequence_key in enumerate(job_dict['sequence']):
-        #raw_cluster = job_dict['clusters_raw'][sequence_key]
-        processed_cluster = job_dict['clusters_processed'][sequence_key]
-        cluster_vertices = []
-        if len(set([p[0] for p in processed_cluster])) == 1 or len(
-                set([p[1] for p in processed_cluster])) == 1:
-            box_vertices = [
-                list(vertex)
-                for vertex in get_box_vertices(bounding_box(processed_cluster))
-            ]
-            for _, vertex in enumerate(box_vertices):
-                cluster_vertices.append({
-                    'x': int(vertex[0]),
-                    'y': int(vertex[1])
-                })
+
+
+def get_cluster_records(job_dict, labels, start=0):
+    """
+    Get the response records of sequenced clusters, with their buffered
+    convex hulls and bounds
+    param job_dict: The job dictionary with the clusters' bounding boxes
+    param labels: The labels of the clusters in sequence order
+    param start: The position of the first cluster in the whole sequence
+    return A list of cluster dictionaries
+    """
+    boxes = [job_dict['bounding_boxes'][label] for label in labels]
+    # Clusters one pixel wide or high have no convex hull, so their bounding
+    # box is used instead
+    degenerate = [
+        box[2] - box[0] == 1 or box[3] - box[1] == 1 for box in boxes
+    ]
+    # Get the convex hulls and buffer the coordinates of all their vertices
+    # in one go
+    geometry = job_dict['geometry']
+    hull_labels = [
+        label for label, is_degenerate in zip(labels, degenerate)
+        if not is_degenerate
+    ]
+    hull_points = [geometry.hull_points(label) for label in hull_labels]
+    buffered_hulls = []
+    if len(hull_points) > 0:
+        counts = [len(points) for points in hull_points]
+        centroids = numpy.repeat(
+            [geometry.centroid(label) for label in hull_labels],
+            counts,
+            axis=0)
+        buffered_points = get_buffered_points(numpy.concatenate(hull_points),
+                                              centroid=centroids,
+                                              factor=1.1).tolist()
+        offset = 0
+        for count in counts:
+            buffered_hulls.append(buffered_points[offset:offset + count])
+            offset += count
+    buffered_hulls = iter(buffered_hulls)
+    records = []
+    for i, (sequence_key, box, is_degenerate) in enumerate(
+            zip(labels, boxes, degenerate)):
+        if is_degenerate:
+            cluster_vertices = [{
+                'x': x,
+                'y': y
+            } for x, y in get_box_vertices(box).tolist()]
         else:
-            # Get the convex hull and gather the coordinates of the vertices
-            hull = ConvexHull(numpy.array(processed_cluster))
-            centroid = [
-                numpy.mean(hull.points[hull.vertices, 0]),
-                numpy.mean(hull.points[hull.vertices, 1])
-            ]
-            buffered_points = get_buffered_points(hull.points[hull.vertices],
-                                                    centroid=centroid,
-                                                    factor=1.1)
-            for _, point in enumerate(buffered_points):
-                cluster_vertices.append({'x': point[0], 'y': point[1]})
-        box = [b.tolist() for b in bounding_box(processed_cluster)]
-        #raw = [{'x': r[0], 'y': r[1]} for r in raw_cluster]
-        #processed = [{'x': r[0], 'y': r[1]} for r in processed_cluster]
+            cluster_vertices = [{
+                'x': x,
+                'y': y
+            } for x, y in next(buffered_hulls)]
         bounds = {
             'x': box[0],
             'y': box[1],
             'width': box[2] - box[0],
             'height': box[3] - box[1],
-            'order': i
+            'order': start + i
         }
         # rbg 18/09/2018 now returning the convex hull of a cluster
-        response['clusters'].append({
+        records.append({
             'cluster_id': sequence_key,
             'hull': cluster_vertices,
             'bounds': bounds
         })
-        #response['clusters'].append({'cluster_id': sequence_key, 'raw': raw, 'processed': processed, 'bounds': bounds})
-    return response
+    return records
+
+
+def get_grey_raster(image):
+    """
+    Convert an image to a raster of grey values in a single pass.
+    The grey value of a pixel is the sum of its R, G and B channels, i.e.
+    three times the mean, so that comparisons against a threshold stay exact
+    in integer arithmetic. L, LA, RGB, RGBA and palette images are read
+    directly, alpha channels are ignored and any other mode is converted
+    to RGB first.
+    param image: A PIL image
+    return A (height, width) uint16 numpy array of channel sums
+    """
+    if image.mode in ('L', 'LA'):
+        grey = numpy.asarray(image, dtype=numpy.uint16)
+        if grey.ndim == 3:
+            grey = grey[:, :, 0]
+        return grey * 3
+    if image.mode == 'P':
+        palette = numpy.array(image.getpalette() or [], dtype=numpy.uint16)
+        lut = numpy.zeros(256, dtype=numpy.uint16)
+        sums = palette[:len(palette) - len(palette) % 3].reshape(-1, 3).sum(
+            axis=1)[:256]
+        lut[:len(sums)] = sums
+        return lut[numpy.asarray(image)]
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGB')
+    channels = numpy.asarray(image)
+    return channels[:, :, :3].sum(axis=2, dtype=numpy.uint16)
+
+
+def get_threshold_pixels(grey, threshold=160):
+    """
+    Get the coordinates of the pixels in a grey raster (see get_grey_raster())
+    that are darker than the threshold
+    param grey: A (height, width) raster of channel sums
+    param threshold: The grey scale threshold
+    return An (N, 2) integer numpy array of [x, y] coordinates in
+    column-major order, i.e. sorted by x and then by y
+    """
+    # Transposing gives an (x, y) indexed view so nonzero() yields the
+    # coordinates in the same order as a column by column scan
+    xs, ys = numpy.nonzero(grey.T < threshold * 3)
+    pixels = numpy.empty((len(xs), 2), dtype=numpy.int32)
+    pixels[:, 0] = xs
+    pixels[:, 1] = ys
+    return pixels
+
+
+def get_point_pixels(data):
+    """
+    Get the pixels to cluster from packed coordinates
+    param data: Bytes of little endian int16 [x, y] pairs. Coordinates can't
+    be negative and the image they cover can have up to input_area_limit
+    pixels.
+    return An (N, 2) array of the distinct [x, y] coordinates in the same
+    order as get_threshold_pixels()
+    """
+    if len(data) % 4 != 0:
+        raise BadRequest(
+            'Point data must be pairs of 16 bit integer coordinates')
+    points = numpy.frombuffer(data, dtype='<i2').reshape(-1, 2)
+    if len(points) == 0:
+        return numpy.empty((0, 2), dtype=numpy.int32)
+    if points.min() < 0:
+        raise BadRequest('Point coordinates can\'t be negative')
+    width, height = points.max(axis=0).astype(numpy.int64) + 1
+    check_input_area(width, height)
+    # Sort by x and then y and drop duplicates
+    return numpy.unique(points, axis=0).astype(numpy.int32)
+
+
+def check_input_area(width, height):
+    """
+    Raise a BadRequest if point or mask input covers more than
+    input_area_limit pixels
+    param width: The width of the input
+    param height: The height of the input
+    """
+    if width * height > input_area_limit:
+        raise BadRequest(
+            'The input covers {} by {} pixels, the limit is {} pixels'.format(
+                width, height, input_area_limit))
+
+
+def get_mask_pixels(data, width, height):
+    """
+    Get the pixels to cluster from a 1-bit mask
+    param data: Bytes of the mask rows from the top, with 8 pixels to a byte
+    starting from the most significant bit and each row padded to a whole
+    byte, as in a PBM image. Set bits are the pixels to cluster.
+    param width: The width of the mask
+    param height: The height of the mask
+    return An (N, 2) array of the [x, y] coordinates in the same order as
+    get_threshold_pixels()
+    """
+    row_bytes = (width + 7) // 8
+    if width <= 0 or height <= 0 or len(data) != row_bytes * height:
+        raise BadRequest(
+            'Mask data must be {} rows of {} bytes'.format(height, row_bytes))
+    check_input_area(width, height)
+    bits = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8))
+    mask = bits.reshape(height, row_bytes * 8)[:, :width]
+    return numpy.stack(numpy.nonzero(mask.T), axis=1).astype(numpy.int32)
+
 
 def get_source_image_pixels(image, threshold=160, invert=False):
-    imagePixels = image.load()
-    #imagePixels = im.load()
-    #print ("Image width and height:", im.size)
-    #print ("Number of pixels in image:",im.size[0] * im.size[1])
-
-    # Convert the RGB image array to a set of gray scale
-    # pixel coordinates over a certain threshold
-    # These pixel cooordinates define the feature space
-    pixels = []
-    for x in range(image.size[0]):
-        for y in range(image.size[1]):
-            grayScale = (imagePixels[x, y][0] + imagePixels[x, y][1] +
-                            imagePixels[x, y][2]) / 3
-            if (grayScale < threshold):
-                pixels.append([x, y])
+    # Convert the image to a set of gray scale pixel coordinates under a
+    # certain threshold. These pixel cooordinates define the feature space
+    pixels = get_threshold_pixels(get_grey_raster(image), threshold=threshold)
     return (pixels, image.size)
 
 
@@ -274,36 +619,46 @@ def have_clusters(db_attributes):
 
 def get_clusters_dictionary(pixels, db_attributes):
     """
-    Put clusters into a dictionary where the key is the
-    cluster label and the value is an array of cluster [x,y]
-    coordinates
+    Put clusters into a ClusterStore, a mapping where the key is the
+    cluster label and the value is a read-only array of cluster [x,y]
+    coordinates. Noise is ignored.
+    param pixels: The clustered pixel coordinates
     param db_attributes: Attributes generated by DBSCAN fit() method
-    return A dictionary of clusters
+    return A ClusterStore of clusters
     """
-    clusters_dict = {}
-    for cluster_label in set(db_attributes.labels_):
-        if cluster_label == -1:
-            # Ignore noise
-            continue
-        cluster = []
-        # Build a cluster
-        cluster = [
-            pixels[j]
-            for j in numpy.where(db_attributes.labels_ == cluster_label)[0]
-        ]
-        # Store the cluster in the dictionary
-        clusters_dict[str(cluster_label)] = cluster
-    return clusters_dict
+    return ClusterStore.from_labels(pixels, db_attributes.labels_)
 
 
 def bounding_box(cluster):
-    box = []
-    cluster = numpy.array(cluster)
-    box.append(min(cluster[:, 0]))
-    box.append(min(cluster[:, 1]))
-    box.append(max(cluster[:, 0] + 1))
-    box.append(max(cluster[:, 1] + 1))
-    return box
+    cluster = numpy.asarray(cluster)
+    low = cluster.min(axis=0)
+    high = cluster.max(axis=0) + 1
+    return [low[0], low[1], high[0], high[1]]
+
+
+def get_bounding_boxes(clusters_dict, labels=None):
+    """
+    Get the bounding boxes of a set of clusters in one pass over their
+    coordinates
+    param clusters_dict: A dictionary of clusters
+    param labels: The labels of the clusters to box, all of them by default
+    return A dictionary of cluster bounding boxes
+    """
+    if labels is None:
+        labels = clusters_dict.keys()
+    labels = list(labels)
+    if len(labels) == 0:
+        return {}
+    clusters = [
+        numpy.asarray(clusters_dict[label]).reshape(-1, 2) for label in labels
+    ]
+    starts = numpy.cumsum([0] + [len(cluster) for cluster in clusters[:-1]])
+    points = numpy.concatenate(clusters)
+    boxes = numpy.hstack([
+        numpy.minimum.reduceat(points, starts, axis=0),
+        numpy.maximum.reduceat(points, starts, axis=0) + 1
+    ]).tolist()
+    return dict(zip(labels, boxes))
 
 
 def inside(box1, box2):
@@ -311,21 +666,50 @@ def inside(box1, box2):
         2] and box2[3] <= box1[3]
 
 
-def poly_inside(cluster_1, cluster_2):
+def get_containment_candidates(boxes):
+    """
+    Find the bounding boxes inside each bounding box (see inside()) with a
+    sort and sweep over the left box edges. A box can only contain boxes
+    whose left edge lies between its own left and right edges, so each box is
+    only compared with that slice of the sorted boxes.
+    param boxes: A list of bounding boxes
+    return A list containing, for each box, an array of the indices of the
+    other boxes inside it in ascending order
+    """
+    boxes = numpy.asarray(boxes).reshape(-1, 4)
+    order = numpy.argsort(boxes[:, 0], kind='mergesort')
+    left_edges = boxes[order, 0]
+    starts = numpy.searchsorted(left_edges, boxes[:, 0], side='left')
+    stops = numpy.searchsorted(left_edges, boxes[:, 2], side='left')
+    candidates = []
+    for i, box in enumerate(boxes):
+        indices = order[starts[i]:stops[i]]
+        others = boxes[indices]
+        is_inside = (others[:, 1] >= box[1]) & (others[:, 2] <= box[2]) & (
+            others[:, 3] <= box[3]) & (indices != i)
+        candidates.append(numpy.sort(indices[is_inside]))
+    return candidates
+
+
+def poly_inside(cluster_1, cluster_2, polygon=None):
     """
     Check whether the polygon of cluster_2 is entirely
     inside the polygon of cluster_1
     param cluster_1: The outer cluster
     param cluster_2: The putativee inner rectangle
+    param polygon: The convex hull Polygon of cluster_1 if already known,
+    see ClusterGeometry.polygon()
     return: Boolean, True if cluster_2 is inside cluster_1 else False
     """
-    hull_outer = ConvexHull(numpy.array(cluster_1))
-    points_outer = numpy.array(cluster_1)
-    poly = Polygon(points_outer[hull_outer.vertices, 0],
-                    points_outer[hull_outer.vertices, 1])
-    points_inner = numpy.array(cluster_2)
-    insiders = (poly.is_inside([point[0] for point in points_inner],
-                                [point[1] for point in points_inner]) >= 0)
+    if polygon is None:
+        hull_outer = ConvexHull(numpy.array(cluster_1))
+        points_outer = numpy.array(cluster_1)
+        polygon = Polygon(points_outer[hull_outer.vertices, 0],
+                          points_outer[hull_outer.vertices, 1])
+    # The hull is convex so the cheaper sign-only test is enough
+    points_inner = numpy.asarray(cluster_2)
+    insiders = (polygon.is_inside_convex(points_inner[:, 0],
+                                         points_inner[:, 1]) >= 0)
     return numpy.all(insiders == True)
 
 
@@ -336,29 +720,30 @@ def get_merge_dict(job_dict):
     The dictionary key is a cluster identifier defining
     an outer cluster. A dictionary value is a list
     of inner cluster labels.
-    param job_dict: A job's dictionary
+    param job_dict: A job's dictionary. Its geometry, if present, must still
+    describe the raw clusters
     return: A dictionary defining clusters to merge
     """
+    geometry = job_dict.get('geometry')
+    if geometry is None:
+        geometry = ClusterGeometry(job_dict['clusters_raw'])
     # Compute the bounding box for all raw clusters
-    boxes = {}
-    for cluster_label in job_dict['clusters_raw']:
-        boxes[cluster_label] = bounding_box(
-            job_dict['clusters_raw'][cluster_label])
+    labels = list(job_dict['clusters_raw'])
+    boxes = [
+        bounding_box(geometry.array(cluster_label)) for cluster_label in labels
+    ]
     # Look for clusters within other clusters based on bounding boxes
     merge_dict = {}
-    for i in boxes:
-        for j in boxes:
-            if i == j:
-                continue
-            else:
-                if inside(boxes[i], boxes[j]):
-                    # Check that inner polygon is entirely inside outer polygon
-                    if poly_inside(job_dict['clusters_raw'][i],
-                                    job_dict['clusters_raw'][j]):
-                        if i in merge_dict:
-                            merge_dict[i].append(j)
-                        else:
-                            merge_dict[i] = [j]
+    for i, inner_indices in zip(labels, get_containment_candidates(boxes)):
+        for j in [labels[index] for index in inner_indices]:
+            # Check that inner polygon is entirely inside outer polygon
+            if poly_inside(geometry.array(i),
+                           geometry.array(j),
+                           polygon=geometry.polygon(i)):
+                if i in merge_dict:
+                    merge_dict[i].append(j)
+                else:
+                    merge_dict[i] = [j]
     # Rationalise the merge dict so that values
     # contain only clusters that are one level down from the
     # the outer cluster
@@ -390,37 +775,76 @@ def get_cartouches(merge_dict, min_glyph_count=3):
     # If the merge_dict is empty then there can't be any cartouches
     if len(merge_dict) == 0:
         return cartouche_list
-    # Generate the edge list based on merge dict
-    elist = []
-    for k in merge_dict:
-        for cluster in merge_dict[k]:
-            t = (k, cluster)
-            elist.append(t)
-    # Create a directed graph
-    DG = nx.DiGraph()
-    DG.add_edges_from(elist)
+    labels, children, parents = get_containment_forest(merge_dict)
     # Iterate nodes from the bottom
-    for i, node in enumerate(reversed(list(DG.nodes))):
-        cartouche_dict = {}
-        successors = list(DG.successors(node))
-        if len(successors) >= min_glyph_count:
-            is_cartouche = True
-            cartouche_dict['inner'] = successors
-            cartouche_dict['wrapper'] = [node]
-            cartouche_dict['frames'] = sorted(list(nx.ancestors(DG, node)))
-            if len(cartouche_dict['frames']) == 0:
-                cartouche_list.append(cartouche_dict)
-            else:
-                for cluster in cartouche_dict['frames']:
-                    successors = list(DG.successors(cluster))
-                    if len(successors) > 1:
-                        is_cartouche = False
-                        break
-                if is_cartouche:
-                    cartouche_list.append(cartouche_dict)
+    for node in reversed(range(len(labels))):
+        if len(children[node]) < min_glyph_count:
+            continue
+        frames = get_ancestors(parents, node)
+        # The frames must only enclose the cartouche
+        if any(len(children[frame]) > 1 for frame in frames):
+            continue
+        cartouche_list.append({
+            'inner': [labels[child] for child in children[node]],
+            'wrapper': [labels[node]],
+            'frames': sorted(labels[frame] for frame in frames)
+        })
     return cartouche_list
 
 
+def get_containment_forest(merge_dict):
+    """
+    Build the containment forest of a merge dictionary (see get_merge_dict()
+    function) in one pass. Nodes are numbered in the order their labels first
+    appear in the merge dictionary. A cluster usually has one parent, but a
+    cluster inside two overlapping clusters has both.
+    param merge_dict: A dictionary defining clusters
+    return: A tuple of the list of node labels and lists of the children and
+    parents of every node, in the order they appear
+    """
+    labels = []
+    nodes = {}
+    children = []
+    parents = []
+
+    def get_node(label):
+        if label not in nodes:
+            nodes[label] = len(labels)
+            labels.append(label)
+            children.append([])
+            parents.append([])
+        return nodes[label]
+
+    edges = set()
+    for outer in merge_dict:
+        parent = get_node(outer)
+        for inner in merge_dict[outer]:
+            child = get_node(inner)
+            if (parent, child) not in edges:
+                edges.add((parent, child))
+                children[parent].append(child)
+                parents[child].append(parent)
+    return labels, children, parents
+
+
+def get_ancestors(parents, node):
+    """
+    Get the nodes a node is nested in
+    param parents: The parents of every node, see get_containment_forest()
+    param node: A node
+    return: The set of the node's ancestors, which doesn't include the node
+    """
+    ancestors = set()
+    stack = list(parents[node])
+    while stack:
+        ancestor = stack.pop()
+        if ancestor not in ancestors:
+            ancestors.add(ancestor)
+            stack.extend(parents[ancestor])
+    ancestors.discard(node)
+    return ancestors
+
+
 def merge(job_dict, merge_dict, cartouche_list):
     """
     Use the merge dictionary and cartouche list to merge clusters.
@@ -431,12 +855,19 @@ def merge(job_dict, merge_dict, cartouche_list):
     param merge_dict: A dictionary defining clusters
     param cartouche_list: A list of cartouche dictionaries
     """
-    # Build a list of cartouche wrappers and frames so we don't merge cartouche
+    geometry = job_dict.get('geometry')
+    clusters = job_dict['clusters_processed']
+    # Build a set of cartouche wrappers and frames so we don't merge cartouche
     # inner clusters with their frames
-    cartouche_clusters = []
+    cartouche_clusters = set()
     for c in cartouche_list:
-        cartouche_clusters = cartouche_clusters + c['wrapper']
-        cartouche_clusters = cartouche_clusters + c['frames']
+        cartouche_clusters.update(c['wrapper'])
+        cartouche_clusters.update(c['frames'])
+    # Resolve the merges on labels first. Each merged outer cluster gets the
+    # ordered list of the clusters it is made of, and an inner cluster
+    # contributes what it has gathered so far as an outer cluster itself.
+    members = {}
+    member_sets = {}
     # Store the labels of inner clusters that we merge with outer clusters
     pop_list = []
     for outer in merge_dict:
@@ -444,19 +875,32 @@ def merge(job_dict, merge_dict, cartouche_list):
             for inner in merge_dict[outer]:
                 # We may have already processed our raw clusters so want to
                 # avoid a key error
-                if outer in job_dict[
-                        'clusters_processed'] and inner in job_dict[
-                            'clusters_processed']:
-                    # Merge the 2 clusters and label with the name of the outer
-                    # cluster then delete the inner cluster
-                    job_dict['clusters_processed'][outer] = merge_clusters(
-                        job_dict['clusters_processed'][inner],
-                        job_dict['clusters_processed'][outer])
+                if outer in clusters and inner in clusters:
+                    outer_members = members.setdefault(outer, [outer])
+                    outer_set = member_sets.setdefault(outer, {outer})
+                    for label in members.get(inner, [inner]):
+                        if label not in outer_set:
+                            outer_members.append(label)
+                            outer_set.add(label)
                     pop_list.append(inner)
+    # Gather the pixels of each merged cluster in one pass. Clusters don't
+    # share pixels, so concatenating the members is the same as merging
+    # them pairwise with merge_clusters.
+    sources = {
+        label: clusters[label]
+        for outer_members in members.values() for label in outer_members
+    }
+    for outer, outer_members in members.items():
+        clusters[outer] = numpy.concatenate(
+            [sources[label] for label in outer_members])
+        if geometry is not None:
+            geometry.invalidate(outer)
     # Remove the clusters that have been merged
     for inner in pop_list:
+        if geometry is not None:
+            geometry.invalidate(inner)
         try:
-            job_dict['clusters_processed'].pop(inner)
+            clusters.pop(inner)
         except KeyError as e:
             logging.info('The value inner may have already popped.')
             logging.error(e)
@@ -467,29 +911,48 @@ def merge_clusters(inner_cluster, outer_cluster):
     Merge two clusters
     param inner_cluster: The cluster that's inside another cluster
     param outer_cluster: The cluster that's outside another cluster
+    return An array of the outer cluster's coordinates followed by those of
+    the inner cluster that are not in the outer cluster
     """
-    outer_cluster = outer_cluster + [
-        item for item in inner_cluster if item not in outer_cluster
-    ]
-    return outer_cluster
+    inner_cluster = numpy.asarray(inner_cluster).reshape(-1, 2)
+    outer_cluster = numpy.asarray(outer_cluster).reshape(-1, 2)
+
+    def get_keys(cluster):
+        return (cluster[:, 0].astype(numpy.int64) << 32) + cluster[:, 1]
+
+    is_new = ~numpy.isin(get_keys(inner_cluster), get_keys(outer_cluster))
+    return numpy.concatenate([outer_cluster, inner_cluster[is_new]])
 
 
 def set_groups_and_sequence(job_dict, labels_axis=0, direction='ltr'):
+    groups = list(iter_groups(job_dict, labels_axis, direction))
+    job_dict['groups'] = groups
+    job_dict['sequence'] = [
+        cluster_label for group in groups for cluster_label in group
+    ]
+
+
+def iter_groups(job_dict, labels_axis=0, direction='ltr'):
+    """
+    Group the processed clusters of a job and order each group, yielding the
+    groups as they are completed
+    param job_dict: A job's dictionary. Its bounding boxes are set before
+    the first group is yielded
+    param labels_axis: The axis to group the clusters along
+    param direction: The read order
+    return A generator of the lists of the labels of each group in order
+    """
     clusters_dict = job_dict['clusters_processed']
+    # Build a dictionary of cluster bounding boxes
+    box_dict = get_bounding_boxes(clusters_dict)
+    job_dict['bounding_boxes'] = box_dict
     labels_dict = get_labels(clusters_dict,
                                 labels_of_interest=[],
                                 axis=labels_axis,
-                                direction=direction)
+                                direction=direction,
+                                box_dict=box_dict)
     label_lists = list(labels_dict.values())
-    # Build a dictionary of cluster bounding boxes
-    box_dict = {}
-    cluster_labels = [
-        label for inner_list in label_lists for label in inner_list
-    ]
-    for cluster_label in cluster_labels:
-        box_dict[cluster_label] = bounding_box(clusters_dict[cluster_label])
     # Start building the groups
-    groups = []
     g = []
     # Iterate the labels list
     for i in range(1, len(label_lists)):
@@ -502,15 +965,11 @@ def set_groups_and_sequence(job_dict, labels_axis=0, direction='ltr'):
             # We crossed a group boundary so add the group we've being building to the groups list
             if len(g) > 0:
                 # Sort within a group
-                groups.append(order_group(g, box_dict, direction))
+                yield order_group(g, box_dict, direction)
                 g = []
     if len(g) > 0:
         # Sort within a group
-        groups.append(order_group(g, box_dict, direction))
-    job_dict['groups'] = groups
-    job_dict['sequence'] = [
-        cluster_label for group in groups for cluster_label in group
-    ]
+        yield order_group(g, box_dict, direction)
 
 
 def y_overlaps(cluster1, cluster2):
@@ -533,81 +992,199 @@ def order_group(group, box_dict, read_order):
     param read_order: The read order for the glyphs
     return a list containing the group's clusters in correct read-order
     """
-    # Generate a coordinate data structure from the bounding boxes
-    candidates = {}
+    # Generate a coordinate data structure from the bounding boxes. The
+    # x-axis is flipped so that we always read from left to right and the
+    # y-axis so that the top of the group has the highest y values.
+    x_lows = []
+    x_highs = []
+    y_lows = []
+    y_highs = []
     for label in group:
-        box = box_dict[label]
+        box = [int(b) for b in box_dict[label]]
         if read_order == 'rtl' or read_order == 'vrtl':
-            candidates[label] = ((box[0], 0 - box[3]), (box[2], 0 - box[1]))
+            x_lows.append(box[0])
+            x_highs.append(box[2])
         else:
-            candidates[label] = ((0 - box[2], 0 - box[3]), (0 - box[0],
-                                                            0 - box[1]))
-
+            x_lows.append(0 - box[2])
+            x_highs.append(0 - box[0])
+        y_lows.append(0 - box[3])
+        y_highs.append(0 - box[1])
+
+    # The next cluster is found by repeatedly taking the top cluster, the
+    # one that is highest, or last in the group of those that are equally
+    # high, and narrowing the candidates to those that overlap it on the
+    # y-axis and lie after it on the x-axis. When no candidates are left the
+    # last top cluster is the next in order. The top clusters only ever get
+    # lower and further along the x-axis, so the candidates after a top
+    # cluster are those with:
+    #   x low >= the top cluster's x high
+    #   y high <= the top cluster's y high
+    #   y high >= the highest y low of the top clusters so far
+    # and taking a cluster out of the group only invalidates the top
+    # clusters from it on, so they are kept on a stack.
+    tree = _GroupTree(x_lows, y_highs)
     order = []
-    while len(candidates) > 0:
-        #Create some side lists to simplify code
-        yDict = {}
-        xDict = {}
-        for rectangle in candidates:
-            tuples = candidates[rectangle]
-            yDict[rectangle] = (tuples[0][1], tuples[1][1])
-        for rectangle in candidates:
-            tuples = candidates[rectangle]
-            xDict[rectangle] = (tuples[0][0], tuples[1][0])
-        #A
-        rightCand = candidates
-        while len(rightCand) > 0:
-            #1st step
-            yres = -100000
-            for rectangle in rightCand:
-                if yDict[rectangle][1] >= yres:
-                    yres = yDict[rectangle][1]
-                    topRectangle = rectangle
-            #2nd step
-            auxRightCand = []
-            xres = xDict[topRectangle][1]
-            for rectangle in rightCand:
-                if y_overlaps(
-                        yDict[rectangle],
-                        yDict[topRectangle]) and xDict[rectangle][0] >= xres:
-                    auxRightCand.append(rectangle)
-            rightCand = auxRightCand
-        #B
-        order.append(topRectangle)
-        candidates.pop(topRectangle)
+    # The stack holds a top cluster and the x low, y high and y low bounds of
+    # the candidates after it
+    stack = []
+    bounds = (None, None, -100000)
+    while len(order) < len(group):
+        x_min, y_high_max, y_high_min = bounds
+        top = tree.get_top(x_min, y_high_max)
+        if top is not None and y_highs[top] >= y_high_min:
+            stack.append((top, bounds))
+            bounds = (x_highs[top], y_highs[top],
+                      max(y_high_min, y_lows[top]))
+        else:
+            top, bounds = stack.pop()
+            order.append(group[top])
+            tree.remove(top)
     return order
 
 
-def get_labels(clusters_dict, labels_of_interest=[], axis=0, direction='ltr'):
-    step = 1
+class _GroupTree:
+    """
+    A segment tree of a group's clusters sorted by the low x values of their
+    boxes. Each node keeps the sorted (y high, index) keys of the clusters
+    under it.
+    param x_lows: The low x value of each cluster
+    param y_highs: The high y value of each cluster
+    """
+
+    def __init__(self, x_lows, y_highs):
+        self.size = 1
+        while self.size < len(x_lows):
+            self.size *= 2
+        self.x_order = sorted(range(len(x_lows)), key=lambda i: x_lows[i])
+        self.sorted_x_lows = [x_lows[i] for i in self.x_order]
+        self.positions = [0] * len(x_lows)
+        for position, i in enumerate(self.x_order):
+            self.positions[i] = position
+        self.keys = [(y_highs[i], i) for i in range(len(y_highs))]
+        self.nodes = [[] for _ in range(2 * self.size)]
+        for position, i in enumerate(self.x_order):
+            self.nodes[self.size + position] = [self.keys[i]]
+        for node in range(self.size - 1, 0, -1):
+            self.nodes[node] = sorted(self.nodes[2 * node] +
+                                      self.nodes[2 * node + 1])
+
+    def get_top(self, x_min=None, y_high_max=None):
+        """
+        Get the cluster with the highest (y high, index) key among those with
+        x low >= x_min and y high <= y_high_max
+        return The index of the cluster or None
+        """
+        if x_min is None:
+            low = 0
+        else:
+            low = bisect.bisect_left(self.sorted_x_lows, x_min)
+        limit = (y_high_max + 1, -1) if y_high_max is not None else None
+        best = None
+        low += self.size
+        high = 2 * self.size
+        while low < high:
+            if low & 1:
+                keys = self.nodes[low]
+                if limit is None:
+                    k = len(keys)
+                else:
+                    k = bisect.bisect_left(keys, limit)
+                if k > 0 and (best is None or keys[k - 1] > best):
+                    best = keys[k - 1]
+                low += 1
+            low //= 2
+            high //= 2
+        return None if best is None else best[1]
+
+    def remove(self, i):
+        key = self.keys[i]
+        node = self.size + self.positions[i]
+        while node > 0:
+            keys = self.nodes[node]
+            del keys[bisect.bisect_left(keys, key)]
+            node //= 2
+
+
+def get_labels(clusters_dict,
+               labels_of_interest=[],
+               axis=0,
+               direction='ltr',
+               box_dict=None):
+    """
+    Label the columns (or rows) of the image with the clusters that span
+    them. A cluster is only added to a column if its bounding box doesn't
+    overlap those of the clusters already in the column, though one bounding
+    box entirely within another is permitted.
+    The columns are swept from one bounding box edge to the next, so the
+    labels are worked out once for every run of columns spanned by the same
+    clusters rather than once per column.
+    param clusters_dict: A dictionary of clusters
+    param labels_of_interest: The labels to use, all of them by default
+    param axis: 0 to label columns on the x-axis and 1 to label rows
+    param direction: The read direction, columns are in reverse for rtl
+    param box_dict: An optional dictionary of precomputed bounding boxes
+    return An ordered dictionary of column to the list of its labels
+    """
+    if len(labels_of_interest) == 0:
+        labels_of_interest = list(clusters_dict.keys())
+    if box_dict is None:
+        box_dict = get_bounding_boxes(clusters_dict, labels_of_interest)
     if axis == 0:
         # x-axis labelling
         box_min_index = 0
         box_max_index = 2
-        if direction == 'rtl':
-            # Go in reverse on the x-axis
-            box_min_index = 2
-            box_max_index = 0
-            step = -1
     else:
         # y-axis labelling because we have a column and we always read from top
         # If we have a read-order of vrtl we sort by reversed x values within groups
         box_min_index = 1
         box_max_index = 3
+    # Going in reverse on the x-axis spans the columns after the box's
+    # minimum up to and including its maximum
+    shift = 1 if direction == 'rtl' and axis == 0 else 0
+    # Sweep events of (column, index of the label, True when the label
+    # enters)
+    events = []
+    for index, cluster_label in enumerate(labels_of_interest):
+        box = box_dict[cluster_label]
+        start = int(box[box_min_index]) + shift
+        stop = int(box[box_max_index]) + shift
+        if start < stop:
+            events.append((start, index, True))
+            events.append((stop, index, False))
+    events.sort()
+    conflicts = {}
+
+    def have_conflict(index, other_index):
+        key = (index, other_index)
+        if key not in conflicts:
+            conflicts[key] = have_box_overlaps(
+                box_dict[labels_of_interest[index]],
+                [box_dict[labels_of_interest[other_index]]], axis)
+        return conflicts[key]
+
     d = {}
-    if len(labels_of_interest) == 0:
-        labels_of_interest = list(clusters_dict.keys())
-    for cluster_label in labels_of_interest:
-        box = bounding_box(clusters_dict[cluster_label])
-        for i in range(box[box_min_index], box[box_max_index], step):
-            if i not in d:
-                d[i] = []
-                d[i].append(cluster_label)
-            # Append another cluster label only if there's no overlap of the cluster's bounding
-            # box with others in the label set. One bounding box entirely within another is permitted
-            else:
-                if not have_overlaps(cluster_label, d[i], clusters_dict, axis):
-                    d[i].append(cluster_label)
+    # The indices of the labels spanning the current column, in label order
+    active = []
+    for e, (column, index, enters) in enumerate(events):
+        if enters:
+            bisect.insort(active, index)
+        else:
+            active.remove(index)
+        if e + 1 == len(events) or events[e + 1][0] == column:
+            continue
+        if len(active) == 0:
+            continue
+        # Add the labels in order, skipping those that overlap one already
+        # added
+        accepted = []
+        for index in active:
+            if not any(
+                    have_conflict(index, other_index)
+                    for other_index in accepted):
+                accepted.append(index)
+        column_labels = [labels_of_interest[index] for index in accepted]
+        for i in range(column, events[e + 1][0]):
+            d[i] = list(column_labels)
     od = collections.OrderedDict(sorted(d.items()))
     if direction == 'rtl' and axis == 0:
         od = collections.OrderedDict(reversed(list(od.items())))
@@ -616,13 +1193,20 @@ def get_labels(clusters_dict, labels_of_interest=[], axis=0, direction='ltr'):
 
 def have_overlaps(label, labels_list, clusters_dict, axis=0):
     label_box = bounding_box(clusters_dict[label])
-    for list_label in labels_list:
-        if list_label is not label:
-            list_label_box = bounding_box(clusters_dict[list_label])
-            if not inside_axis(list_label_box, label_box, axis) \
-                    and not inside(list_label_box, label_box)\
-                    and overlaps(list_label_box, label_box):
-                return True
+    list_label_boxes = [
+        bounding_box(clusters_dict[list_label])
+        for list_label in labels_list
+        if list_label is not label
+    ]
+    return have_box_overlaps(label_box, list_label_boxes, axis)
+
+
+def have_box_overlaps(label_box, list_label_boxes, axis=0):
+    for list_label_box in list_label_boxes:
+        if not inside_axis(list_label_box, label_box, axis) \
+                and not inside(list_label_box, label_box)\
+                and overlaps(list_label_box, label_box):
+            return True
     return False
 
 
@@ -703,31 +1287,54 @@ def find_plural_marks(job_dict, width_threshold, height_threshold):
 
 
 def serialize_job_dictionary(job_dict):
-    file_name = "jobs" + os.path.sep + "dictionary.json"
-    with open(file_name, 'w') as outfile:
-        json.dump(job_dict, outfile)
+    """
+    Get a job dictionary in a form that can be written as JSON, for
+    debugging. Results of analyses are kept with their jobs, see
+    submit_job().
+    param job_dict: A job dictionary
+    return A JSON serializable dictionary
+    """
+    # Cluster stores are written as plain lists and cached geometry is
+    # left out
+    return {
+        key: value.to_dict() if isinstance(value,
+                                           (ClusterStore,
+                                            ClusterLayer)) else value
+        for key, value in job_dict.items() if key != 'geometry'
+    }
 
 
-app = Flask(__name__)
-CORS(app)
+def open_image(imagebytes):
+    """
+    Create an image object from image file bytes and validate it
+    param imagebytes: The bytes of a png image file
+    return The PIL image
+    """
+    try:
+        image = Image.open(BytesIO(imagebytes))
 
-@app.route('/_ah/warmup')
-def warmup():
-    return '', 200, {}
+    except IOError as e:
+        logging.error(e)
+        message = list(e.args)[0]
+        raise BadRequest(message)
 
-@app.route('/clusteranalysis', methods=['POST'])
-@require_json(['image'])
-def cluster_analysis(payload):
-    """Cluster analysis endpoint to perform cluster
-    analysis on the given image data"""
+    if not isinstance(image, PngImageFile):
+        raise BadRequest('Only png images are accepted')
 
-    # Create an image object from the image data and validate it
+    return image
+
+
+def decode_image(payload):
+    """
+    Create an image object from a request's image data and validate it
+    param payload: The request's JSON payload
+    return A tuple of the PIL image and its decoded bytes
+    """
     try:
         image = payload.get('image')
         imagedata = re.sub('^data:image/.+;base64,', '',
                             image)  # Strip the image meta
-        imagebytes = BytesIO(base64.b64decode(imagedata))
-        image = Image.open(imagebytes)
+        imagebytes = base64.b64decode(imagedata)
 
     except base64.binascii.Error as e:
         logging.error(e)
@@ -739,32 +1346,635 @@ def cluster_analysis(payload):
             e.message, base64.binascii.Error) else e.message
         raise BadRequest('Unable to process image data: {}'.format(e.message))
 
-    except IOError as e:
-        logging.error(e)
-        message = list(e.args)[0]
-        raise BadRequest(message)
+    return open_image(imagebytes), imagebytes
 
-    if not isinstance(image, PngImageFile):
-        raise BadRequest('Only png images are accepted')
 
-    # Validate the read order
+def get_analysis_request():
+    """
+    Get the parameters and input of an analysis request. The input can be:
+    - A JSON payload with a png image data URL, points or mask, see
+    get_pixel_input()
+    - A body of one of the INPUT_MIMETYPES with the parameters in the query
+    string
+    - A multipart/form-data upload with an image, points or mask file and
+    the parameters in the form or query string
+    return A tuple of the parameters dictionary, the input bytes and the
+    kind of input, one of INPUT_MIMETYPES' values. The input and its kind are
+    None for JSON requests.
+    """
+    data = None
+    kind = None
+    if request.mimetype in INPUT_MIMETYPES:
+        payload = request.args.to_dict()
+        data = request.get_data(cache=False)
+        kind = INPUT_MIMETYPES[request.mimetype]
+    elif request.mimetype == 'multipart/form-data':
+        payload = request.args.to_dict()
+        payload.update(request.form.to_dict())
+        for name in INPUT_MIMETYPES.values():
+            if name in request.files:
+                data = request.files[name].read()
+                kind = name
+                break
+    elif request.is_json:
+        return request.get_json(cache=False), None, None
+    else:
+        raise BadRequest('The request content type must be application/json')
+    # Parameters that aren't JSON are strings
+    for name in ['session', 'stream']:
+        if name in payload:
+            payload[name] = payload[name].lower() in ['true', '1']
+    if not data:
+        data = None
+        kind = None
+    return payload, data, kind
+
+
+def get_pixel_input(payload):
+    """
+    Get the pixel input of a JSON request, given as base64 "points", see
+    get_point_pixels(), or as a base64 "mask" with its "width" and "height",
+    see get_mask_pixels()
+    param payload: The request's JSON payload
+    return A tuple of the decoded input and its kind, or (None, None) if the
+    request has neither
+    """
+    for kind in ['points', 'mask']:
+        if payload.get(kind):
+            try:
+                return base64.b64decode(payload.get(kind)), kind
+            except (base64.binascii.Error, TypeError) as e:
+                logging.error(e)
+                raise BadRequest('Unable to process {} data: {}'.format(
+                    kind, e))
+    return None, None
+
+
+def get_input_pixels(data, kind, payload):
+    """
+    Get the pixels to cluster from point or mask input
+    param data: The input bytes
+    param kind: 'points' or 'mask'
+    param payload: The request parameters, with the mask's width and height
+    return An (N, 2) array of [x, y] coordinates
+    """
+    if kind == 'points':
+        return get_point_pixels(data)
+    try:
+        width = int(payload.get('width'))
+        height = int(payload.get('height'))
+    except (TypeError, ValueError):
+        raise BadRequest('The mask width and height must be given')
+    return get_mask_pixels(data, width, height)
+
+
+def make_analysis_response(body, mimetypes=None):
+    """
+    Make the response of an analysis in the encoding the client prefers,
+    see models.encoding, and gzip it if the client accepts gzip
+    param body: The response body dictionary
+    param mimetypes: The mimetypes to choose from, all of them by default
+    return A Flask response
+    """
+    if mimetypes is None:
+        mimetypes = get_mimetypes()
+    mimetype = request.accept_mimetypes.best_match(mimetypes,
+                                                   default=JSON_MIMETYPE)
+    with g.timer.stage('encode'):
+        if mimetype == JSON_MIMETYPE:
+            response = jsonify(**body)
+        else:
+            response = app.response_class(encode_body(body, mimetype),
+                                          mimetype=mimetype)
+        response.vary.add('Accept')
+        response.vary.add('Accept-Encoding')
+        if request.accept_encodings['gzip'] and response.content_length >= \
+                GZIP_MIN_SIZE:
+            response.set_data(compress(response.get_data()))
+            response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def get_direction(payload):
+    """
+    Get and validate the read order of a request
+    param payload: The request's JSON payload
+    return The read order
+    """
     direction = payload.get('direction', 'rtl')
     if direction not in ['rtl', 'vrtl', 'ltr', 'vrtl']:
         raise BadRequest("Invalid read order '{}'".format(direction))
+    return direction
+
+
+def get_threshold(payload):
+    """
+    Get the threshold of a request, which is the default threshold if it
+    isn't given or isn't a number
+    param payload: The request's JSON payload
+    return The threshold
+    """
+    threshold = default_dbscan_threshold
+    if 'threshold' in payload:
+        try:
+            threshold = int(payload.get('threshold'))
+        except ValueError:
+            pass
+    return threshold
+
+
+def get_error_record(code, message):
+    """
+    Get the body of an error response
+    param code: The HTTP status code
+    param message: The error message
+    return A dictionary like the body of an HTTPException
+    """
+    return {'success': False, 'message': message, 'code': code}
 
+
+def get_analysis_record(analyse):
+    """
+    Run an analysis and catch any error
+    param analyse: A function of a StageTimer that returns an analysis result
+    return A dictionary of the response body, with the timings of the
+    analysis under "timings" for observe_record()
+    """
+    timer = StageTimer()
     try:
-        if 'threshold' in payload:
-            threshold = payload.get('threshold')
-            try:
-                threshold = int(threshold)
-                result = do_cluster_analysis(image,
-                                                direction,
-                                                dbscan_threshold=threshold)
-            except ValueError:
-                result = do_cluster_analysis(image, direction)
+        record = {'code': 200, 'success': True, 'result': analyse(timer)}
+
+    except BadRequest as e:
+        record = get_error_record(400, e.description)
+
+    except QhullError as e:
+        record = get_error_record(400, QHULL_ERROR_MESSAGE)
+
+    except Exception as e:
+        logging.exception(e)
+        record = get_error_record(500, 'Something went wrong!')
+
+    record['timings'] = timer.to_dict()
+    return record
+
+
+def run_analysis(imagebytes, direction, threshold):
+    """
+    Analyse an image and catch any error, so it can be run in a worker
+    process
+    param imagebytes: The decoded bytes of a png image
+    param direction: The read order
+    param threshold: Grey scale threshold for the pixels to cluster
+    return A dictionary of the response body
+    """
+
+    def analyse(timer):
+        with timer.stage('decode'):
+            image = Image.open(BytesIO(imagebytes))
+            image.load()
+        return do_cluster_analysis(image,
+                                   direction,
+                                   dbscan_threshold=threshold,
+                                   timer=timer)
+
+    return get_analysis_record(analyse)
+
+
+def run_pixel_analysis(pixels, direction):
+    """
+    Analyse pixels and catch any error, so it can be run in a worker process
+    param pixels: An (N, 2) array of the [x, y] coordinates of the pixels
+    param direction: The read order
+    return A dictionary of the response body
+    """
+    return get_analysis_record(
+        lambda timer: analyse_pixels(pixels, direction, timer=timer))
+
+
+def get_record_result(record):
+    """
+    Get the result of a response body from run_analysis(), raising its error
+    if it has one
+    param record: A dictionary of the response body
+    return The result
+    """
+    if record['success']:
+        return record['result']
+    if record['code'] == 400:
+        raise BadRequest(record['message'])
+    raise InternalServerError(record['message'])
+
+
+def observe_timings(timings):
+    """
+    Add the timings of an analysis to the request's Server-Timing header and
+    the metrics
+    param timings: A dictionary from StageTimer.to_dict()
+    """
+    g.timer.update(timings)
+    metrics.observe(timings)
+
+
+def observe_record(record):
+    """
+    Observe and remove the timings of a record from run_analysis()
+    param record: A dictionary of the response body
+    return The record
+    """
+    observe_timings(record.pop('timings', {}))
+    return record
+
+
+def get_warmup_image():
+    """
+    Get a tiny image with everything the pipeline handles: a cartouche of
+    four glyphs, one of them with a dot inside to merge, and a one pixel high
+    stroke that has no convex hull
+    return A PIL image
+    """
+    pixels = numpy.full((30, 80), 255, dtype=numpy.uint8)
+    # The cartouche frame
+    pixels[1, 1:72] = pixels[24, 1:72] = 0
+    pixels[1:25, 1] = pixels[1:25, 71] = 0
+    for x in range(6, 70, 16):
+        pixels[6:19, x:x + 13] = 0
+    # A ring with a dot inside
+    pixels[8:17, 8:17] = 255
+    pixels[11:14, 11:14] = 0
+    # The stroke
+    pixels[28, 4:40] = 0
+    return Image.fromarray(pixels).convert('RGB')
+
+
+def get_region(payload, shape):
+    """
+    Get the region of a session's image to analyse
+    param payload: The request parameters, with an optional "region" of the
+    x, y, width and height of the region, either as a dictionary or as a
+    comma separated string
+    param shape: The (height, width) of the image
+    return The (x, y, width, height) of the region clipped to the image, or
+    None to analyse the whole image
+    """
+    region = payload.get('region')
+    if region is None or region == '':
+        return None
+    try:
+        if isinstance(region, dict):
+            values = [region[key] for key in ['x', 'y', 'width', 'height']]
+        else:
+            values = str(region).split(',')
+        x, y, width, height = [int(value) for value in values]
+    except (KeyError, TypeError, ValueError):
+        raise BadRequest('The region must have an x, y, width and height')
+    x0 = max(x, 0)
+    y0 = max(y, 0)
+    x1 = min(x + width, shape[1])
+    y1 = min(y + height, shape[0])
+    if x1 <= x0 or y1 <= y0:
+        raise BadRequest('The region is outside the image')
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def get_region_raster(grey, region=None):
+    """
+    Crop a grey scale raster to a region
+    param grey: The grey scale raster
+    param region: The (x, y, width, height) of the region, or None for all of
+    the raster
+    return The raster of the region
+    """
+    if region is None:
+        return grey
+    x, y, width, height = region
+    return grey[y:y + height, x:x + width]
+
+
+def get_session_size(session):
+    """
+    Get the memory a session takes
+    param session: A session dictionary
+    return The bytes of its grey raster and threshold index
+    """
+    size = session['grey'].nbytes
+    index = session['index']
+    if index is not None:
+        size += index.nbytes
+    return size
+
+
+def get_session_pixels(session, dbscan_threshold, timer, region=None):
+    """
+    Get the pixels of a session's image to cluster, with their clusters from
+    its threshold index so the image isn't clustered again
+    param session: A session dictionary with the image's grey raster
+    param dbscan_threshold: Grey scale threshold for the pixels to cluster
+    param timer: A StageTimer to time the stages with
+    param region: The (x, y, width, height) of a region of the image to
+    analyse, see get_region(). The clusters of the whole image that are
+    inside the region are reused and the pixel coordinates are relative to
+    the region, as they are in the cropped image.
+    return A tuple of the pixels and the attributes of their DBSCAN fit, or
+    None if they still need to be clustered
+    """
+    # Concurrent requests wait for the index rather than building it again
+    with session['lock']:
+        if session['index'] is None:
+            with timer.stage('index'):
+                # Thresholds with more pixels than can be clustered aren't
+                # indexed
+                session['index'] = ThresholdIndex(
+                    session['grey'],
+                    eps=dbscan_eps,
+                    min_samples=dbscan_min_samples,
+                    max_threshold=session_max_threshold,
+                    max_pixels=tiled_pixel_limit)
+    index = session['index']
+    if not index.covers(dbscan_threshold):
+        with timer.stage('threshold'):
+            return get_threshold_pixels(
+                get_region_raster(session['grey'], region),
+                dbscan_threshold), None
+    with timer.stage('dbscan'):
+        if region is None:
+            return index.fit(dbscan_threshold)
+        return index.fit_region(dbscan_threshold, region)
+
+
+def iter_analysis_records(job_dict, timer=None):
+    """
+    Group, sequence and assemble the response of an analysis group by group.
+    The hulls are buffered a group at a time rather than in a single pass,
+    which only costs noticeably more when there are many tiny groups.
+    param job_dict: The job dictionary from prepare_analysis()
+    param timer: An optional StageTimer to time the "sequence" and
+    "response" stages with
+    return A generator of the response records: a "group" record with the
+    clusters of each group as soon as it is sequenced, then a "cartouches"
+    record and a "summary" record with the groups
+    """
+    if timer is None:
+        timer = StageTimer()
+    groups = []
+    start = 0
+    group_iterator = iter_groups(job_dict,
+                                 labels_axis=0,
+                                 direction=job_dict['direction'])
+    while True:
+        with timer.stage('sequence'):
+            group = next(group_iterator, None)
+        if group is None:
+            break
+        with timer.stage('response'):
+            clusters = get_cluster_records(job_dict, group, start)
+        yield {'type': 'group', 'group': len(groups), 'clusters': clusters}
+        groups.append(group)
+        start += len(group)
+    yield {'type': 'cartouches', 'cartouches': job_dict['cartouches']}
+    yield {
+        'type': 'summary',
+        'direction': job_dict['direction'],
+        'groups': groups,
+        'cluster_count': start
+    }
+
+
+def iter_result_records(result):
+    """
+    Split the response of an analysis into the records of
+    iter_analysis_records()
+    param result: The response dictionary
+    return A generator of the response records
+    """
+    start = 0
+    for i, group in enumerate(result['groups']):
+        yield {
+            'type': 'group',
+            'group': i,
+            'clusters': result['clusters'][start:start + len(group)]
+        }
+        start += len(group)
+    yield {'type': 'cartouches', 'cartouches': result['cartouches']}
+    summary = {
+        'type': 'summary',
+        'direction': result['direction'],
+        'groups': result['groups'],
+        'cluster_count': start
+    }
+    if 'region' in result:
+        summary['region'] = result['region']
+    yield summary
+
+
+def get_region_record(region):
+    """
+    Get the response record of a region
+    param region: The (x, y, width, height) of the region
+    return A dictionary of the region
+    """
+    return dict(zip(['x', 'y', 'width', 'height'], region))
+
+
+app = Flask(__name__)
+CORS(app,
+     expose_headers=[
+         'X-Cache', 'X-Cache-Tier', 'X-Cache-Key', 'Server-Timing', 'Location'
+     ])
+
+result_cache = ResultCache(max_entries=cache_size,
+                           directory=cache_dir,
+                           max_disk_entries=cache_disk_size)
+sessions = SessionStore(max_sessions=session_count,
+                        ttl=session_ttl,
+                        max_bytes=session_memory_limit,
+                        get_size=get_session_size)
+pool = AnalysisPool(max_workers=pool_workers,
+                    max_queue=pool_queue_size)
+metrics = MetricsRegistry()
+jobs = JobStore(path=job_db, ttl=job_ttl)
+
+# Seconds it took to import the modules and set up the app, its caches, pool
+# and job store, which dominates a cold start once the interpreter is running
+import_seconds = time.perf_counter() - import_started
+
+
+@app.before_request
+def start_timer():
+    """Time the stages of every request"""
+    g.timer = StageTimer()
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def add_server_timing(response):
+    """Report the stages of a request in a Server-Timing header"""
+    timer = g.get('timer')
+    if timer is not None and timer.stages:
+        response.headers['Server-Timing'] = timer.get_server_timing(
+            total=time.perf_counter() - g.started)
+    return response
+
+@app.route('/_ah/warmup')
+def warmup():
+    """Warm up a new instance before it is sent requests, by running a tiny
+    analysis through every pipeline stage so the first request doesn't pay
+    for first-call initialisation, and starting the pool's workers. Reports
+    how long the imports, the first and a warm analysis and the pool took."""
+    image = get_warmup_image()
+    timer = StageTimer()
+    started = time.perf_counter()
+    do_cluster_analysis(image, 'rtl', timer=timer)
+    first_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    do_cluster_analysis(image, 'rtl')
+    warm_seconds = time.perf_counter() - started
+    # Workers are forked from this process so they start warm
+    started = time.perf_counter()
+    imagebytes = get_image_bytes(image)
+    try:
+        futures = [
+            pool.submit(run_analysis, imagebytes, 'rtl',
+                        default_dbscan_threshold)
+            for _ in range(pool.max_workers)
+        ]
+        for future in futures:
+            future.result()
+    except PoolFull:
+        # The instance is already serving requests
+        pass
+    pool_seconds = time.perf_counter() - started
+    result = {
+        'import_seconds': import_seconds,
+        'first_analysis_seconds': first_seconds,
+        'warm_analysis_seconds': warm_seconds,
+        'first_analysis_stages': timer.stages,
+        'pool_seconds': pool_seconds
+    }
+    logging.info('Warmed up: %s', result)
+    return jsonify(code=200, success=True, result=result)
+
+@app.route('/clusteranalysis', methods=['POST'])
+def cluster_analysis():
+    """Cluster analysis endpoint to perform cluster
+    analysis on the given image data, see get_analysis_request() for the
+    ways the image can be sent. A request with "session": true opens a
+    session for the image and later requests can give its session_id instead
+    of the image to analyse it again at another threshold or direction, or
+    a region of it, see get_region(). A request with "stream": true, or that
+    accepts application/x-ndjson, is answered with newline delimited JSON
+    records as each group of clusters is sequenced, see
+    iter_analysis_records()."""
+
+    payload, imagebytes, kind = get_analysis_request()
+    if kind is None:
+        imagebytes, kind = get_pixel_input(payload)
+    session_id = payload.get('session_id')
+    session = None
+    new_session = False
+    if session_id:
+        session = sessions.get(session_id)
+        if session is None:
+            raise NotFound(
+                "Unknown or expired session '{}'".format(session_id))
+    elif kind == 'image':
+        image = open_image(imagebytes)
+    elif kind is not None:
+        if payload.get('session') is True:
+            raise BadRequest('Sessions are only available for images')
+        pixels = get_input_pixels(imagebytes, kind, payload)
+    elif not payload.get('image'):
+        raise BadRequest('The request is missing the image parameter')
+    else:
+        image, imagebytes = decode_image(payload)
+        kind = 'image'
+
+    direction = get_direction(payload)
+
+    if kind in ['points', 'mask']:
+        return analyse_pixel_input(imagebytes, kind, pixels, payload,
+                                   direction)
+
+    try:
+        threshold = get_threshold(payload)
+        if session is not None:
+            digest = session['digest']
         else:
-            result = do_cluster_analysis(image, direction)
-        return jsonify(code=200, success=True, result=result)
+            digest = get_image_digest(imagebytes)
+            if payload.get('session') is True:
+                if image.width * image.height > session_area_limit:
+                    raise BadRequest(
+                        'Sessions are limited to images of up to {} pixels'.
+                        format(session_area_limit))
+                with g.timer.stage('decode'):
+                    grey = get_grey_raster(image)
+                session = {
+                    'digest': digest,
+                    'grey': grey,
+                    'index': None,
+                    'lock': threading.Lock()
+                }
+                session_id = sessions.create(session)
+                new_session = True
+            elif payload.get('region'):
+                raise BadRequest('A region can only be analysed in a session')
+        region = None
+        parameters = threshold
+        if session is not None:
+            region = get_region(payload, session['grey'].shape)
+            if region is not None:
+                parameters = '{}-{}_{}_{}_{}'.format(threshold, *region)
+        # Look for the result of the same analysis of the same image
+        cache_key = get_cache_key(digest, parameters, direction)
+        result, tier = result_cache.get(cache_key)
+
+        def get_pixels(timer):
+            if session is None:
+                with timer.stage('threshold'):
+                    return get_source_image_pixels(
+                        image, threshold=threshold)[0], None
+            if new_session:
+                # The threshold index is only worth building once the
+                # session is used again
+                with timer.stage('threshold'):
+                    return get_threshold_pixels(
+                        get_region_raster(session['grey'], region),
+                        threshold), None
+            return get_session_pixels(session,
+                                      threshold,
+                                      timer,
+                                      region=region)
+
+        if is_stream_request(payload):
+            if result is None:
+                records = iter_stream_records(get_pixels, direction,
+                                              cache_key, region)
+            else:
+                records = iter_result_records(result)
+            return make_stream_response(records, digest, tier, session_id)
+        if result is None:
+            if session is None:
+                result = get_record_result(
+                    observe_record(
+                        pool.run(run_analysis, imagebytes, direction,
+                                 threshold)))
+            else:
+                # Sessions only live in this process so they are analysed
+                # here, holding a place in the pool
+                timer = StageTimer()
+                with pool.slot():
+                    pixels, db_attributes = get_pixels(timer)
+                    result = analyse_pixels(pixels,
+                                            direction,
+                                            db_attributes=db_attributes,
+                                            timer=timer)
+                observe_timings(timer.to_dict())
+                if region is not None:
+                    result['region'] = get_region_record(region)
+            result_cache.set(cache_key, result)
+        body = {'code': 200, 'success': True, 'result': result}
+        if session_id:
+            body['session_id'] = session_id
+        return make_cached_response(body, digest, tier)
 
     except BadRequest as e:
         raise BadRequest(e.description)
@@ -772,11 +1982,414 @@ def cluster_analysis(payload):
     except QhullError as e:
         raise BadRequest(QHULL_ERROR_MESSAGE)
 
+    except PoolFull as e:
+        raise ServiceUnavailable(POOL_FULL_MESSAGE, retry_after=e.retry_after)
+
+    except InternalServerError as e:
+        raise InternalServerError(e.description)
+
+    except Exception as e:
+        logging.exception(e)
+        raise InternalServerError('Something went wrong!')
+
+
+def analyse_pixel_input(data, kind, pixels, payload, direction):
+    """
+    Analyse the pixels of a points or mask request
+    param data: The input bytes
+    param kind: 'points' or 'mask'
+    param pixels: The pixels of the input
+    param payload: The request parameters
+    param direction: The read order
+    return The response
+    """
+    try:
+        digest = get_image_digest(data)
+        # The same bytes are a different mask at another width
+        parameters = kind
+        if kind == 'mask':
+            parameters = 'mask{}x{}'.format(payload.get('width'),
+                                            payload.get('height'))
+        cache_key = get_cache_key(digest, parameters, direction)
+        result, tier = result_cache.get(cache_key)
+        if result is None:
+            result = get_record_result(
+                observe_record(pool.run(run_pixel_analysis, pixels,
+                                        direction)))
+            result_cache.set(cache_key, result)
+        return make_cached_response({
+            'code': 200,
+            'success': True,
+            'result': result
+        }, digest, tier)
+
+    except BadRequest as e:
+        raise BadRequest(e.description)
+
+    except PoolFull as e:
+        raise ServiceUnavailable(POOL_FULL_MESSAGE, retry_after=e.retry_after)
+
+    except InternalServerError as e:
+        raise InternalServerError(e.description)
+
     except Exception as e:
         logging.exception(e)
         raise InternalServerError('Something went wrong!')
 
 
+def make_cached_response(body, digest, tier):
+    """
+    Make the response of an analysis with its cache headers
+    param body: The response body dictionary
+    param digest: The digest of the analysis input
+    param tier: The cache tier the result was found in or None
+    return A Flask response
+    """
+    return set_cache_headers(make_analysis_response(body), digest, tier)
+
+
+def set_cache_headers(response, digest, tier):
+    """
+    Set the cache headers of an analysis response
+    param response: A Flask response
+    param digest: The digest of the analysis input
+    param tier: The cache tier the result was found in or None
+    return The response
+    """
+    response.headers['X-Cache'] = 'MISS' if tier is None else 'HIT'
+    if tier is not None:
+        response.headers['X-Cache-Tier'] = tier
+    response.headers['X-Cache-Key'] = digest
+    return response
+
+
+def is_stream_request(payload):
+    """
+    Check whether a request asks for a stream of newline delimited JSON
+    records, with "stream": true or by preferring them in its Accept header
+    param payload: The request parameters
+    return True to stream the response
+    """
+    return payload.get('stream') is True or \
+        request.accept_mimetypes.best_match(
+            [JSON_MIMETYPE, NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+def iter_stream_records(get_pixels, direction, cache_key, region=None):
+    """
+    Analyse pixels in this process, holding a place in the pool until the
+    stream is complete, and yield the records of iter_analysis_records() as
+    they are ready. The result is cached once all of it has been assembled.
+    param get_pixels: A function of a StageTimer that returns the pixels to
+    cluster and the attributes of their DBSCAN fit or None
+    param direction: The read order
+    param cache_key: The cache key of the result
+    param region: The (x, y, width, height) of the region analysed or None
+    return A generator of the response records
+    """
+    timer = StageTimer()
+    with pool.slot():
+        pixels, db_attributes = get_pixels(timer)
+        job_dict = prepare_analysis(pixels,
+                                    direction,
+                                    db_attributes=db_attributes,
+                                    timer=timer)
+        clusters = []
+        for record in iter_analysis_records(job_dict, timer):
+            if record['type'] == 'group':
+                clusters.extend(record['clusters'])
+            elif record['type'] == 'summary':
+                result = {
+                    'clusters': clusters,
+                    'direction': direction,
+                    'cartouches': job_dict['cartouches'],
+                    'groups': record['groups']
+                }
+                if region is not None:
+                    record['region'] = get_region_record(region)
+                    result['region'] = record['region']
+                result_cache.set(cache_key, result)
+                # The request has finished so its timer can't be updated
+                metrics.observe(timer.to_dict())
+            yield record
+
+
+def make_stream_response(records, digest, tier, session_id=None):
+    """
+    Make a streamed response of newline delimited JSON records. The first
+    record is got straight away so errors up to then are raised as usual,
+    later errors end the stream with an "error" record.
+    param records: A generator of response records
+    param digest: The digest of the analysis input
+    param tier: The cache tier the result was found in or None
+    param session_id: The session to add to the summary record or None
+    return A Flask response
+    """
+    first = next(records)
+
+    def generate():
+        try:
+            record = first
+            while record is not None:
+                if session_id and record['type'] == 'summary':
+                    record['session_id'] = session_id
+                yield encode_record(record)
+                record = next(records, None)
+        except QhullError:
+            yield encode_record(
+                dict(get_error_record(400, QHULL_ERROR_MESSAGE),
+                     type='error'))
+        except BadRequest as e:
+            yield encode_record(
+                dict(get_error_record(400, e.description), type='error'))
+        except Exception as e:
+            logging.exception(e)
+            yield encode_record(
+                dict(get_error_record(500, 'Something went wrong!'),
+                     type='error'))
+        finally:
+            records.close()
+
+    return set_cache_headers(
+        app.response_class(generate(), mimetype=NDJSON_MIMETYPE), digest,
+        tier)
+
+
+@app.route('/clusteranalysis/batch', methods=['POST'])
+@require_json(['images'])
+def cluster_analysis_batch(payload):
+    """Batch cluster analysis endpoint to analyse a list of images, each with
+    its own threshold and direction, in parallel. The results are returned in
+    the same order with an error instead of the result of any image that
+    couldn't be analysed. Images are submitted to the pool as the batch's
+    earlier analyses finish, so a batch is never refused because of its own
+    size."""
+    images = payload.get('images')
+    if not isinstance(images, list):
+        raise BadRequest('The images parameter must be a list')
+    if len(images) > batch_limit:
+        raise BadRequest('A batch may have up to {} images'.format(batch_limit))
+
+    records = [None] * len(images)
+    waiting = collections.deque()
+    retry_after = None
+    for i, item in enumerate(images):
+        try:
+            if not isinstance(item, dict) or not item.get('image'):
+                raise BadRequest('The request is missing the image parameter')
+            _, imagebytes = decode_image(item)
+            direction = get_direction(item)
+            threshold = get_threshold(item)
+        except BadRequest as e:
+            records[i] = get_error_record(400, e.description)
+            continue
+        except Exception as e:
+            logging.exception(e)
+            records[i] = get_error_record(500, 'Something went wrong!')
+            continue
+        cache_key = get_cache_key(get_image_digest(imagebytes), threshold,
+                                  direction)
+        result, _ = result_cache.get(cache_key)
+        if result is not None:
+            records[i] = {'code': 200, 'success': True, 'result': result}
+        else:
+            waiting.append((i, cache_key, (imagebytes, direction, threshold)))
+
+    futures = {}
+    analysed = 0
+    while waiting or futures:
+        while waiting:
+            i, cache_key, args = waiting[0]
+            try:
+                futures[pool.submit(run_analysis, *args)] = (i, cache_key)
+            except PoolFull as e:
+                if futures:
+                    # Wait for one of the batch's own analyses to finish
+                    break
+                # The pool is full of other requests' analyses
+                records[i] = get_error_record(503, POOL_FULL_MESSAGE)
+                retry_after = e.retry_after
+            waiting.popleft()
+        if not futures:
+            break
+        done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+        for future in done:
+            i, cache_key = futures.pop(future)
+            analysed += 1
+            try:
+                records[i] = observe_record(future.result())
+            except Exception as e:
+                logging.exception(e)
+                records[i] = get_error_record(500, 'Something went wrong!')
+            if records[i]['success']:
+                result_cache.set(cache_key, records[i]['result'])
+    if retry_after is not None and analysed == 0 and all(
+            not record['success'] for record in records):
+        # Nothing in the batch could be analysed
+        raise ServiceUnavailable(POOL_FULL_MESSAGE, retry_after=retry_after)
+    mimetypes = [
+        mimetype for mimetype in get_mimetypes()
+        if mimetype != BINARY_MIMETYPE
+    ]
+    return make_analysis_response(
+        {
+            'code': 200,
+            'success': True,
+            'results': records
+        }, mimetypes)
+
+
+def submit_job(imagebytes, direction, threshold, cache_key):
+    """
+    Start an analysis in the pool that finishes a job when it is done
+    param imagebytes: The decoded bytes of a png image
+    param direction: The read order
+    param threshold: Grey scale threshold for the pixels to cluster
+    param cache_key: The cache key of the result
+    return The job's handle, raises PoolFull if the pool is full
+    """
+    # The job has to exist before the analysis can finish it
+    job_id = jobs.create()
+    try:
+        future = pool.submit(run_analysis, imagebytes, direction, threshold)
+    except Exception:
+        jobs.delete(job_id)
+        raise
+
+    def done(future):
+        # This runs after the request has finished, so the timings only go
+        # to the metrics
+        try:
+            record = future.result()
+        except Exception as e:
+            logging.exception(e)
+            record = get_error_record(500, 'Something went wrong!')
+        metrics.observe(record.pop('timings', {}))
+        if record['success']:
+            result_cache.set(cache_key, record['result'])
+        jobs.finish(job_id, record)
+
+    future.add_done_callback(done)
+    return job_id
+
+
+def get_job_record(job):
+    """
+    Get the response record of a job
+    param job: A job from JobStore.get()
+    return A dictionary of the job's status and its result or error
+    """
+    record = {'job_id': job['job_id'], 'status': job['status']}
+    if job['record'] is not None:
+        if job['record']['success']:
+            record['result'] = job['record']['result']
+        else:
+            record['error'] = {
+                'code': job['record']['code'],
+                'message': job['record']['message']
+            }
+    return record
+
+
+@app.route('/clusteranalysis/jobs', methods=['POST'])
+@require_json(['image'])
+def cluster_analysis_job(payload):
+    """Asynchronous cluster analysis endpoint that takes the same parameters
+    as a batch image and answers straight away with a job_id. The analysis
+    runs in the pool and its result is collected from
+    /clusteranalysis/jobs/<job_id>, so analyses of large images don't have
+    to finish within a request."""
+    _, imagebytes = decode_image(payload)
+    direction = get_direction(payload)
+    threshold = get_threshold(payload)
+    cache_key = get_cache_key(get_image_digest(imagebytes), threshold,
+                              direction)
+    result, _ = result_cache.get(cache_key)
+    try:
+        if result is not None:
+            job_id = jobs.create({'code': 200, 'success': True,
+                                  'result': result})
+        else:
+            job_id = submit_job(imagebytes, direction, threshold, cache_key)
+    except PoolFull as e:
+        raise ServiceUnavailable(POOL_FULL_MESSAGE, retry_after=e.retry_after)
+    response = jsonify(code=202,
+                       success=True,
+                       result=get_job_record(jobs.get(job_id)))
+    response.status_code = 202
+    response.headers['Location'] = '/clusteranalysis/jobs/{}'.format(job_id)
+    return response
+
+
+@app.route('/clusteranalysis/jobs/<job_id>')
+def get_cluster_analysis_job(job_id):
+    """Report the status of a job from /clusteranalysis/jobs, with its
+    result once it is done or its error if it failed"""
+    job = jobs.get(job_id)
+    if job is None:
+        raise NotFound("Unknown or expired job '{}'".format(job_id))
+    mimetypes = [
+        mimetype for mimetype in get_mimetypes()
+        if mimetype != BINARY_MIMETYPE
+    ]
+    response = make_analysis_response(
+        {
+            'code': 200,
+            'success': True,
+            'result': get_job_record(job)
+        }, mimetypes)
+    if job['status'] == PENDING:
+        response.headers['Retry-After'] = 1
+    return response
+
+
+@app.route('/health')
+def health():
+    """Report the queue depth and worker utilisation of the analysis pool"""
+    return jsonify(code=200, success=True, result=pool.stats())
+
+
+@app.route('/metrics')
+def get_metrics():
+    """Report the stage timings, pixel and cluster counts of the analyses
+    and the state of the analysis pool in the Prometheus text format"""
+    stats = pool.stats()
+    gauges = collections.OrderedDict(
+        ('pool_{}'.format(name), stats[name])
+        for name in ['busy', 'queued', 'utilisation'])
+    counters = collections.OrderedDict(
+        ('pool_{}'.format(name), stats[name])
+        for name in ['completed', 'rejected'])
+    return app.response_class(
+        metrics.render(gauges, counters),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def require_admin():
+    """
+    Check that a request has the admin token in its Authorization header, as
+    "Bearer <token>", raising Forbidden if it hasn't or no token is set
+    """
+    authorization = request.headers.get('Authorization', '')
+    if not admin_token or not hmac.compare_digest(
+            authorization.encode('utf-8'),
+            'Bearer {}'.format(admin_token).encode('utf-8')):
+        raise Forbidden('This endpoint requires the admin token')
+
+
+@app.route('/clusteranalysis/cache', methods=['DELETE'])
+@app.route('/clusteranalysis/cache/<digest>', methods=['DELETE'])
+def invalidate_cache(digest=''):
+    """Remove cached results, either those of the image with the digest
+    given by a response's X-Cache-Key header or all of them. Only available
+    with the admin token, see require_admin()."""
+    require_admin()
+    if digest and not re.match('^[0-9a-f]{64}$', digest):
+        raise BadRequest("Invalid cache key '{}'".format(digest))
+    removed = result_cache.invalidate(prefix=digest)
+    return jsonify(code=200, success=True, result={'removed': removed})
+
+
 if __name__ == '__main__':
     # By default PORT is 8080, if you want to change it for local dev
     # set a CLUSTER_SERVICE_PORT environment variable.
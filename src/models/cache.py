@@ -0,0 +1,188 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Cache of cluster analysis results.
+
+Results are keyed by a digest of the decoded image bytes together with the
+analysis parameters. The cache has a size bounded in-memory LRU tier and an
+optional on-disk tier of JSON files, which survives restarts and is shared by
+every worker process pointed at the same directory. The disk tier is bounded
+too, dropping the results that were least recently written or read.
+
+'''
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+# Cache tiers reported by ResultCache.get()
+MEMORY = 'memory'
+DISK = 'disk'
+
+
+def get_image_digest(image_bytes):
+    '''Get the hex digest identifying an image's content.'''
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def get_cache_key(digest, threshold, direction):
+    '''Get the cache key of an analysis.
+
+    Input parameters:
+
+    digest -- The digest of the image from get_image_digest().
+    threshold -- The grey scale threshold.
+    direction -- The read order.
+
+    '''
+    return '{}-{}-{}'.format(digest, threshold, direction)
+
+
+class ResultCache:
+    '''Two tier cache of JSON serializable results.
+
+    Input parameters:
+
+    max_entries -- The number of results kept in memory, 0 disables the
+                   memory tier.
+    directory -- The directory of the disk tier, None disables it.
+    max_disk_entries -- The number of results kept on disk.
+
+    '''
+
+    def __init__(self, max_entries=128, directory=None, max_disk_entries=4096):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def _remember(self, key, result):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        '''Look up a result.
+
+        Output parameters:
+
+        A tuple of the result and the tier it was found in, MEMORY or DISK,
+        or (None, None) on a miss.
+
+        '''
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key], MEMORY
+        if self.directory is None:
+            return None, None
+        try:
+            with open(self._path(key)) as infile:
+                result = json.load(infile)
+            # Mark the result as recently used for _evict()
+            os.utime(self._path(key))
+        except (IOError, ValueError):
+            return None, None
+        self._remember(key, result)
+        return result, DISK
+
+    def set(self, key, result):
+        '''Store a result in both tiers.'''
+        self._remember(key, result)
+        if self.directory is None:
+            return
+        # Write to a temporary file first so other processes never read a
+        # partial result
+        try:
+            handle, temp_path = tempfile.mkstemp(dir=self.directory,
+                                                 suffix='.tmp')
+        except IOError as e:
+            logging.error('Unable to cache result %s: %s', key, e)
+            return
+        try:
+            with os.fdopen(handle, 'w') as outfile:
+                json.dump(result, outfile)
+            os.replace(temp_path, self._path(key))
+        except (IOError, TypeError, ValueError) as e:
+            logging.error('Unable to cache result %s: %s', key, e)
+            try:
+                os.remove(temp_path)
+            except IOError:
+                pass
+            return
+        self._evict()
+
+    def _evict(self):
+        '''Remove the least recently used results on disk beyond
+        max_disk_entries.'''
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                # Another process removed it first
+                continue
+        if len(entries) <= self.max_disk_entries:
+            return
+        entries.sort()
+        for _, path in entries[:len(entries) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+    def invalidate(self, prefix=''):
+        '''Remove the results whose keys start with prefix, all of them by
+        default.
+
+        Output parameters:
+
+        The number of results removed from either tier.
+
+        '''
+        removed = set()
+        with self._lock:
+            keys = [key for key in self._entries if key.startswith(prefix)]
+            for key in keys:
+                del self._entries[key]
+                removed.add(key)
+        if self.directory is not None:
+            for file_name in os.listdir(self.directory):
+                key, extension = os.path.splitext(file_name)
+                if extension == '.json' and key.startswith(prefix):
+                    try:
+                        os.remove(os.path.join(self.directory, file_name))
+                    except OSError:
+                        # Another process removed it first
+                        continue
+                    removed.add(key)
+        return len(removed)
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Compact storage of cluster pixel coordinates.
+
+ClusterStore keeps the coordinates of every cluster in one contiguous
+array, sorted by cluster, with an offsets index into it (as in a CSR
+sparse matrix). Each cluster is a read-only (N, 2) view of that array.
+
+ClusterLayer is a mutable, copy-on-write view of a store. Clusters that
+are replaced or removed are recorded in the layer while the store is left
+untouched, so the processed clusters of a job cost nothing until they are
+merged.
+
+Both are mappings from cluster labels to coordinate arrays and iterate in
+cluster order.
+
+'''
+
+from collections.abc import Mapping, MutableMapping
+
+import numpy as np
+
+
+def get_coordinate_dtype(coords):
+    '''Get the smallest integer dtype for an array of pixel coordinates that
+    leaves room for the exclusive upper bound of a bounding box.'''
+    if len(coords) == 0:
+        return np.int16
+    info = np.iinfo(np.int16)
+    if coords.min() >= info.min and coords.max() < info.max:
+        return np.int16
+    return np.int32
+
+
+class ClusterStore(Mapping):
+    '''Clusters of pixel coordinates in a contiguous, label sorted array.
+
+    Input parameters:
+
+    coords -- An (N, 2) array of [x, y] coordinates sorted by cluster. The
+              store makes the array read-only.
+    labels -- A sequence of cluster labels.
+    offsets -- An array of len(labels) + 1 offsets, where the coordinates of
+               cluster labels[i] are coords[offsets[i]:offsets[i + 1]].
+
+    '''
+
+    def __init__(self, coords, labels, offsets):
+        coords = np.asarray(coords).reshape(-1, 2)
+        self.coords = coords.astype(get_coordinate_dtype(coords), copy=False)
+        self.coords.flags.writeable = False
+        self.labels = list(labels)
+        self.offsets = np.asarray(offsets, dtype=np.intp)
+        if len(self.offsets) != len(self.labels) + 1:
+            raise IndexError('offsets must have one more item than labels.')
+        self._index = {label: i for i, label in enumerate(self.labels)}
+
+    @classmethod
+    def from_labels(cls, pixels, labels):
+        '''Group pixels by their DBSCAN labels.
+
+        Input parameters:
+
+        pixels -- An (N, 2) array-like of [x, y] coordinates.
+        labels -- An array of N cluster labels, where -1 marks noise.
+
+        Output parameters:
+
+        A ClusterStore keyed by the string of each label, in label order.
+        Each cluster keeps the order of its pixels.
+
+        '''
+        pixels = np.asarray(pixels).reshape(-1, 2)
+        labels = np.asarray(labels)
+        clustered = np.nonzero(labels != -1)[0]
+        order = clustered[np.argsort(labels[clustered], kind='mergesort')]
+        cluster_labels, counts = np.unique(labels[order], return_counts=True)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        return cls(pixels[order], [str(label) for label in cluster_labels],
+                   offsets)
+
+    def __getitem__(self, label):
+        i = self._index[label]
+        return self.coords[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, label):
+        return label in self._index
+
+    def copy(self):
+        '''Get a copy-on-write ClusterLayer over the store.'''
+        return ClusterLayer(self)
+
+    def to_dict(self):
+        '''Get the clusters as a dictionary of [x, y] lists.'''
+        return {label: self[label].tolist() for label in self}
+
+
+class ClusterLayer(MutableMapping):
+    '''A copy-on-write view of a ClusterStore.
+
+    Input parameters:
+
+    base -- The ClusterStore to view.
+
+    '''
+
+    def __init__(self, base):
+        self.base = base
+        self._changed = {}
+        # Labels of the base store that have been deleted
+        self._removed = set()
+        # Labels inserted since, in insertion order. A deleted label of the
+        # base store that is set again is added like a new one.
+        self._added = []
+
+    def __getitem__(self, label):
+        if label in self._changed:
+            return self._changed[label]
+        if label in self._removed or label not in self.base:
+            raise KeyError(label)
+        return self.base[label]
+
+    def __setitem__(self, label, cluster):
+        cluster = np.asarray(cluster).reshape(-1, 2)
+        if label not in self:
+            # A new key goes to the end as it would in a dictionary
+            self._added.append(label)
+        self._changed[label] = cluster
+
+    def __delitem__(self, label):
+        if label not in self:
+            raise KeyError(label)
+        self._changed.pop(label, None)
+        if label in self._added:
+            self._added.remove(label)
+        if label in self.base:
+            self._removed.add(label)
+
+    def __iter__(self):
+        for label in self.base:
+            if label not in self._removed:
+                yield label
+        for label in self._added:
+            yield label
+
+    def __len__(self):
+        return len(self.base) - len(self._removed) + len(self._added)
+
+    def __contains__(self, label):
+        if label in self._changed:
+            return True
+        return label in self.base and label not in self._removed
+
+    def copy(self):
+        '''Get a copy-on-write ClusterLayer over the same base store with the
+        same changes.'''
+        layer = ClusterLayer(self.base)
+        layer._changed = dict(self._changed)
+        layer._removed = set(self._removed)
+        layer._added = list(self._added)
+        return layer
+
+    def to_dict(self):
+        '''Get the clusters as a dictionary of [x, y] lists.'''
+        return {label: self[label].tolist() for label in self}
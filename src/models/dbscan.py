@@ -0,0 +1,449 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''DBSCAN for points on the integer lattice.
+
+Thresholded pixel coordinates are distinct integer points, so the
+eps-neighbourhood of every point is the same fixed disk of lattice offsets.
+Rather than building a general purpose neighbour index, the points are
+rasterised and:
+
+1. Neighbours are counted by correlating the raster with the disk.
+2. Core points are labelled as the connected components of the graph
+   joining core points that lie within eps of each other.
+3. Border points are attached to the neighbouring cluster with the lowest
+   label.
+
+Clusters are numbered in order of their first core point, which reproduces
+the labels of sklearn.cluster.DBSCAN exactly.
+
+TiledDBSCAN applies the same steps to square tiles of a large raster in
+parallel. Each tile is processed with a halo of neighbouring pixels and the
+core components of neighbouring tiles are stitched together across the tile
+seams with a union-find.
+
+'''
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from models.unionfind import UnionFind
+
+
+def get_disk_offsets(eps):
+    '''Get the lattice offsets within distance eps of the origin.
+
+    Input parameters:
+
+    eps -- The neighbourhood radius.
+
+    Output parameters:
+
+    A list of (dx, dy) tuples, including (0, 0).
+
+    '''
+    radius = int(np.floor(eps))
+    return [(dx, dy)
+            for dx in range(-radius, radius + 1)
+            for dy in range(-radius, radius + 1)
+            if dx * dx + dy * dy <= eps * eps]
+
+
+def _check_points(X):
+    '''Validate an array-like of lattice points and return it as an array.'''
+    X = np.asarray(X)
+    if X.size == 0:
+        X = X.reshape(0, 2)
+    if X.ndim != 2 or X.shape[1] != 2:
+        raise ValueError('Expected an (N, 2) array of points.')
+    if len(X) and not np.issubdtype(X.dtype, np.integer):
+        raise ValueError('Lattice DBSCAN requires integer coordinates.')
+    return X
+
+
+def _count_neighbours(xs, ys, shape, offsets, pad):
+    '''Count the points in the neighbourhood of every point.
+
+    Input parameters:
+
+    xs, ys -- Raster coordinates of distinct points, at least pad from the
+              raster edge.
+    shape -- The raster shape.
+    offsets -- The neighbourhood offsets, see get_disk_offsets().
+    pad -- The neighbourhood radius in whole pixels.
+
+    Output parameters:
+
+    An array with the neighbour count of every point.
+
+    '''
+    occupied = np.zeros(shape, dtype=np.int32)
+    occupied[xs, ys] = 1
+    if occupied.sum() != len(xs):
+        raise ValueError('Lattice DBSCAN requires distinct points.')
+    kernel = np.zeros((2 * pad + 1, 2 * pad + 1), dtype=np.int32)
+    for dx, dy in offsets:
+        kernel[dx + pad, dy + pad] = 1
+    counts = ndimage.correlate(occupied, kernel, mode='constant')
+    return counts[xs, ys]
+
+
+def _label_core_components(xs, ys, shape, offsets, pad):
+    '''Label the connected components of core points, where two core points
+    are connected if one is in the neighbourhood of the other.
+
+    Input parameters:
+
+    xs, ys -- Raster coordinates of the core points, at least pad from the
+              raster edge.
+    shape -- The raster shape.
+    offsets -- The neighbourhood offsets, see get_disk_offsets().
+    pad -- The neighbourhood radius in whole pixels.
+
+    Output parameters:
+
+    An array with the component of every core point.
+
+    '''
+    core_ids = np.full(shape, -1, dtype=np.intp)
+    core_ids[xs, ys] = np.arange(len(xs))
+    width, height = shape[0] - 2 * pad, shape[1] - 2 * pad
+    window = core_ids[pad:pad + width, pad:pad + height]
+    rows, cols = [np.empty(0, dtype=np.intp)], [np.empty(0, dtype=np.intp)]
+    # Only half of the offsets are needed as the graph is undirected
+    for dx, dy in offsets:
+        if (dx, dy) <= (0, 0):
+            continue
+        shifted = core_ids[pad + dx:pad + dx + width,
+                           pad + dy:pad + dy + height]
+        joined = (window >= 0) & (shifted >= 0)
+        rows.append(window[joined])
+        cols.append(shifted[joined])
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)),
+                       shape=(len(xs), len(xs)))
+    _, components = connected_components(graph, directed=False)
+    return components
+
+
+def _rank_components(components):
+    '''Renumber components in order of their first member.'''
+    _, first, inverse = np.unique(components, return_index=True,
+                                  return_inverse=True)
+    rank = np.empty(len(first), dtype=np.intp)
+    rank[np.argsort(first)] = np.arange(len(first))
+    return rank[inverse], len(first)
+
+
+def _attach_border_points(labels, xs, ys, shape, offsets, core_indices,
+                          core_labels, n_clusters):
+    '''Label the points that aren't core points with the lowest label of
+    the core points in their neighbourhood.
+
+    Input parameters:
+
+    labels -- The array of point labels to update.
+    xs, ys -- Raster coordinates of the points, at least the neighbourhood
+              radius from the raster edge.
+    shape -- The raster shape.
+    offsets -- The neighbourhood offsets, see get_disk_offsets().
+    core_indices -- The indices of the core points.
+    core_labels -- The labels of the core points.
+    n_clusters -- The number of clusters.
+
+    '''
+    is_border = np.ones(len(xs), dtype=bool)
+    is_border[core_indices] = False
+    border_indices = np.nonzero(is_border)[0]
+    if len(border_indices) == 0:
+        return
+    label_raster = np.full(shape, n_clusters, dtype=np.intp)
+    label_raster[xs[core_indices], ys[core_indices]] = core_labels
+    border_labels = np.full(len(border_indices), n_clusters, dtype=np.intp)
+    bxs = xs[border_indices]
+    bys = ys[border_indices]
+    for dx, dy in offsets:
+        np.minimum(border_labels, label_raster[bxs + dx, bys + dy],
+                   out=border_labels)
+    attached = border_labels < n_clusters
+    labels[border_indices[attached]] = border_labels[attached]
+
+
+class LatticeDBSCAN:
+    '''DBSCAN clustering of distinct integer points.
+
+    Follows the sklearn.cluster.DBSCAN estimator interface so it can be used
+    in its place.
+
+    Input parameters:
+
+    eps -- The maximum distance between two neighbouring points.
+    min_samples -- The number of points in a neighbourhood, including the
+                   point itself, for a point to be a core point.
+
+    '''
+
+    def __init__(self, eps=0.5, min_samples=5):
+        self.eps = eps
+        self.min_samples = min_samples
+
+    def fit(self, X, y=None):
+        '''Perform DBSCAN clustering on an array of points.
+
+        Input parameters:
+
+        X -- An (N, 2) array-like of distinct integer [x, y] coordinates.
+
+        Output parameters:
+
+        self, with the labels_, core_sample_indices_ and components_
+        attributes set as they are by sklearn.
+
+        '''
+        X = _check_points(X)
+        self.labels_ = np.full(len(X), -1, dtype=np.intp)
+        self.core_sample_indices_ = np.empty(0, dtype=np.intp)
+        self.components_ = X[:0]
+        if len(X) == 0:
+            return self
+
+        offsets = get_disk_offsets(self.eps)
+        pad = int(np.floor(self.eps))
+        # Rasterise the points with a margin so every neighbourhood offset
+        # stays inside the raster
+        coords = X.astype(np.intp) - X.min(axis=0)
+        shape = tuple(coords.max(axis=0) + 1 + 2 * pad)
+        xs = coords[:, 0] + pad
+        ys = coords[:, 1] + pad
+
+        # 1. Count the neighbours of every point
+        counts = _count_neighbours(xs, ys, shape, offsets, pad)
+        is_core = counts >= self.min_samples
+        core_indices = np.nonzero(is_core)[0]
+        if len(core_indices) == 0:
+            return self
+
+        # 2. Connected components of the core points, numbered in order of
+        # their first core point
+        components = _label_core_components(xs[core_indices],
+                                            ys[core_indices], shape, offsets,
+                                            pad)
+        core_labels, n_clusters = _rank_components(components)
+        self.labels_[core_indices] = core_labels
+
+        # 3. Attach border points to the lowest labelled neighbouring cluster
+        _attach_border_points(self.labels_, xs, ys, shape, offsets,
+                              core_indices, core_labels, n_clusters)
+
+        self.core_sample_indices_ = core_indices
+        self.components_ = X[core_indices]
+        return self
+
+    def fit_predict(self, X, y=None):
+        '''Perform DBSCAN clustering and return the cluster labels.'''
+        return self.fit(X).labels_
+
+
+def _fit_tile(points, region, eps, min_samples):
+    '''Find the core points and local core components of a tile.
+
+    Input parameters:
+
+    points -- An (M, 2) array of the points within two neighbourhood radii of
+              the region.
+    region -- (x0, y0, x1, y1) half-open bounds of the tile grown by one
+              neighbourhood radius. Core status is exact inside the region.
+    eps -- The maximum distance between two neighbouring points.
+    min_samples -- The minimum neighbourhood size of a core point.
+
+    Output parameters:
+
+    A tuple of the indices of the points in the region, which of them are
+    core points and the local component of every core point.
+
+    '''
+    offsets = get_disk_offsets(eps)
+    pad = int(np.floor(eps))
+    x0, y0, x1, y1 = region
+    # The raster covers the region plus a margin of one radius
+    xs = points[:, 0].astype(np.intp) - (x0 - pad)
+    ys = points[:, 1].astype(np.intp) - (y0 - pad)
+    shape = (x1 - x0 + 2 * pad, y1 - y0 + 2 * pad)
+    counts = _count_neighbours(xs, ys, shape, offsets, pad)
+    in_region = np.nonzero((xs >= pad) & (xs < shape[0] - pad) &
+                           (ys >= pad) & (ys < shape[1] - pad))[0]
+    is_core = counts[in_region] >= min_samples
+    core_indices = in_region[is_core]
+    components = _label_core_components(xs[core_indices], ys[core_indices],
+                                        shape, offsets, pad)
+    return in_region, is_core, components
+
+
+class TiledDBSCAN(LatticeDBSCAN):
+    '''DBSCAN clustering of distinct integer points in tiles.
+
+    Produces the same labels as LatticeDBSCAN without rasterising all of
+    the points at once. Tiles can be clustered in parallel processes.
+
+    Input parameters:
+
+    eps -- The maximum distance between two neighbouring points.
+    min_samples -- The number of points in a neighbourhood, including the
+                   point itself, for a point to be a core point.
+    tile_size -- The width and height of a tile in pixels.
+    n_jobs -- The number of worker processes, or None for the CPU count.
+              Tiles are clustered in the calling process by default.
+
+    '''
+
+    def __init__(self, eps=0.5, min_samples=5, tile_size=512, n_jobs=1):
+        super().__init__(eps=eps, min_samples=min_samples)
+        self.tile_size = tile_size
+        self.n_jobs = n_jobs
+
+    def get_tiles(self, X):
+        '''Split points into tiles.
+
+        Input parameters:
+
+        X -- An (N, 2) array of points.
+
+        Output parameters:
+
+        A list of (region, indices, owned) tuples, one for each non-empty
+        tile, where region is the tile grown by one neighbourhood radius,
+        indices are the indices of the points within two radii of the tile
+        and owned marks which of those points lie in the tile itself.
+
+        '''
+        pad = int(np.floor(self.eps))
+        size = self.tile_size
+        tile_x = X[:, 0] // size
+        tile_y = X[:, 1] // size
+        by_x = np.argsort(X[:, 0], kind='mergesort')
+        sorted_x = X[by_x, 0]
+        tiles = []
+        for tx in np.unique(tile_x).tolist():
+            x0, x1 = tx * size, (tx + 1) * size
+            # Points in the column of tiles, with a halo of two radii
+            column = by_x[np.searchsorted(sorted_x, x0 - 2 * pad):
+                          np.searchsorted(sorted_x, x1 + 2 * pad)]
+            column = np.sort(column)
+            for ty in np.unique(tile_y[column[tile_x[column] == tx]]).tolist():
+                y0, y1 = ty * size, (ty + 1) * size
+                ys = X[column, 1]
+                indices = column[(ys >= y0 - 2 * pad) & (ys < y1 + 2 * pad)]
+                owned = (tile_x[indices] == tx) & (tile_y[indices] == ty)
+                region = (x0 - pad, y0 - pad, x1 + pad, y1 + pad)
+                tiles.append((region, indices, owned))
+        return tiles
+
+    def fit(self, X, y=None):
+        '''Perform DBSCAN clustering on an array of points, see
+        LatticeDBSCAN.fit().'''
+        X = _check_points(X)
+        self.labels_ = np.full(len(X), -1, dtype=np.intp)
+        self.core_sample_indices_ = np.empty(0, dtype=np.intp)
+        self.components_ = X[:0]
+        if len(X) == 0:
+            return self
+        X = X.astype(np.int64)
+        tiles = self.get_tiles(X)
+
+        # Find core points and core components tile by tile
+        jobs = [(X[indices], region, self.eps, self.min_samples)
+                for region, indices, _ in tiles]
+        n_jobs = self.n_jobs or os.cpu_count() or 1
+        if n_jobs > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=min(n_jobs,
+                                                     len(jobs))) as executor:
+                results = list(executor.map(_fit_tile, *zip(*jobs)))
+        else:
+            results = [_fit_tile(*job) for job in jobs]
+
+        # Every point takes its core status and component from the tile that
+        # owns it. Components are numbered globally by offsetting each tile's
+        # local components.
+        is_core = np.zeros(len(X), dtype=bool)
+        owner_component = np.full(len(X), -1, dtype=np.intp)
+        halo = []
+        n_components = 0
+        for (_, indices, owned), (in_region, core, components) in zip(
+                tiles, results):
+            core_indices = indices[in_region[core]]
+            core_owned = owned[in_region[core]]
+            components = components + n_components
+            is_core[core_indices[core_owned]] = True
+            owner_component[core_indices[core_owned]] = components[core_owned]
+            halo.append((core_indices[~core_owned], components[~core_owned]))
+            if len(components):
+                n_components = components.max() + 1
+
+        # Stitch components across tile seams. A core point in the halo of a
+        # tile is owned by a neighbouring tile, so the components containing
+        # it in both tiles are the same global component.
+        union_find = UnionFind(n_components)
+        seams = [np.stack([components, owner_component[indices]], axis=1)
+                 for indices, components in halo if len(indices)]
+        if seams:
+            union_find.union_pairs(np.concatenate(seams))
+        roots = union_find.roots()
+
+        core_indices = np.nonzero(is_core)[0]
+        if len(core_indices) == 0:
+            return self
+        core_labels, n_clusters = _rank_components(
+            roots[owner_component[core_indices]])
+        self.labels_[core_indices] = core_labels
+
+        # Attach border points to the lowest labelled neighbouring cluster,
+        # looking neighbours up by their sorted raster keys
+        border_indices = np.nonzero(~is_core)[0]
+        if len(border_indices):
+            pad = int(np.floor(self.eps))
+            origin = X.min(axis=0) - pad
+            stride = X[:, 1].max() - origin[1] + pad + 1
+
+            def get_keys(points):
+                return (points[:, 0] - origin[0]) * stride + (points[:, 1] -
+                                                              origin[1])
+
+            core_keys = get_keys(X[core_indices])
+            key_order = np.argsort(core_keys)
+            core_keys = core_keys[key_order]
+            sorted_labels = core_labels[key_order]
+            border_keys = get_keys(X[border_indices])
+            border_labels = np.full(len(border_indices), n_clusters,
+                                    dtype=np.intp)
+            for dx, dy in get_disk_offsets(self.eps):
+                keys = border_keys + dx * stride + dy
+                found = np.minimum(np.searchsorted(core_keys, keys),
+                                   len(core_keys) - 1)
+                labels = np.where(core_keys[found] == keys,
+                                  sorted_labels[found], n_clusters)
+                np.minimum(border_labels, labels, out=border_labels)
+            attached = border_labels < n_clusters
+            self.labels_[border_indices[attached]] = border_labels[attached]
+
+        self.core_sample_indices_ = core_indices
+        self.components_ = X[core_indices]
+        return self
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Compact encodings of cluster analysis responses.
+
+Besides JSON a response body can be encoded as:
+
+MessagePack (application/x-msgpack) -- The same structure as the JSON body.
+Only offered when the msgpack package is installed.
+
+Typed arrays (application/x-cluster-analysis) -- The clusters are packed
+into little endian int32 buffers that can be viewed directly as JavaScript
+typed arrays:
+
+    4 bytes     b'CLA1'
+    4 bytes     uint32 length of the header
+    header      UTF-8 JSON of the body with the clusters replaced by their
+                cluster_ids and a "buffers" dictionary of
+                name -> [byte offset, item count] into the data that follows
+    padding     to a multiple of 4 bytes
+    data        the buffers:
+                bounds -- [x, y, width, height, order] of every cluster
+                hull_offsets -- the start of every cluster's hull in hull
+                                and the total hull length, counted in points
+                hull -- [x, y] hull vertices of all the clusters
+
+Byte offsets are relative to the start of the data.
+
+Streamed responses are newline delimited JSON (application/x-ndjson), one
+record to a line.
+
+'''
+
+import gzip
+import json
+import struct
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/x-msgpack'
+BINARY_MIMETYPE = 'application/x-cluster-analysis'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+BINARY_MAGIC = b'CLA1'
+
+# Smallest body worth compressing
+GZIP_MIN_SIZE = 1024
+
+
+def get_mimetypes():
+    '''Get the response mimetypes that can be encoded, in order of
+    preference.'''
+    mimetypes = [JSON_MIMETYPE, BINARY_MIMETYPE]
+    if msgpack is not None:
+        mimetypes.append(MSGPACK_MIMETYPE)
+    return mimetypes
+
+
+def pack_clusters(clusters):
+    '''Pack the clusters of a result into int32 arrays.
+
+    Input parameters:
+
+    clusters -- A list of cluster dictionaries of a response result.
+
+    Output parameters:
+
+    A tuple of the list of cluster ids and a dictionary of the bounds,
+    hull_offsets and hull arrays.
+
+    '''
+    cluster_ids = [cluster['cluster_id'] for cluster in clusters]
+    bounds = np.array([[
+        cluster['bounds']['x'], cluster['bounds']['y'],
+        cluster['bounds']['width'], cluster['bounds']['height'],
+        cluster['bounds']['order']
+    ] for cluster in clusters],
+                      dtype=np.int32).reshape(-1, 5)
+    counts = [len(cluster['hull']) for cluster in clusters]
+    hull_offsets = np.zeros(len(clusters) + 1, dtype=np.int32)
+    np.cumsum(counts, out=hull_offsets[1:])
+    # Hull vertices are whole numbers of pixels
+    hull = np.array([[vertex['x'], vertex['y']]
+                     for cluster in clusters
+                     for vertex in cluster['hull']],
+                    dtype=np.float64).reshape(-1, 2)
+    return cluster_ids, {
+        'bounds': bounds,
+        'hull_offsets': hull_offsets,
+        'hull': np.rint(hull).astype(np.int32)
+    }
+
+
+def encode_binary(body):
+    '''Encode a response body in the typed array layout.'''
+    header = dict(body)
+    buffers = {}
+    if 'result' in body:
+        result = dict(body['result'])
+        result['cluster_ids'], buffers = pack_clusters(result.pop('clusters'))
+        header['result'] = result
+    data = []
+    offset = 0
+    header['buffers'] = {}
+    for name, array in buffers.items():
+        array = array.astype('<i4')
+        header['buffers'][name] = [offset, int(array.size)]
+        data.append(array.tobytes())
+        offset += array.nbytes
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    padding = -(len(BINARY_MAGIC) + 4 + len(header)) % 4
+    return b''.join([
+        BINARY_MAGIC,
+        struct.pack('<I', len(header)), header, b' ' * padding
+    ] + data)
+
+
+def decode_binary(data):
+    '''Decode a body in the typed array layout.
+
+    Output parameters:
+
+    A tuple of the header dictionary and a dictionary of the buffers as
+    numpy arrays.
+
+    '''
+    if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError('Not a cluster analysis binary body.')
+    start = len(BINARY_MAGIC) + 4
+    (length,) = struct.unpack('<I', data[len(BINARY_MAGIC):start])
+    header = json.loads(data[start:start + length].decode('utf-8'))
+    start += length
+    start += -start % 4
+    buffers = {
+        name: np.frombuffer(data, dtype='<i4', count=count,
+                            offset=start + offset)
+        for name, (offset, count) in header['buffers'].items()
+    }
+    if 'bounds' in buffers:
+        buffers['bounds'] = buffers['bounds'].reshape(-1, 5)
+    if 'hull' in buffers:
+        buffers['hull'] = buffers['hull'].reshape(-1, 2)
+    return header, buffers
+
+
+def encode_body(body, mimetype):
+    '''Encode a response body as one of get_mimetypes().'''
+    if mimetype == BINARY_MIMETYPE:
+        return encode_binary(body)
+    if mimetype == MSGPACK_MIMETYPE:
+        return msgpack.packb(body, use_bin_type=True)
+    return json.dumps(body, separators=(',', ':')).encode('utf-8')
+
+
+def encode_record(record):
+    '''Encode a record as a line of newline delimited JSON.'''
+    return json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+def compress(data):
+    '''Gzip compress a response body, favouring speed over size.'''
+    return gzip.compress(data, compresslevel=5)
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Per-job cache of cluster geometry.
+
+Containment tests and the response both need the convex hull of the same
+clusters, so the geometry of each cluster is computed on first use and kept
+until the cluster changes.
+
+'''
+
+import numpy as np
+from scipy.spatial import ConvexHull
+
+from models.polygon import Polygon
+
+
+class ClusterGeometry:
+    '''Lazily computed geometry of a job's clusters.
+
+    Input parameters:
+
+    clusters -- A mapping of cluster labels to [x, y] coordinates. The
+                mapping is read when geometry is first requested, so
+                invalidate() must be called when a cluster changes.
+
+    '''
+
+    def __init__(self, clusters):
+        self.clusters = clusters
+        self._cache = {}
+
+    def _get(self, label, key, compute):
+        entry = self._cache.setdefault(label, {})
+        if key not in entry:
+            entry[key] = compute(label)
+        return entry[key]
+
+    def invalidate(self, label):
+        '''Forget the geometry of a cluster that has changed or been
+        removed.'''
+        self._cache.pop(label, None)
+
+    def array(self, label):
+        '''Get the cluster's coordinates as an (N, 2) numpy array.'''
+        return self._get(label, 'array',
+                         lambda label: np.asarray(self.clusters[label]))
+
+    def hull(self, label):
+        '''Get the cluster's scipy.spatial.ConvexHull. Raises QhullError for
+        degenerate clusters.'''
+        return self._get(label, 'hull',
+                         lambda label: ConvexHull(self.array(label)))
+
+    def hull_points(self, label):
+        '''Get the coordinates of the cluster's convex hull vertices in
+        anticlockwise order.'''
+
+        def compute(label):
+            hull = self.hull(label)
+            return hull.points[hull.vertices]
+
+        return self._get(label, 'hull_points', compute)
+
+    def centroid(self, label):
+        '''Get the centroid of the cluster's convex hull vertices.'''
+
+        def compute(label):
+            points = self.hull_points(label)
+            return [np.mean(points[:, 0]), np.mean(points[:, 1])]
+
+        return self._get(label, 'centroid', compute)
+
+    def polygon(self, label):
+        '''Get the cluster's convex hull as a Polygon.'''
+
+        def compute(label):
+            points = self.hull_points(label)
+            return Polygon(points[:, 0], points[:, 1])
+
+        return self._get(label, 'polygon', compute)
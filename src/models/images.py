@@ -0,0 +1,26 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Helpers for PIL images.'''
+
+from io import BytesIO
+
+
+def get_image_bytes(image):
+    '''Encode an image as png bytes.'''
+    output = BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
@@ -0,0 +1,230 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Persistent store of asynchronous analysis jobs.
+
+A job is submitted by one request and its result collected by later ones, so
+analyses that take longer than a request may are still answered. Jobs and
+their results are kept in an SQLite database, which is shared by every
+process on the instance pointed at the same file. Finished jobs survive
+restarts. Jobs are evicted once they haven't been updated for a while.
+
+A pending job can only be finished by the process that submitted it, its
+owner. A pending job whose owner is no longer running is failed when a store
+is opened or the job is looked up, rather than staying pending until it
+expires.
+
+'''
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# Job statuses
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+INTERRUPTED_MESSAGE = ('The analysis was interrupted, please submit the job '
+                       'again.')
+
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+
+
+class JobStore:
+    '''SQLite store of jobs that expire.
+
+    Input parameters:
+
+    path -- The database file, or ':memory:' to keep jobs in this process.
+    ttl -- The number of seconds a job is kept after it was last updated.
+    owner -- The owner of the jobs created with the store, see
+             get_process_owner(), this process by default.
+
+    '''
+
+    def __init__(self, path=':memory:', ttl=3600, owner=None):
+        self.path = path
+        self.ttl = ttl
+        self.owner = owner or get_process_owner()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path,
+                                           timeout=10,
+                                           check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, '
+                'status TEXT NOT NULL, created REAL NOT NULL, '
+                'updated REAL NOT NULL, record TEXT, owner TEXT)')
+            columns = [
+                row[1] for row in self._connection.execute(
+                    'PRAGMA table_info(jobs)')
+            ]
+            if 'owner' not in columns:
+                self._connection.execute(
+                    'ALTER TABLE jobs ADD COLUMN owner TEXT')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated)')
+            owners = self._connection.execute(
+                'SELECT DISTINCT owner FROM jobs WHERE status = ?',
+                (PENDING, )).fetchall()
+            for owner, in owners:
+                self._fail_orphans(owner)
+
+    def _expire(self, now):
+        return self._connection.execute('DELETE FROM jobs WHERE updated < ?',
+                                        (now - self.ttl, )).rowcount
+
+    def _fail_orphans(self, owner):
+        '''Fail the pending jobs of an owner that is no longer running.'''
+        if owner == self.owner or is_running(owner):
+            return
+        record = {'code': 500, 'success': False, 'message': INTERRUPTED_MESSAGE}
+        self._connection.execute(
+            'UPDATE jobs SET status = ?, updated = ?, record = ? '
+            'WHERE status = ? AND owner IS ?',
+            (FAILED, time.time(), _dumps(record), PENDING, owner))
+
+    def create(self, record=None):
+        '''Store a new job.
+
+        Input parameters:
+
+        record -- The job's response body if it is already finished, such as
+                  a cached result.
+
+        Output parameters:
+
+        The job's handle.
+
+        '''
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        status = PENDING if record is None else _get_status(record)
+        with self._lock, self._connection:
+            self._expire(now)
+            self._connection.execute(
+                'INSERT INTO jobs (job_id, status, created, updated, record, '
+                'owner) VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, status, now, now, _dumps(record), self.owner))
+        return job_id
+
+    def finish(self, job_id, record):
+        '''Store the response body of a job, returning whether the job
+        exists.'''
+        with self._lock, self._connection:
+            return self._connection.execute(
+                'UPDATE jobs SET status = ?, updated = ?, record = ? '
+                'WHERE job_id = ?', (_get_status(record), time.time(),
+                                     _dumps(record), job_id)).rowcount > 0
+
+    def get(self, job_id):
+        '''Get a job by its handle, or None if it is unknown or has expired.
+
+        Output parameters:
+
+        A dictionary of the job's job_id, status, created and updated times
+        and its response body under record, which is None while it is
+        pending.
+
+        '''
+        now = time.time()
+        query = ('SELECT job_id, status, created, updated, record, owner '
+                 'FROM jobs WHERE job_id = ?')
+        with self._lock, self._connection:
+            self._expire(now)
+            row = self._connection.execute(query, (job_id, )).fetchone()
+            if row is not None and row[1] == PENDING:
+                self._fail_orphans(row[5])
+                row = self._connection.execute(query, (job_id, )).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(['job_id', 'status', 'created', 'updated'], row))
+        job['record'] = None if row[4] is None else json.loads(row[4])
+        return job
+
+    def delete(self, job_id):
+        '''Remove a job, returning whether it existed.'''
+        with self._lock, self._connection:
+            return self._connection.execute(
+                'DELETE FROM jobs WHERE job_id = ?', (job_id, )).rowcount > 0
+
+    def expire(self):
+        '''Remove the expired jobs, returning how many there were.'''
+        with self._lock, self._connection:
+            return self._expire(time.time())
+
+
+def get_process_owner(pid=None):
+    '''Get the owner identifier of a running process, which tells it apart
+    from earlier processes with the same pid, or None if there is no such
+    process.
+
+    Input parameters:
+
+    pid -- The process id, this process by default.
+
+    '''
+    pid = os.getpid() if pid is None else pid
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        # The process exists but belongs to another user
+        pass
+    # The start time of the process in clock ticks since boot, where it is
+    # available
+    started = ''
+    try:
+        with open('/proc/{}/stat'.format(pid)) as infile:
+            stat = infile.read()
+        # The command name in parentheses can contain spaces
+        started = stat[stat.rindex(')') + 2:].split()[19]
+    except (IOError, ValueError, IndexError):
+        pass
+    return '{}:{}:{}'.format(_get_boot_id(), pid, started)
+
+
+def is_running(owner):
+    '''Check whether the process of an owner from get_process_owner() is
+    still running.'''
+    try:
+        pid = int(owner.split(':')[1])
+    except (AttributeError, IndexError, ValueError):
+        return False
+    if pid <= 0:
+        return False
+    return get_process_owner(pid) == owner
+
+
+def _get_boot_id():
+    try:
+        with open(BOOT_ID_PATH) as infile:
+            return infile.read().strip()
+    except IOError:
+        return ''
+
+
+def _get_status(record):
+    return DONE if record.get('success') else FAILED
+
+
+def _dumps(record):
+    return None if record is None else json.dumps(record)
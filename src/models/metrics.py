@@ -0,0 +1,181 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Timing of the analysis pipeline stages.
+
+A StageTimer records how long each stage of one analysis takes, along with
+counts such as the number of pixels clustered. Its timings are plain
+dictionaries so they can be returned from pool workers. MetricsRegistry
+aggregates the timings of every analysis into histograms and renders them in
+the Prometheus text format.
+
+'''
+
+import bisect
+import collections
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets in seconds
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                 2.5, 5.0, 10.0, 30.0)
+
+# Upper bounds of the histogram buckets of each count
+COUNT_BUCKETS = {
+    'pixels': (1000, 5000, 10000, 50000, 100000, 500000, 1000000, 5000000),
+    'clusters': (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+}
+
+METRIC_PREFIX = 'cluster_analysis'
+
+
+class StageTimer:
+    '''Timings of the stages of an analysis.'''
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name):
+        '''Context manager that adds the time spent in it to a stage.'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = (self.stages.get(name, 0.0) +
+                                 time.perf_counter() - start)
+
+    def count(self, name, value):
+        '''Record a count, such as the number of pixels.'''
+        self.counts[name] = value
+
+    def update(self, timings):
+        '''Add the timings of another timer, from to_dict().'''
+        for name, seconds in timings.get('stages', {}).items():
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+        self.counts.update(timings.get('counts', {}))
+
+    def to_dict(self):
+        '''Get the timings as a dictionary that can be pickled.'''
+        return {'stages': dict(self.stages), 'counts': dict(self.counts)}
+
+    def get_server_timing(self, total=None):
+        '''Get the stages as the value of a Server-Timing header, with an
+        optional total number of seconds.'''
+        stages = list(self.stages.items())
+        if total is not None:
+            stages.append(('total', total))
+        return ', '.join('{};dur={:.1f}'.format(name, seconds * 1000)
+                         for name, seconds in stages)
+
+
+class Histogram:
+    '''Cumulative histogram of observed values.
+
+    Input parameters:
+
+    buckets -- The ascending upper bounds of the buckets. Values above the
+               last bound are only counted in the +Inf bucket.
+
+    '''
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # Bounds are inclusive
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_lines(self, name, labels=''):
+        '''Get the Prometheus text lines of the histogram.'''
+        separator = ',' if labels else ''
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(
+                name, labels, separator, bound, total))
+        labels = '{{{}}}'.format(labels) if labels else ''
+        lines.append('{}_sum{} {}'.format(name, labels, self.sum))
+        lines.append('{}_count{} {}'.format(name, labels, self.count))
+        return lines
+
+
+class MetricsRegistry:
+    '''Histograms of the stage timings and counts of every analysis.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = collections.OrderedDict()
+        self._counts = collections.OrderedDict(
+            (name, Histogram(buckets))
+            for name, buckets in COUNT_BUCKETS.items())
+
+    def observe(self, timings):
+        '''Add the timings of an analysis, from StageTimer.to_dict().'''
+        with self._lock:
+            for name, seconds in timings.get('stages', {}).items():
+                if name not in self._stages:
+                    self._stages[name] = Histogram(STAGE_BUCKETS)
+                self._stages[name].observe(seconds)
+            for name, value in timings.get('counts', {}).items():
+                if name in self._counts:
+                    self._counts[name].observe(value)
+
+    def render(self, gauges=None, counters=None):
+        '''Render the histograms in the Prometheus text format.
+
+        Input parameters:
+
+        gauges -- An optional dictionary of names to current values to
+                  include, such as the queue depth.
+        counters -- An optional dictionary of names to totals that only ever
+                    increase to include, such as the completed analyses. They
+                    are named with a _total suffix.
+
+        '''
+        name = '{}_stage_seconds'.format(METRIC_PREFIX)
+        lines = [
+            '# HELP {} Time spent in each stage of an analysis.'.format(name),
+            '# TYPE {} histogram'.format(name)
+        ]
+        with self._lock:
+            for stage, histogram in self._stages.items():
+                lines.extend(
+                    histogram.get_lines(name, 'stage="{}"'.format(stage)))
+            for count, histogram in self._counts.items():
+                name = '{}_{}'.format(METRIC_PREFIX, count)
+                lines.append(
+                    '# HELP {} Number of {} in each analysis.'.format(
+                        name, count))
+                lines.append('# TYPE {} histogram'.format(name))
+                lines.extend(histogram.get_lines(name))
+        for gauge, value in (gauges or {}).items():
+            name = '{}_{}'.format(METRIC_PREFIX, gauge)
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, float(value)))
+        for counter, value in (counters or {}).items():
+            name = '{}_{}_total'.format(METRIC_PREFIX, counter)
+            lines.append('# TYPE {} counter'.format(name))
+            lines.append('{} {}'.format(name, float(value)))
+        return '\n'.join(lines) + '\n'
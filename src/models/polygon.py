@@ -31,10 +31,16 @@ If is_inside < 0 then point is outside the polygon.
 If is_inside = 0 then point in on a side of the polygon.
 If is_inside > 0 then point is inside the polygon.
 
+For convex polygons, is_inside_convex returns only the sign of is_inside
+using cheaper half-plane tests.
+
 '''
 
 import numpy as np
 
+# Maximum number of point and side pairs evaluated at once
+CHUNK_SIZE = 2 ** 20
+
 
 def _det(xvert, yvert):
     '''Compute twice the area of the triangle defined by points with using
@@ -117,6 +123,74 @@ class Polygon:
              Software, Vol 7, No. 1, pp 45-47.
 
         '''
+        xpoint, ypoint, scalar = self._points(xpoint, ypoint)
+        mindst = np.empty(xpoint.shape, dtype=float)
+        xflat = xpoint.ravel()
+        yflat = ypoint.ravel()
+        flat = mindst.reshape(-1)
+        step = max(1, CHUNK_SIZE // (len(self.x) - 1))
+        for start in range(0, len(xflat), step):
+            stop = start + step
+            flat[start:stop] = self._distances(xflat[start:stop],
+                                               yflat[start:stop], smalld)
+        # If input values were scalar then the output should be too
+        if scalar:
+            mindst = float(mindst[0])
+        return mindst
+
+    def is_inside_convex(self, xpoint, ypoint, smalld=1e-12):
+        '''Check if point is inside a convex polygon.
+
+        Input parameters:
+
+        xpoint -- The x-coord of the point to be tested.
+        ypoint -- The y-coords of the point to be tested.
+        smalld -- A small float number.
+
+        xpoint and ypoint could be scalars or array-like sequences.
+
+        Output parameters:
+
+        sign -- The sign of is_inside for a convex polygon.
+                If sign = -1 then point is outside the polygon.
+                If sign = 0 then point in on a side of the polygon.
+                If sign = 1 then point is inside the polygon.
+
+        Notes:
+
+        The polygon is anti-clockwise so a point is inside it if it is to the
+        left of every side. The result is undefined for concave polygons.
+
+        '''
+        xpoint, ypoint, scalar = self._points(xpoint, ypoint)
+        sign = np.empty(xpoint.shape, dtype=int)
+        x1 = self.x[:-1]
+        y1 = self.y[:-1]
+        x21 = self.x[1:] - x1
+        y21 = self.y[1:] - y1
+        length = np.hypot(x21, y21)
+        sides = length > 0
+        x1, y1, x21, y21, length = (x1[sides], y1[sides], x21[sides],
+                                    y21[sides], length[sides])
+        xflat = xpoint.ravel()
+        yflat = ypoint.ravel()
+        flat = sign.reshape(-1)
+        step = max(1, CHUNK_SIZE // max(1, len(x1)))
+        for start in range(0, len(xflat), step):
+            stop = start + step
+            # Signed distance from each point to the line through each side
+            dst = (x21 * (yflat[start:stop, np.newaxis] - y1) -
+                   y21 * (xflat[start:stop, np.newaxis] - x1)) / length
+            dst[np.fabs(dst) < smalld] = 0
+            flat[start:stop] = np.sign(dst).min(axis=1, initial=1)
+        if scalar:
+            sign = int(sign[0])
+        return sign
+
+    @staticmethod
+    def _points(xpoint, ypoint):
+        '''Convert points to float arrays, noting whether they were
+        scalars.'''
         xpoint = np.asfarray(xpoint)
         ypoint = np.asfarray(ypoint)
         # Scalar to array
@@ -129,55 +203,49 @@ class Polygon:
         # Check consistency
         if xpoint.shape != ypoint.shape:
             raise IndexError('x and y has different shapes')
-        # If snear = True: Dist to nearest side < nearest vertex
-        # If snear = False: Dist to nearest vertex < nearest side
-        snear = np.ma.masked_all(xpoint.shape, dtype=bool)
-        # Initialize arrays
-        mindst = np.ones_like(xpoint, dtype=float) * np.inf
-        j = np.ma.masked_all(xpoint.shape, dtype=int)
+        return xpoint, ypoint, scalar
+
+    def _distances(self, xpoint, ypoint, smalld):
+        '''Signed distances for a 1-D array of points, see is_inside.'''
         x = self.x
         y = self.y
-        n = len(x) - 1  # Number of sides/vertices defining the polygon
-        # Loop over each side defining polygon
-        for i in range(n):
-            d = np.ones_like(xpoint, dtype=float) * np.inf
-            # Start of side has coords (x1, y1)
-            # End of side has coords (x2, y2)
-            # Point has coords (xpoint, ypoint)
-            x1 = x[i]
-            y1 = y[i]
-            x21 = x[i + 1] - x1
-            y21 = y[i + 1] - y1
-            x1p = x1 - xpoint
-            y1p = y1 - ypoint
-            # Points on infinite line defined by
-            #     x = x1 + t * (x1 - x2)
-            #     y = y1 + t * (y1 - y2)
-            # where
-            #     t = 0    at (x1, y1)
-            #     t = 1    at (x2, y2)
-            # Find where normal passing through (xpoint, ypoint) intersects
-            # infinite line
+        # Start of side has coords (x1, y1)
+        # End of side has coords (x2, y2)
+        # Point has coords (xpoint, ypoint)
+        # Arrays are indexed [point, side]
+        x1 = x[:-1]
+        y1 = y[:-1]
+        x21 = x[1:] - x1
+        y21 = y[1:] - y1
+        x1p = x1 - xpoint[:, np.newaxis]
+        y1p = y1 - ypoint[:, np.newaxis]
+        # Points on infinite line defined by
+        #     x = x1 + t * (x1 - x2)
+        #     y = y1 + t * (y1 - y2)
+        # where
+        #     t = 0    at (x1, y1)
+        #     t = 1    at (x2, y2)
+        # Find where normal passing through (xpoint, ypoint) intersects
+        # infinite line
+        with np.errstate(divide='ignore', invalid='ignore'):
             t = -(x1p * x21 + y1p * y21) / (x21 ** 2 + y21 ** 2)
-            tlt0 = t < 0
-            tle1 = (0 <= t) & (t <= 1)
-            # Normal intersects side
-            d[tle1] = ((x1p[tle1] + t[tle1] * x21) ** 2 +
-                       (y1p[tle1] + t[tle1] * y21) ** 2)
-            # Normal does not intersects side
-            # Point is closest to vertex (x1, y1)
-            # Compute square of distance to this vertex
-            d[tlt0] = x1p[tlt0] ** 2 + y1p[tlt0] ** 2
-            # Store distances
-            mask = d < mindst
-            mindst[mask] = d[mask]
-            j[mask] = i
-            # Point is closer to (x1, y1) than any other vertex or side
-            snear[mask & tlt0] = False
-            # Point is closer to this side than to any other side or vertex
-            snear[mask & tle1] = True
-        if np.ma.count(snear) != snear.size:
+        tlt0 = t < 0
+        tle1 = (0 <= t) & (t <= 1)
+        # Normal intersects side: square of distance to the side.
+        # Normal does not intersects side, point is closest to vertex
+        # (x1, y1): square of distance to this vertex.
+        d = np.where(tle1, (x1p + t * x21) ** 2 + (y1p + t * y21) ** 2,
+                     np.inf)
+        d = np.where(tlt0, x1p ** 2 + y1p ** 2, d)
+        # The first nearest side or vertex of each point
+        j = np.argmin(d, axis=1)
+        points = np.arange(len(xpoint))
+        mindst = d[points, j]
+        if not np.all(mindst < np.inf):
             raise IndexError('Error computing distances')
+        # If snear = True: Dist to nearest side < nearest vertex
+        # If snear = False: Dist to nearest vertex < nearest side
+        snear = tle1[points, j]
         mindst **= 0.5
         # Point is closer to its nearest vertex than its nearest side, check if
         # nearest vertex is concave.
@@ -195,7 +263,4 @@ class Polygon:
         mindst[snear] = np.copysign(mindst, area)[snear]
         # Point is on side of polygon
         mindst[np.fabs(mindst) < smalld] = 0
-        # If input values were scalar then the output should be too
-        if scalar:
-            mindst = float(mindst)
         return mindst
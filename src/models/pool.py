@@ -0,0 +1,208 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Process pool with admission control for the analysis pipeline.
+
+The pipeline is CPU bound and mostly holds the GIL, so analyses run in a pool
+of worker processes. The pool admits up to one analysis per worker plus a
+bounded queue. Anything beyond that is refused straight away with an estimate
+of when to retry, rather than waiting behind the queue. When a worker dies,
+say it runs out of memory, the analyses it took down fail and the workers
+are started again for the next one.
+
+'''
+
+import math
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+
+class PoolFull(Exception):
+    '''Raised when the pool can't admit more work.
+
+    Input parameters:
+
+    retry_after -- The estimated number of seconds until there is room.
+
+    '''
+
+    def __init__(self, retry_after):
+        super(PoolFull, self).__init__(
+            'The analysis pool is full, retry after {} seconds'.format(
+                retry_after))
+        self.retry_after = retry_after
+
+
+def _timed(fn, *args):
+    '''Run a function in a worker and time it.'''
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+
+class AnalysisPool:
+    '''Bounded process pool.
+
+    Input parameters:
+
+    max_workers -- The number of worker processes, defaults to the CPU count.
+    max_queue -- The number of analyses that can wait for a worker.
+    initializer -- A function called when each worker process starts.
+
+    '''
+
+    def __init__(self, max_workers=None, max_queue=8, initializer=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.initializer = initializer
+        self._executor = None
+        self._lock = threading.Lock()
+        # Analyses that have been admitted and haven't finished
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._busy_seconds = 0.0
+        # Moving average of the time an analysis takes
+        self._average_seconds = None
+        self._started = time.time()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    initializer=self.initializer)
+            return self._executor
+
+    def _discard_executor(self, executor):
+        '''Stop using a broken executor, so the next analysis starts new
+        workers.'''
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def _get_retry_after(self):
+        average = self._average_seconds or 1.0
+        waiting = self._pending - self.max_workers + 1
+        return max(1, int(math.ceil(average * waiting / self.max_workers)))
+
+    def _admit(self):
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                self._rejected += 1
+                raise PoolFull(self._get_retry_after())
+            self._pending += 1
+
+    def _release(self, seconds):
+        with self._lock:
+            self._pending -= 1
+            self._completed += 1
+            if seconds is not None:
+                self._busy_seconds += seconds
+                if self._average_seconds is None:
+                    self._average_seconds = seconds
+                else:
+                    self._average_seconds = (0.8 * self._average_seconds +
+                                             0.2 * seconds)
+
+    def submit(self, fn, *args):
+        '''Run a picklable function in a worker process.
+
+        Output parameters:
+
+        A concurrent.futures.Future of the function's result.
+
+        Raises PoolFull if the pool and its queue are full.
+
+        '''
+        self._admit()
+        future = Future()
+        try:
+            executor = self._get_executor()
+            try:
+                worker_future = executor.submit(_timed, fn, *args)
+            except BrokenProcessPool:
+                # A worker died since the last analysis finished
+                self._discard_executor(executor)
+                executor = self._get_executor()
+                worker_future = executor.submit(_timed, fn, *args)
+        except Exception:
+            self._release(None)
+            raise
+
+        def done(worker_future):
+            try:
+                seconds, result = worker_future.result()
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    self._discard_executor(executor)
+                self._release(None)
+                future.set_exception(e)
+            else:
+                self._release(seconds)
+                future.set_result(result)
+
+        worker_future.add_done_callback(done)
+        return future
+
+    def run(self, fn, *args):
+        '''Run a picklable function in a worker process and wait for its
+        result. Raises PoolFull if the pool and its queue are full.'''
+        return self.submit(fn, *args).result()
+
+    @contextmanager
+    def slot(self):
+        '''Context manager that holds a place in the pool while work is done
+        in this process, such as analyses of data that only this process
+        has. Raises PoolFull if the pool and its queue are full.'''
+        self._admit()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._release(time.time() - start)
+
+    def stats(self):
+        '''Get the queue depth and worker utilisation of the pool.'''
+        with self._lock:
+            busy = min(self._pending, self.max_workers)
+            uptime = max(time.time() - self._started, 1e-9)
+            return {
+                'workers': self.max_workers,
+                'busy': busy,
+                'queued': self._pending - busy,
+                'max_queue': self.max_queue,
+                'utilisation': busy / self.max_workers,
+                'average_utilisation': min(
+                    1.0, self._busy_seconds / (uptime * self.max_workers)),
+                'average_seconds': self._average_seconds,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'full': self._pending >= self.max_workers + self.max_queue
+            }
+
+    def shutdown(self, wait=True):
+        '''Stop the worker processes.'''
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=wait)
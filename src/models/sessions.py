@@ -0,0 +1,110 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Per-process store of analysis sessions.
+
+A session keeps what was worked out for an image, such as its threshold
+index, so later requests about the same image can refer to it by a handle
+instead of sending and decoding the image again. Sessions live in the memory
+of the process that created them and expire when they haven't been used for
+a while, when too many newer sessions have been created or when they take
+more memory together than the store allows.
+
+'''
+
+import collections
+import threading
+import time
+import uuid
+
+
+class SessionStore:
+    '''Least recently used store of sessions that expire.
+
+    Input parameters:
+
+    max_sessions -- The number of sessions to keep.
+    ttl -- The number of seconds a session is kept after it was last used.
+    max_bytes -- The optional number of bytes the sessions can take together.
+                 The most recently used session is always kept.
+    get_size -- A function of a session that returns the bytes it takes,
+                which is needed with max_bytes. Sizes are worked out again
+                every time the store is used, as sessions can grow.
+
+    '''
+
+    def __init__(self, max_sessions=16, ttl=1800, max_bytes=None,
+                 get_size=None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.get_size = get_size
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._sessions:
+            session_id, (last_used, _) = next(iter(self._sessions.items()))
+            if now - last_used <= self.ttl and len(
+                    self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[session_id]
+        if self.max_bytes is None:
+            return
+        sizes = collections.OrderedDict(
+            (session_id, self.get_size(session))
+            for session_id, (_, session) in self._sessions.items())
+        total = sum(sizes.values())
+        while total > self.max_bytes and len(sizes) > 1:
+            session_id, size = sizes.popitem(last=False)
+            del self._sessions[session_id]
+            total -= size
+
+    def create(self, session):
+        '''Store a session.
+
+        Input parameters:
+
+        session -- A dictionary of the session's data.
+
+        Output parameters:
+
+        The session's handle.
+
+        '''
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._sessions[session_id] = (now, session)
+            self._expire(now)
+        return session_id
+
+    def get(self, session_id):
+        '''Get a session by its handle, or None if it is unknown or has
+        expired.'''
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if session_id not in self._sessions:
+                return None
+            _, session = self._sessions.pop(session_id)
+            self._sessions[session_id] = (now, session)
+            return session
+
+    def delete(self, session_id):
+        '''Remove a session, returning whether it existed.'''
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
@@ -0,0 +1,335 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Lattice DBSCAN of an image at every grey scale threshold.
+
+A pixel is clustered at threshold t when its grey value is below t, so
+raising the threshold only ever adds pixels, and a pixel that is a core point
+at one threshold is a core point at every higher one. ThresholdIndex records
+for every pixel:
+
+1. Its entry level, the lowest threshold that includes it.
+2. Its core level, the lowest threshold at which it has min_samples pixels
+   in its neighbourhood, which is the min_samples-th smallest entry level of
+   the neighbourhood.
+
+Two neighbouring core points are joined from the higher of their core levels
+on, so the core components at any threshold are those of the joins made at or
+below it. Only the minimum spanning forest of the joins is needed for that
+and it is kept sorted by level, which makes the clusters at a threshold a
+prefix of the forest plus the border points.
+
+The clusters at a threshold also give the clusters of a region of the
+raster, such as a marquee selection, without clustering all of it again,
+see ThresholdIndex.fit_region().
+
+The memory of an index grows with the number of pixels it covers, so it can
+be limited to the thresholds with up to a number of pixels. An index can be
+shared by threads.
+
+'''
+
+import collections
+import threading
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+
+from models.dbscan import (LatticeDBSCAN, _attach_border_points,
+                           _rank_components, get_disk_offsets)
+
+# Number of pixels whose neighbourhoods are gathered at once when building an
+# index, which bounds its working memory
+CHUNK_SIZE = 1 << 20
+
+
+class ThresholdIndex:
+    '''Index of the lattice DBSCAN clusters of a grey scale raster.
+
+    Input parameters:
+
+    grey -- An (height, width) array of the sum of every pixel's channels,
+            see main.get_grey_raster().
+    eps -- The maximum distance between two neighbouring pixels.
+    min_samples -- The number of pixels in a neighbourhood, including the
+                   pixel itself, for a pixel to be a core point.
+    max_threshold -- The highest threshold to index.
+    region_cache_size -- The number of thresholds to keep the clusters of
+                         for fit_region().
+    max_pixels -- The optional number of pixels to index. The index then
+                  only covers the thresholds with fewer pixels than this,
+                  even if that is below max_threshold.
+
+    '''
+
+    def __init__(self,
+                 grey,
+                 eps=2,
+                 min_samples=3,
+                 max_threshold=255,
+                 region_cache_size=2,
+                 max_pixels=None):
+        self.eps = eps
+        self.min_samples = min_samples
+        self.offsets = get_disk_offsets(eps)
+        self.pad = int(np.floor(eps))
+        # A pixel's grey value is below t when the sum of its channels is
+        # below 3 * t
+        levels = np.asarray(grey).T // 3 + 1
+        if max_pixels is not None:
+            # The number of pixels at each threshold
+            counts = np.cumsum(
+                np.bincount(levels.ravel(),
+                            minlength=max_threshold + 1)[:max_threshold + 1])
+            max_threshold = int(np.searchsorted(counts, max_pixels)) - 1
+        self.max_threshold = max_threshold
+        xs, ys = np.nonzero(levels <= max_threshold)
+        self.points = np.stack([xs, ys], axis=1).astype(np.int32)
+        self.entry_levels = levels[xs, ys].astype(np.int32)
+        self.shape = (levels.shape[0] + 2 * self.pad,
+                      levels.shape[1] + 2 * self.pad)
+        self.xs = xs + self.pad
+        self.ys = ys + self.pad
+        self.core_levels = self._get_core_levels()
+        self.edges, self.edge_levels = self._get_edges()
+        self.region_cache_size = region_cache_size
+        self._region_cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def nbytes(self):
+        '''The bytes taken by the index's arrays and its cache of recent
+        thresholds.'''
+        arrays = [
+            self.points, self.entry_levels, self.xs, self.ys,
+            self.core_levels, self.edges, self.edge_levels
+        ]
+        with self._lock:
+            for clusters in self._region_cache.values():
+                arrays.extend(clusters)
+        return sum(array.nbytes for array in arrays)
+
+    def covers(self, threshold):
+        '''Check whether a threshold is within the index.'''
+        return threshold <= self.max_threshold
+
+    def _get_core_levels(self):
+        never = self.max_threshold + 1
+        level_raster = np.full(self.shape, never, dtype=np.int32)
+        level_raster[self.xs, self.ys] = self.entry_levels
+        k = min(self.min_samples, len(self.offsets)) - 1
+        core_levels = np.empty(len(self.xs), dtype=np.int32)
+        for start in range(0, len(self.xs), CHUNK_SIZE):
+            xs = self.xs[start:start + CHUNK_SIZE]
+            ys = self.ys[start:start + CHUNK_SIZE]
+            neighbour_levels = np.stack(
+                [level_raster[xs + dx, ys + dy] for dx, dy in self.offsets])
+            core_levels[start:start + CHUNK_SIZE] = np.partition(
+                neighbour_levels, k, axis=0)[k]
+        if self.min_samples > len(self.offsets):
+            core_levels[:] = never
+        return np.maximum(core_levels, self.entry_levels)
+
+    def _get_edges(self):
+        '''Get the minimum spanning forest of the joins between core points,
+        sorted by level.'''
+        n = len(self.points)
+        can_be_core = self.core_levels <= self.max_threshold
+        ids = np.full(self.shape, -1, dtype=np.int32)
+        ids[self.xs[can_be_core],
+            self.ys[can_be_core]] = np.nonzero(can_be_core)[0]
+        rows, cols = [np.empty(0, dtype=np.intp)], [np.empty(0, dtype=np.intp)]
+        xs = self.xs[can_be_core]
+        ys = self.ys[can_be_core]
+        sources = ids[xs, ys]
+        # Only half of the offsets are needed as the graph is undirected
+        for dx, dy in self.offsets:
+            if (dx, dy) <= (0, 0):
+                continue
+            targets = ids[xs + dx, ys + dy]
+            joined = targets >= 0
+            rows.append(sources[joined])
+            cols.append(targets[joined])
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        if len(rows) == 0:
+            return (np.empty((0, 2), dtype=np.intp),
+                    np.empty(0, dtype=np.int32))
+        levels = np.maximum(self.core_levels[rows], self.core_levels[cols])
+        forest = minimum_spanning_tree(
+            coo_matrix((levels.astype(np.float64), (rows, cols)),
+                       shape=(n, n))).tocoo()
+        forest_levels = forest.data.astype(np.int32)
+        order = np.argsort(forest_levels, kind='mergesort')
+        edges = np.stack([forest.row[order], forest.col[order]],
+                         axis=1).astype(np.intp)
+        return edges, forest_levels[order]
+
+    def fit(self, threshold):
+        '''Get the DBSCAN clustering of the pixels below a threshold.
+
+        Input parameters:
+
+        threshold -- A threshold covered by the index.
+
+        Output parameters:
+
+        A tuple of the (N, 2) array of pixel [x, y] coordinates in the order
+        of main.get_threshold_pixels() and a LatticeDBSCAN with the labels_,
+        core_sample_indices_ and components_ it would have fitting them.
+
+        '''
+        present, db = self._fit(threshold)
+        return self.points[present], db
+
+    def _fit(self, threshold):
+        if not self.covers(threshold):
+            raise ValueError(
+                'Threshold {} is above the index maximum of {}.'.format(
+                    threshold, self.max_threshold))
+        present = np.nonzero(self.entry_levels <= threshold)[0]
+        pixels = self.points[present]
+        db = LatticeDBSCAN(eps=self.eps, min_samples=self.min_samples)
+        db.labels_ = np.full(len(present), -1, dtype=np.intp)
+        is_core = self.core_levels[present] <= threshold
+        core_indices = np.nonzero(is_core)[0]
+        db.core_sample_indices_ = core_indices
+        db.components_ = pixels[core_indices]
+        if len(core_indices) == 0:
+            return present, db
+
+        # Join the core points with the forest edges up to the threshold
+        n_edges = np.searchsorted(self.edge_levels, threshold, side='right')
+        edges = self.edges[:n_edges]
+        graph = coo_matrix(
+            (np.ones(n_edges, dtype=np.int8), (edges[:, 0], edges[:, 1])),
+            shape=(len(self.points), len(self.points)))
+        _, components = connected_components(graph, directed=False)
+        core_labels, n_clusters = _rank_components(
+            components[present[core_indices]])
+        db.labels_[core_indices] = core_labels
+        _attach_border_points(db.labels_, self.xs[present], self.ys[present],
+                              self.shape, self.offsets, core_indices,
+                              core_labels, n_clusters)
+        return present, db
+
+    def _get_clusters(self, threshold):
+        '''Get the pixels, labels, core points and isolated clusters at a
+        threshold, from the cache of recent thresholds. Threads wait for each
+        other so a threshold's clusters are only worked out once.'''
+        with self._lock:
+            if threshold in self._region_cache:
+                self._region_cache.move_to_end(threshold)
+                return self._region_cache[threshold]
+            present, db = self._fit(threshold)
+            is_core = np.zeros(len(present), dtype=bool)
+            is_core[db.core_sample_indices_] = True
+            clusters = (self.points[present], db.labels_, is_core,
+                        self._get_isolated_clusters(present, db.labels_))
+            if self.region_cache_size > 0:
+                self._region_cache[threshold] = clusters
+                while len(self._region_cache) > self.region_cache_size:
+                    self._region_cache.popitem(last=False)
+            return clusters
+
+    def _get_isolated_clusters(self, present, labels):
+        '''Find the clusters with no pixels of another cluster, or noise, in
+        the neighbourhood of any of their pixels.'''
+        n_clusters = labels.max(initial=-1) + 1
+        isolated = np.ones(n_clusters, dtype=bool)
+        background = -2
+        label_raster = np.full(self.shape, background, dtype=np.int32)
+        xs = self.xs[present]
+        ys = self.ys[present]
+        label_raster[xs, ys] = labels
+        clustered = labels >= 0
+        for dx, dy in self.offsets:
+            neighbours = label_raster[xs + dx, ys + dy]
+            foreign = (neighbours != background) & (neighbours != labels)
+            isolated[labels[foreign & clustered]] = False
+        return isolated
+
+    def fit_region(self, threshold, region):
+        '''Get the DBSCAN clustering of the pixels below a threshold within
+        a region of the raster, reusing the clusters of the whole raster.
+
+        A cluster that is inside the region and has no other pixels in its
+        neighbourhood is clustered the same way in the region, so only the
+        rest of the region's pixels are clustered again. Clusters are then
+        numbered as they would be clustering the region on its own.
+
+        Input parameters:
+
+        threshold -- A threshold covered by the index.
+        region -- The (x, y, width, height) of the region, within the
+                  raster.
+
+        Output parameters:
+
+        A tuple of the (N, 2) array of pixel [x, y] coordinates relative to
+        the region, in the order of main.get_threshold_pixels() of the
+        cropped raster, and a LatticeDBSCAN with the labels_,
+        core_sample_indices_ and components_ it would have fitting them.
+
+        '''
+        x0, y0, width, height = region
+        pixels, labels, full_is_core, isolated = self._get_clusters(threshold)
+        in_region = ((pixels[:, 0] >= x0) & (pixels[:, 0] < x0 + width) &
+                     (pixels[:, 1] >= y0) & (pixels[:, 1] < y0 + height))
+        db = LatticeDBSCAN(eps=self.eps, min_samples=self.min_samples)
+
+        # Clusters whose pixels are all in the region and that don't touch
+        # any other pixels can be reused. The last entry is for the noise
+        # label, which is never reused.
+        n_clusters = len(isolated)
+        outside = np.zeros(n_clusters + 1, dtype=bool)
+        outside[labels[~in_region]] = True
+        reusable = np.append(isolated, False) & ~outside
+
+        region_indices = np.nonzero(in_region)[0]
+        region_labels = labels[region_indices]
+        reused = reusable[region_labels]
+        rest = np.nonzero(~reused)[0]
+        pixels = (pixels[region_indices] - [x0, y0]).astype(np.int32)
+        rest_db = LatticeDBSCAN(eps=self.eps,
+                                min_samples=self.min_samples).fit(
+                                    pixels[rest])
+
+        # Give the reused clusters and the new ones distinct ids, then number
+        # them in order of their first core point
+        ids = np.full(len(pixels), -1, dtype=np.intp)
+        ids[reused] = region_labels[reused]
+        rest_labels = rest_db.labels_
+        ids[rest[rest_labels >= 0]] = rest_labels[rest_labels >= 0] + \
+            n_clusters
+        is_core = full_is_core[region_indices] & reused
+        is_core[rest[rest_db.core_sample_indices_]] = True
+        core_indices = np.nonzero(is_core)[0]
+        db.labels_ = np.full(len(pixels), -1, dtype=np.intp)
+        db.core_sample_indices_ = core_indices
+        db.components_ = pixels[core_indices]
+        if len(core_indices) == 0:
+            return pixels, db
+        core_labels, _ = _rank_components(ids[core_indices])
+        id_labels = np.empty(ids.max() + 1, dtype=np.intp)
+        id_labels[ids[core_indices]] = core_labels
+        clustered = ids >= 0
+        db.labels_[clustered] = id_labels[ids[clustered]]
+        return pixels, db
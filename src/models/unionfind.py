@@ -0,0 +1,76 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Disjoint set forest over the integers 0..n-1.'''
+
+import numpy as np
+
+
+class UnionFind:
+    '''Union-find with path halving and union by size.
+
+    Input parameters:
+
+    n -- The number of elements.
+
+    '''
+
+    def __init__(self, n):
+        self.parent = np.arange(n, dtype=np.intp)
+        self.size = np.ones(n, dtype=np.intp)
+
+    def find(self, i):
+        '''Get the representative element of the set containing i.'''
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        '''Merge the sets containing i and j.
+
+        Output parameters:
+
+        The representative element of the merged set.
+
+        '''
+        i = self.find(i)
+        j = self.find(j)
+        if i == j:
+            return i
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+        return i
+
+    def union_pairs(self, pairs):
+        '''Merge the sets of every (i, j) row of an array-like of pairs.'''
+        pairs = np.asarray(pairs)
+        if len(pairs) == 0:
+            return
+        for i, j in np.unique(pairs, axis=0).tolist():
+            self.union(i, j)
+
+    def roots(self):
+        '''Get the representative element of every element as an array.'''
+        parent = self.parent
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                return parent.copy()
+            parent[:] = grandparent
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from test.utils import TestbedTestCase
+
+import main
+from benchmarks.generator import generate_image
+from benchmarks.run import DIRECTIONS, compare, run
+from models.images import get_image_bytes
+
+
+class GeneratorTests(TestbedTestCase):
+
+    def test_images_are_deterministic(self):
+        arguments = {
+            'width': 300,
+            'height': 200,
+            'glyph_count': 20,
+            'cartouches': 1,
+            'nesting': 2,
+            'noise': 0.05
+        }
+        image = generate_image(7, **arguments)
+        self.assertEqual(get_image_bytes(image),
+                         get_image_bytes(generate_image(7, **arguments)))
+        self.assertNotEqual(get_image_bytes(image),
+                            get_image_bytes(generate_image(8, **arguments)))
+
+    def test_glyphs_are_clustered(self):
+        image = generate_image(1,
+                               width=400,
+                               height=300,
+                               glyph_count=24,
+                               cartouches=2)
+        response = main.do_cluster_analysis(image, 'rtl')
+        self.assertGreaterEqual(len(response['clusters']), 24)
+        self.assertEqual(2, len(response['cartouches']))
+
+    def test_too_many_glyphs(self):
+        with self.assertRaises(ValueError):
+            generate_image(1, width=50, height=50, glyph_count=100)
+
+
+class CompareTests(TestbedTestCase):
+
+    def test_regressions_beyond_the_tolerance(self):
+        baseline = {'timings': {'small': {'ltr': {'dbscan': 0.1,
+                                                  'merge': 0.1}}}}
+        results = {'timings': {'small': {'ltr': {'dbscan': 0.12,
+                                                 'merge': 0.2}}}}
+        self.assertEqual([('small', 'ltr', 'merge', 0.1, 0.2)],
+                         compare(results, baseline, tolerance=0.25))
+
+
+class RunTests(TestbedTestCase):
+
+    def test_run_a_small_workload(self):
+        results = run(['small'], repeat=1)
+        self.assertEqual(['small'], list(results['timings']))
+        self.assertEqual(DIRECTIONS, list(results['timings']['small']))
+        for stages in results['timings']['small'].values():
+            self.assertIn('dbscan', stages)
+            self.assertGreater(stages['endpoint'], 0)
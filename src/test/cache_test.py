@@ -0,0 +1,78 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+from test.utils import TestbedTestCase
+
+from models.cache import (DISK, MEMORY, ResultCache, get_cache_key,
+                          get_image_digest)
+
+
+class ResultCacheTests(TestbedTestCase):
+
+    def setUp(self):
+        super(ResultCacheTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(ResultCacheTests, self).tearDown()
+
+    def test_memory_tier_is_least_recently_used(self):
+        cache = ResultCache(max_entries=2)
+        cache.set('a', {'n': 1})
+        cache.set('b', {'n': 2})
+        self.assertEqual(({'n': 1}, MEMORY), cache.get('a'))
+        cache.set('c', {'n': 3})
+        self.assertEqual((None, None), cache.get('b'))
+        self.assertEqual(({'n': 1}, MEMORY), cache.get('a'))
+
+    def test_disk_tier_is_shared(self):
+        key = get_cache_key(get_image_digest(b'image'), 160, 'rtl')
+        ResultCache(directory=self.directory).set(key, {'clusters': []})
+        cache = ResultCache(directory=self.directory)
+        self.assertEqual(({'clusters': []}, DISK), cache.get(key))
+        self.assertEqual(({'clusters': []}, MEMORY), cache.get(key))
+
+    def test_invalidate(self):
+        cache = ResultCache(directory=self.directory)
+        digest = get_image_digest(b'image')
+        cache.set(get_cache_key(digest, 160, 'rtl'), {})
+        cache.set(get_cache_key(digest, 200, 'ltr'), {})
+        cache.set(get_cache_key(get_image_digest(b'other'), 160, 'rtl'), {})
+        self.assertEqual(2, cache.invalidate(digest))
+        self.assertEqual((None, None),
+                         cache.get(get_cache_key(digest, 160, 'rtl')))
+        self.assertEqual(1, cache.invalidate())
+
+    def test_failed_writes_leave_no_temporary_files(self):
+        cache = ResultCache(directory=self.directory)
+        cache.set('a', {'n': object()})
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_disk_tier_is_bounded(self):
+        cache = ResultCache(max_entries=0,
+                            directory=self.directory,
+                            max_disk_entries=2)
+        for i, key in enumerate(['a', 'b', 'c']):
+            cache.set(key, {'n': i})
+            # Modification times must differ for the order to be kept
+            os.utime(os.path.join(self.directory, key + '.json'),
+                     (i, i))
+        self.assertEqual(['b.json', 'c.json'],
+                         sorted(os.listdir(self.directory)))
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from test.utils import TestbedTestCase
+
+import numpy
+
+import main
+from models.clusters import ClusterStore
+
+
+class ClusterStoreTests(TestbedTestCase):
+
+    def setUp(self):
+        super(ClusterStoreTests, self).setUp()
+        pixels = [[0, 0], [5, 5], [0, 1], [9, 9], [5, 6]]
+        labels = [1, 0, 1, -1, 0]
+        self.store = ClusterStore.from_labels(pixels, labels)
+
+    def test_from_labels(self):
+        self.assertEqual(['0', '1'], list(self.store))
+        self.assertEqual(numpy.int16, self.store.coords.dtype)
+        self.assertEqual({
+            '0': [[5, 5], [5, 6]],
+            '1': [[0, 0], [0, 1]]
+        }, self.store.to_dict())
+        with self.assertRaises(ValueError):
+            self.store['0'][0, 0] = 1
+
+    def test_layer_is_copy_on_write(self):
+        layer = self.store.copy()
+        layer['1'] = main.merge_clusters(layer['0'], layer['1'])
+        del layer['0']
+        layer['0'] = [[7, 7]]
+        self.assertEqual(['1', '0'], list(layer))
+        self.assertEqual(2, len(layer))
+        self.assertEqual([[0, 0], [0, 1], [5, 5], [5, 6]],
+                         layer['1'].tolist())
+        self.assertEqual([[5, 5], [5, 6]], self.store['0'].tolist())
+        del layer['0']
+        self.assertNotIn('0', layer)
+        self.assertEqual(1, len(layer))
+
+    def test_merge_clusters_skips_shared_pixels(self):
+        merged = main.merge_clusters([[1, 1], [2, 2], [3, 3]],
+                                     [[2, 2], [0, 0]])
+        self.assertEqual([[2, 2], [0, 0], [1, 1], [3, 3]], merged.tolist())
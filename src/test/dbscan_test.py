@@ -0,0 +1,91 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from test.utils import TestbedTestCase
+
+import numpy
+from sklearn.cluster import DBSCAN
+
+from models.dbscan import LatticeDBSCAN, TiledDBSCAN, get_disk_offsets
+
+
+def get_random_pixels(seed, size=(60, 40), density=0.2):
+    """
+    Random distinct pixel coordinates in column-major order
+    """
+    rng = numpy.random.RandomState(seed)
+    mask = rng.random_sample(size) < density
+    return numpy.argwhere(mask)
+
+
+class LatticeDBSCANTests(TestbedTestCase):
+
+    def test_disk_offsets(self):
+        offsets = get_disk_offsets(2)
+        self.assertEqual(13, len(offsets))
+        self.assertIn((0, 0), offsets)
+        self.assertIn((2, 0), offsets)
+        self.assertNotIn((1, 2), offsets)
+
+    def test_labels_match_sklearn(self):
+        for seed in range(6):
+            for density in [0.05, 0.2, 0.5]:
+                pixels = get_random_pixels(seed, density=density)
+                for eps, min_samples in [(2, 3), (1, 2), (1.5, 4), (3, 8)]:
+                    expected = DBSCAN(eps=eps,
+                                      min_samples=min_samples).fit(pixels)
+                    actual = LatticeDBSCAN(eps=eps,
+                                           min_samples=min_samples).fit(pixels)
+                    self.assertEqual(expected.labels_.tolist(),
+                                     actual.labels_.tolist())
+                    self.assertEqual(expected.core_sample_indices_.tolist(),
+                                     actual.core_sample_indices_.tolist())
+
+    def test_empty_and_noise_only_input(self):
+        empty = LatticeDBSCAN(eps=2, min_samples=3).fit(
+            numpy.empty((0, 2), dtype=int))
+        self.assertEqual(0, len(empty.labels_))
+        noise = LatticeDBSCAN(eps=2, min_samples=3).fit([[0, 0], [10, 10]])
+        self.assertEqual([-1, -1], noise.labels_.tolist())
+
+    def test_rejects_non_lattice_input(self):
+        with self.assertRaises(ValueError):
+            LatticeDBSCAN().fit([[0.5, 1.0]])
+        with self.assertRaises(ValueError):
+            LatticeDBSCAN().fit([[1, 1], [1, 1]])
+
+
+class TiledDBSCANTests(TestbedTestCase):
+
+    def test_labels_match_untiled(self):
+        for seed in range(4):
+            pixels = get_random_pixels(seed, size=(90, 70), density=0.3)
+            expected = LatticeDBSCAN(eps=2, min_samples=3).fit(pixels)
+            for tile_size in [5, 16, 64]:
+                actual = TiledDBSCAN(eps=2, min_samples=3,
+                                     tile_size=tile_size,
+                                     n_jobs=1).fit(pixels)
+                self.assertEqual(expected.labels_.tolist(),
+                                 actual.labels_.tolist())
+                self.assertEqual(expected.core_sample_indices_.tolist(),
+                                 actual.core_sample_indices_.tolist())
+
+    def test_parallel_tiles(self):
+        pixels = get_random_pixels(7, size=(120, 80), density=0.25)
+        expected = DBSCAN(eps=2, min_samples=3).fit(pixels)
+        actual = TiledDBSCAN(eps=2, min_samples=3, tile_size=32,
+                             n_jobs=2).fit(pixels)
+        self.assertEqual(expected.labels_.tolist(), actual.labels_.tolist())
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from test.utils import TestbedTestCase
+
+from models.encoding import decode_binary, encode_binary
+
+
+class BinaryEncodingTests(TestbedTestCase):
+
+    def test_round_trip(self):
+        body = {
+            'code': 200,
+            'success': True,
+            'result': {
+                'direction': 'rtl',
+                'cartouches': [],
+                'groups': [['1', '0']],
+                'clusters': [{
+                    'cluster_id': '1',
+                    'hull': [{'x': 1.0, 'y': 2.0}, {'x': 3.0, 'y': 4.0},
+                             {'x': 1.0, 'y': 5.0}],
+                    'bounds': {'x': 1, 'y': 2, 'width': 3, 'height': 4,
+                               'order': 0}
+                }, {
+                    'cluster_id': '0',
+                    'hull': [{'x': 7, 'y': 7}],
+                    'bounds': {'x': 7, 'y': 7, 'width': 1, 'height': 1,
+                               'order': 1}
+                }]
+            }
+        }
+        header, buffers = decode_binary(encode_binary(body))
+        self.assertEqual(['1', '0'], header['result']['cluster_ids'])
+        self.assertEqual([['1', '0']], header['result']['groups'])
+        self.assertNotIn('clusters', header['result'])
+        self.assertEqual([[1, 2, 3, 4, 0], [7, 7, 1, 1, 1]],
+                         buffers['bounds'].tolist())
+        self.assertEqual([0, 3, 4], buffers['hull_offsets'].tolist())
+        self.assertEqual([[1, 2], [3, 4], [1, 5], [7, 7]],
+                         buffers['hull'].tolist())
+        # The original body is left alone
+        self.assertIn('clusters', body['result'])
+
+    def test_empty_result(self):
+        body = {'code': 200, 'success': True, 'result': {'clusters': []}}
+        header, buffers = decode_binary(encode_binary(body))
+        self.assertEqual([], header['result']['cluster_ids'])
+        self.assertEqual([0], buffers['hull_offsets'].tolist())
+        self.assertEqual((0, 2), buffers['hull'].shape)
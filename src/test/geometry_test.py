@@ -0,0 +1,53 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from test.utils import TestbedTestCase
+
+import main
+from models.geometry import ClusterGeometry
+
+
+class ClusterGeometryTests(TestbedTestCase):
+
+    def setUp(self):
+        super(ClusterGeometryTests, self).setUp()
+        self.clusters = {
+            '0': [[0, 0], [10, 0], [10, 10], [0, 10], [5, 5]],
+            '1': [[4, 4], [5, 4], [4, 5]],
+            '2': [[20, 20], [21, 20], [20, 21]]
+        }
+        self.geometry = ClusterGeometry(self.clusters)
+
+    def test_geometry_is_memoised(self):
+        hull = self.geometry.hull('0')
+        self.assertIs(hull, self.geometry.hull('0'))
+        self.assertIs(self.geometry.polygon('0'), self.geometry.polygon('0'))
+        self.assertEqual(4, len(self.geometry.hull_points('0')))
+        self.assertEqual([5, 5], self.geometry.centroid('0'))
+
+    def test_merge_invalidates_changed_clusters(self):
+        job_dict = {
+            'clusters_raw': self.clusters,
+            'clusters_processed': dict(self.clusters),
+        }
+        job_dict['geometry'] = ClusterGeometry(job_dict['clusters_processed'])
+        merge_dict = main.get_merge_dict(job_dict)
+        self.assertEqual({'0': ['1']}, merge_dict)
+        unchanged = job_dict['geometry'].hull('2')
+        main.merge(job_dict, merge_dict, [])
+        self.assertNotIn('1', job_dict['clusters_processed'])
+        self.assertEqual(8, len(job_dict['geometry'].array('0')))
+        self.assertIs(unchanged, job_dict['geometry'].hull('2'))
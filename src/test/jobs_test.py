@@ -0,0 +1,87 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import sys
+import tempfile
+
+from test.utils import TestbedTestCase
+
+from models.jobs import (DONE, FAILED, INTERRUPTED_MESSAGE, PENDING,
+                         JobStore, get_process_owner, is_running)
+
+
+class JobStoreTests(TestbedTestCase):
+
+    def test_jobs_are_finished(self):
+        store = JobStore()
+        job_id = store.create()
+        job = store.get(job_id)
+        self.assertEqual(PENDING, job['status'])
+        self.assertIsNone(job['record'])
+        record = {'code': 200, 'success': True, 'result': {'clusters': []}}
+        self.assertTrue(store.finish(job_id, record))
+        job = store.get(job_id)
+        self.assertEqual(DONE, job['status'])
+        self.assertEqual(record, job['record'])
+        self.assertGreaterEqual(job['updated'], job['created'])
+        failed = store.create({'code': 400, 'success': False, 'message': ''})
+        self.assertEqual(FAILED, store.get(failed)['status'])
+        self.assertTrue(store.delete(job_id))
+        self.assertFalse(store.delete(job_id))
+        self.assertIsNone(store.get(job_id))
+        self.assertFalse(store.finish(job_id, record))
+
+    def test_jobs_expire(self):
+        store = JobStore(ttl=-1)
+        self.assertIsNone(store.get(store.create()))
+        store.create()
+        self.assertEqual(1, store.expire())
+
+    def test_jobs_persist(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'jobs.db')
+            job_id = JobStore(path).create({'success': True})
+            self.assertEqual(DONE, JobStore(path).get(job_id)['status'])
+
+    def test_pending_jobs_of_stopped_processes_fail(self):
+        process = subprocess.Popen([sys.executable, '-c', 'input()'],
+                                   stdin=subprocess.PIPE)
+        owner = get_process_owner(process.pid)
+        self.assertTrue(is_running(owner))
+        self.assertTrue(is_running(get_process_owner()))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'jobs.db')
+            store = JobStore(path)
+            running = store.create()
+            stopped = JobStore(path, owner=owner).create()
+            restarted = JobStore(path, owner=owner).create()
+            self.assertEqual(PENDING, store.get(stopped)['status'])
+            process.communicate(b'\n')
+            self.assertFalse(is_running(owner))
+            # Jobs are failed when they are looked up
+            job = store.get(stopped)
+            self.assertEqual(FAILED, job['status'])
+            self.assertEqual(INTERRUPTED_MESSAGE, job['record']['message'])
+            self.assertEqual(PENDING, store.get(running)['status'])
+            # and when a store is opened
+            store = JobStore(path)
+            with store._connection:
+                row = store._connection.execute(
+                    'SELECT status FROM jobs WHERE job_id = ?',
+                    (restarted, )).fetchone()
+            self.assertEqual((FAILED, ), row)
@@ -15,9 +15,20 @@
 # limitations under the License.
 
 from test.utils import TestbedTestCase
-import os
+import base64
+import gzip
 import json
+import os
+import time
+from io import BytesIO
+
+import numpy
+from PIL import Image
+
 import main
+from models.clusters import ClusterStore
+from models.encoding import BINARY_MIMETYPE, decode_binary
+from models.metrics import StageTimer
 
 
 VALID_PNG_IMAGE_DATA = '''data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAZAAAADMCAIAAADS5mKjAAAAGXRFWHRTb2Z0d2FyZQBBZG9
@@ -297,9 +308,723 @@ class MainTests(TestbedTestCase):
             main.QHULL_ERROR_MESSAGE,
             data.get('message'))
 
+    def test_results_are_cached(self):
+        main.result_cache.invalidate()
+        payload = {'image': VALID_PNG_IMAGE_DATA, 'threshold': 150}
+        response = self.client.post('/clusteranalysis', json=payload)
+        self.assertEqual('MISS', response.headers.get('X-Cache'))
+        cached = self.client.post('/clusteranalysis', json=payload)
+        self.assertEqual('HIT', cached.headers.get('X-Cache'))
+        self.assertEqual(json.loads(response.data), json.loads(cached.data))
+        url = '/clusteranalysis/cache/{}'.format(
+            cached.headers.get('X-Cache-Key'))
+        self.assertEqual('403 FORBIDDEN', self.client.delete(url).status)
+        main.admin_token = 'secret'
+        try:
+            headers = {'Authorization': 'Bearer wrong'}
+            self.assertEqual('403 FORBIDDEN',
+                             self.client.delete(url, headers=headers).status)
+            headers = {'Authorization': 'Bearer secret'}
+            response = self.client.delete(url, headers=headers)
+            self.assertEqual(1,
+                             json.loads(response.data)['result']['removed'])
+            response = self.client.post('/clusteranalysis', json=payload)
+            self.assertEqual('MISS', response.headers.get('X-Cache'))
+            response = self.client.delete('/clusteranalysis/cache/invalid',
+                                          headers=headers)
+            self.assertEqual('400 BAD REQUEST', response.status)
+        finally:
+            main.admin_token = None
+
+    def test_session_reuses_the_image(self):
+        main.result_cache.invalidate()
+        response = self.client.post('/clusteranalysis',
+                                    json={
+                                        'image': VALID_PNG_IMAGE_DATA,
+                                        'session': True
+                                    })
+        data = json.loads(response.data)
+        self.assertEqual(200, data.get('code'))
+        session_id = data.get('session_id')
+        self.assertIsNotNone(session_id)
+        image = Image.open(
+            BytesIO(base64.b64decode(VALID_PNG_IMAGE_DATA.split(',')[1])))
+        for threshold in [160, 120]:
+            response = self.client.post('/clusteranalysis',
+                                        json={
+                                            'session_id': session_id,
+                                            'threshold': threshold
+                                        })
+            data = json.loads(response.data)
+            expected = json.loads(
+                json.dumps(
+                    main.do_cluster_analysis(image,
+                                             'rtl',
+                                             dbscan_threshold=threshold)))
+            self.assertEqual(expected, data.get('result'))
+            self.assertEqual(session_id, data.get('session_id'))
+        response = self.client.post('/clusteranalysis',
+                                    json={'session_id': 'unknown'})
+        self.assertEqual('404 NOT FOUND', response.status)
+
+    def test_session_area_limit(self):
+        limit = main.session_area_limit
+        main.session_area_limit = 100
+        try:
+            response = self.client.post('/clusteranalysis',
+                                        json={
+                                            'image': VALID_PNG_IMAGE_DATA,
+                                            'session': True
+                                        })
+        finally:
+            main.session_area_limit = limit
+        self.assertEqual('400 BAD REQUEST', response.status)
+        self.assertEqual('Sessions are limited to images of up to 100 pixels',
+                         json.loads(response.data).get('message'))
+
+    def test_session_region(self):
+        main.result_cache.invalidate()
+        response = self.client.post('/clusteranalysis',
+                                    json={
+                                        'image': VALID_PNG_IMAGE_DATA,
+                                        'session': True
+                                    })
+        session_id = json.loads(response.data).get('session_id')
+        image = Image.open(
+            BytesIO(base64.b64decode(VALID_PNG_IMAGE_DATA.split(',')[1])))
+        width, height = image.size
+        for x, y in [(0, 0), (width // 4, height // 5)]:
+            region = {
+                'x': x,
+                'y': y,
+                'width': width // 2,
+                'height': height // 2
+            }
+            response = self.client.post('/clusteranalysis',
+                                        json={
+                                            'session_id': session_id,
+                                            'region': region
+                                        })
+            self.assertEqual('200 OK', response.status)
+            expected = json.loads(
+                json.dumps(
+                    main.do_cluster_analysis(
+                        image.crop((x, y, x + width // 2,
+                                    y + height // 2)), 'rtl')))
+            expected['region'] = region
+            self.assertEqual(expected, json.loads(response.data).get('result'))
+        response = self.client.post('/clusteranalysis',
+                                    json={
+                                        'session_id': session_id,
+                                        'region': '{},0,10,10'.format(width)
+                                    })
+        self.assertEqual('The region is outside the image',
+                         json.loads(response.data).get('message'))
+        response = self.client.post('/clusteranalysis',
+                                    json={
+                                        'image': VALID_PNG_IMAGE_DATA,
+                                        'region': '0,0,10,10'
+                                    })
+        self.assertEqual('400 BAD REQUEST', response.status)
+
+    def get_streamed_result(self, response):
+        self.assertEqual('200 OK', response.status)
+        self.assertEqual('application/x-ndjson', response.mimetype)
+        records = [
+            json.loads(line)
+            for line in response.get_data(as_text=True).splitlines()
+        ]
+        groups = [record for record in records if record['type'] == 'group']
+        self.assertEqual(list(range(len(groups))),
+                         [record['group'] for record in groups])
+        self.assertEqual(['cartouches', 'summary'],
+                         [record['type'] for record in records[-2:]])
+        summary = records[-1]
+        result = {
+            'clusters': [
+                cluster for record in groups for cluster in record['clusters']
+            ],
+            'direction': summary['direction'],
+            'cartouches': records[-2]['cartouches'],
+            'groups': summary['groups']
+        }
+        self.assertEqual(len(result['clusters']), summary['cluster_count'])
+        if 'region' in summary:
+            result['region'] = summary['region']
+        return result, summary
+
+    def test_stream_request(self):
+        main.result_cache.invalidate()
+        payload = {'image': VALID_PNG_IMAGE_DATA, 'threshold': 152}
+        result, _ = self.get_streamed_result(
+            self.client.post('/clusteranalysis',
+                             json=payload,
+                             headers={'Accept': 'application/x-ndjson'}))
+        response = self.client.post('/clusteranalysis', json=payload)
+        self.assertEqual('HIT', response.headers['X-Cache'])
+        self.assertEqual(result, json.loads(response.data).get('result'))
+        response = self.client.post('/clusteranalysis',
+                                    json=dict(payload, stream=True))
+        self.assertEqual('HIT', response.headers['X-Cache'])
+        self.assertEqual(result, self.get_streamed_result(response)[0])
+
+    def test_stream_session_region(self):
+        main.result_cache.invalidate()
+        response = self.client.post('/clusteranalysis',
+                                    json={
+                                        'image': VALID_PNG_IMAGE_DATA,
+                                        'session': True,
+                                        'stream': True
+                                    })
+        result, summary = self.get_streamed_result(response)
+        session_id = summary['session_id']
+        payload = {'session_id': session_id, 'region': '0,0,200,100'}
+        response = self.client.post('/clusteranalysis',
+                                    json=dict(payload, stream=True))
+        self.assertEqual('MISS', response.headers['X-Cache'])
+        result, summary = self.get_streamed_result(response)
+        self.assertEqual({'x': 0, 'y': 0, 'width': 200, 'height': 100},
+                         summary['region'])
+        response = self.client.post('/clusteranalysis', json=payload)
+        self.assertEqual(result, json.loads(response.data).get('result'))
+
+    def test_job_request(self):
+        main.result_cache.invalidate()
+        payload = {'image': VALID_PNG_IMAGE_DATA, 'threshold': 153}
+        response = self.client.post('/clusteranalysis/jobs', json=payload)
+        self.assertEqual('202 ACCEPTED', response.status)
+        job_id = json.loads(response.data)['result']['job_id']
+        self.assertTrue(response.headers['Location'].endswith(
+            '/clusteranalysis/jobs/{}'.format(job_id)))
+        deadline = time.time() + 60
+        while True:
+            response = self.client.get(
+                '/clusteranalysis/jobs/{}'.format(job_id))
+            self.assertEqual('200 OK', response.status)
+            job = json.loads(response.data)['result']
+            if job['status'] != 'pending' or time.time() > deadline:
+                break
+            time.sleep(0.05)
+        self.assertEqual('done', job['status'])
+        response = self.client.post('/clusteranalysis', json=payload)
+        self.assertEqual('HIT', response.headers['X-Cache'])
+        self.assertEqual(job['result'], json.loads(response.data)['result'])
+        # Cached results finish their jobs straight away
+        response = self.client.post('/clusteranalysis/jobs', json=payload)
+        self.assertEqual('done', json.loads(response.data)['result']['status'])
+        response = self.client.get('/clusteranalysis/jobs/unknown')
+        self.assertEqual('404 NOT FOUND', response.status)
+
+    def test_batch_request(self):
+        main.result_cache.invalidate()
+        json_path = os.path.join(os.path.dirname(__file__),
+                                 'scipy_error_request.json')
+        with open(json_path) as infile:
+            scipy_error = json.load(infile)
+        images = [{
+            'image': VALID_PNG_IMAGE_DATA,
+            'direction': 'ltr'
+        }, scipy_error, {
+            'image': VALID_PNG_IMAGE_DATA,
+            'direction': 'invalid'
+        }, {
+            'threshold': 100
+        }, {
+            'image': VALID_PNG_IMAGE_DATA
+        }]
+        response = self.client.post('/clusteranalysis/batch',
+                                    json={'images': images})
+        self.assertEqual('200 OK', response.status)
+        records = json.loads(response.data).get('results')
+        self.assertEqual([200, 400, 400, 400, 200],
+                         [record.get('code') for record in records])
+        single = self.client.post('/clusteranalysis',
+                                  json={
+                                      'image': VALID_PNG_IMAGE_DATA,
+                                      'direction': 'ltr'
+                                  })
+        self.assertEqual(json.loads(single.data).get('result'),
+                         records[0].get('result'))
+        self.assertEqual('HIT', single.headers.get('X-Cache'))
+        self.assertEqual(main.QHULL_ERROR_MESSAGE, records[1].get('message'))
+        self.assertEqual("Invalid read order 'invalid'",
+                         records[2].get('message'))
+        self.assertEqual('rtl', records[4]['result']['direction'])
+        response = self.client.post('/clusteranalysis/batch',
+                                    json={'images': 'invalid'})
+        self.assertEqual('400 BAD REQUEST', response.status)
+
+    def test_batch_larger_than_the_pool(self):
+        main.result_cache.invalidate()
+        # Leave room for one analysis at a time
+        capacity = main.pool.max_workers + main.pool.max_queue
+        slots = [main.pool.slot() for _ in range(capacity - 1)]
+        for slot in slots:
+            slot.__enter__()
+        try:
+            images = [{
+                'image': VALID_PNG_IMAGE_DATA,
+                'threshold': threshold
+            } for threshold in [140, 145, 150]]
+            response = self.client.post('/clusteranalysis/batch',
+                                        json={'images': images})
+        finally:
+            for slot in slots:
+                slot.__exit__(None, None, None)
+        self.assertEqual('200 OK', response.status)
+        records = json.loads(response.data).get('results')
+        self.assertEqual([200, 200, 200],
+                         [record.get('code') for record in records])
+
+    def test_full_pool_responds_503(self):
+        main.result_cache.invalidate()
+        capacity = main.pool.max_workers + main.pool.max_queue
+        slots = [main.pool.slot() for _ in range(capacity)]
+        for slot in slots:
+            slot.__enter__()
+        try:
+            response = self.client.post('/clusteranalysis',
+                                        json={'image': VALID_PNG_IMAGE_DATA})
+            self.assertEqual('503 SERVICE UNAVAILABLE', response.status)
+            self.assertEqual(main.POOL_FULL_MESSAGE,
+                             json.loads(response.data).get('message'))
+            self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+            health = json.loads(self.client.get('/health').data)
+            self.assertTrue(health['result']['full'])
+        finally:
+            for slot in slots:
+                slot.__exit__(None, None, None)
+        health = json.loads(self.client.get('/health').data)
+        self.assertEqual(0, health['result']['busy'])
+        self.assertFalse(health['result']['full'])
+
+    def test_binary_image_uploads(self):
+        imagebytes = base64.b64decode(VALID_PNG_IMAGE_DATA.split(',')[1])
+        expected = self.client.post('/clusteranalysis',
+                                    json={
+                                        'image': VALID_PNG_IMAGE_DATA,
+                                        'direction': 'ltr',
+                                        'threshold': 150
+                                    })
+        expected = json.loads(expected.data).get('result')
+        response = self.client.post(
+            '/clusteranalysis?direction=ltr&threshold=150',
+            data=imagebytes,
+            content_type='image/png')
+        self.assertEqual('200 OK', response.status)
+        self.assertEqual(expected, json.loads(response.data).get('result'))
+        response = self.client.post('/clusteranalysis',
+                                    data={
+                                        'image': (BytesIO(imagebytes),
+                                                  'image.png'),
+                                        'direction': 'ltr',
+                                        'threshold': '150'
+                                    },
+                                    content_type='multipart/form-data')
+        self.assertEqual('200 OK', response.status)
+        self.assertEqual(expected, json.loads(response.data).get('result'))
+        response = self.client.post('/clusteranalysis',
+                                    data=b'',
+                                    content_type='image/png')
+        self.assertEqual('The request is missing the image parameter',
+                         json.loads(response.data).get('message'))
+        response = self.client.post('/clusteranalysis',
+                                    data=b'not a png',
+                                    content_type='image/png')
+        self.assertEqual('400 BAD REQUEST', response.status)
+
+    def test_point_and_mask_input(self):
+        image = Image.open(
+            BytesIO(base64.b64decode(VALID_PNG_IMAGE_DATA.split(',')[1])))
+        expected = self.client.post('/clusteranalysis',
+                                    json={'image': VALID_PNG_IMAGE_DATA})
+        expected = json.loads(expected.data).get('result')
+        pixels, _ = main.get_source_image_pixels(image)
+        # Point order doesn't matter
+        points = pixels[::-1].astype('<i2').tobytes()
+        response = self.client.post(
+            '/clusteranalysis',
+            json={'points': base64.b64encode(points).decode('ascii')})
+        self.assertEqual('200 OK', response.status)
+        self.assertEqual(expected, json.loads(response.data).get('result'))
+        response = self.client.post('/clusteranalysis',
+                                    data=points,
+                                    content_type='application/x-cluster-points')
+        self.assertEqual(expected, json.loads(response.data).get('result'))
+
+        width, height = image.size
+        mask = numpy.zeros((height, width), dtype=bool)
+        mask[pixels[:, 1], pixels[:, 0]] = True
+        maskbytes = numpy.packbits(mask, axis=1).tobytes()
+        response = self.client.post(
+            '/clusteranalysis?width={}&height={}'.format(width, height),
+            data=maskbytes,
+            content_type='application/x-cluster-mask')
+        self.assertEqual('200 OK', response.status)
+        self.assertEqual(expected, json.loads(response.data).get('result'))
+
+        response = self.client.post('/clusteranalysis',
+                                    json={
+                                        'mask': base64.b64encode(
+                                            maskbytes).decode('ascii'),
+                                        'width': width + 8,
+                                        'height': height
+                                    })
+        self.assertEqual('400 BAD REQUEST', response.status)
+        response = self.client.post('/clusteranalysis',
+                                    data=points[:-1],
+                                    content_type='application/x-cluster-points')
+        self.assertEqual(
+            'Point data must be pairs of 16 bit integer coordinates',
+            json.loads(response.data).get('message'))
+        for point, message in [
+            ([-1, 0], 'Point coordinates can\'t be negative'),
+            ([32767, 32767], 'The input covers 32768 by 32768 pixels, '
+             'the limit is {} pixels'.format(main.input_area_limit))
+        ]:
+            response = self.client.post(
+                '/clusteranalysis',
+                data=numpy.array([[0, 0], point], dtype='<i2').tobytes(),
+                content_type='application/x-cluster-points')
+            self.assertEqual('400 BAD REQUEST', response.status)
+            self.assertEqual(message, json.loads(response.data).get('message'))
+
+    def test_server_timing_and_metrics(self):
+        response = self.client.post('/clusteranalysis',
+                                    json={
+                                        'image': VALID_PNG_IMAGE_DATA,
+                                        'threshold': 151
+                                    })
+        self.assertEqual('200 OK', response.status)
+        stages = [
+            timing.split(';')[0]
+            for timing in response.headers['Server-Timing'].split(', ')
+        ]
+        for stage in [
+                'decode', 'threshold', 'dbscan', 'merge_dict', 'cartouches',
+                'merge', 'sequence', 'response', 'encode', 'total'
+        ]:
+            self.assertIn(stage, stages)
+        response = self.client.get('/metrics')
+        self.assertEqual('200 OK', response.status)
+        self.assertEqual('text/plain', response.mimetype)
+        text = response.get_data(as_text=True)
+        self.assertIn('cluster_analysis_stage_seconds_count{stage="dbscan"}',
+                      text)
+        self.assertIn('cluster_analysis_clusters_count', text)
+
+    def test_response_encodings(self):
+        payload = {'image': VALID_PNG_IMAGE_DATA}
+        expected = json.loads(
+            self.client.post('/clusteranalysis', json=payload).data)
+        response = self.client.post('/clusteranalysis',
+                                    json=payload,
+                                    headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', response.headers.get('Content-Encoding'))
+        self.assertEqual(expected, json.loads(gzip.decompress(response.data)))
+        response = self.client.post('/clusteranalysis',
+                                    json=payload,
+                                    headers={'Accept': BINARY_MIMETYPE})
+        self.assertEqual(BINARY_MIMETYPE, response.mimetype)
+        header, buffers = decode_binary(response.data)
+        clusters = expected['result']['clusters']
+        self.assertEqual([cluster['cluster_id'] for cluster in clusters],
+                         header['result']['cluster_ids'])
+        self.assertEqual(expected['result']['groups'],
+                         header['result']['groups'])
+        self.assertEqual(len(clusters), len(buffers['bounds']))
+        for i, cluster in enumerate(clusters):
+            start, end = buffers['hull_offsets'][i:i + 2]
+            self.assertEqual(
+                [[vertex['x'], vertex['y']] for vertex in cluster['hull']],
+                buffers['hull'][start:end].tolist())
+            self.assertEqual(cluster['bounds']['width'],
+                             buffers['bounds'][i][2])
+        response = self.client.post('/clusteranalysis',
+                                    json=payload,
+                                    headers={'Accept': '*/*'})
+        self.assertEqual('application/json', response.mimetype)
+        self.assertIsNone(response.headers.get('Content-Encoding'))
+
     def test_warmup_request_responds_200(self):
         """
         Asserts that a reuqest to /_ah/warmup is handled.
         """
         response = self.client.get('/_ah/warmup')
         self.assertEqual('200 OK', response.status)
+        result = json.loads(response.data).get('result')
+        for stage in [
+                'threshold', 'dbscan', 'clusters', 'merge_dict', 'cartouches',
+                'merge', 'sequence', 'response'
+        ]:
+            self.assertIn(stage, result['first_analysis_stages'])
+        self.assertGreater(result['import_seconds'], 0)
+
+    def test_warmup_image(self):
+        """
+        Asserts that the warmup image goes through every stage.
+        """
+        response = main.do_cluster_analysis(main.get_warmup_image(), 'rtl')
+        self.assertEqual(1, len(response['cartouches']))
+        # The dot was merged into its ring
+        self.assertEqual(6, len(response['clusters']))
+        self.assertEqual(1, response['clusters'][-1]['bounds']['height'])
+
+
+class SourceImagePixelsTests(TestbedTestCase):
+
+    @staticmethod
+    def get_reference_pixels(image, threshold):
+        # The original per-pixel scan, for comparison
+        rgb = image.convert('RGB').load()
+        return [[x, y] for x in range(image.size[0])
+                for y in range(image.size[1])
+                if sum(rgb[x, y]) / 3 < threshold]
+
+    def get_test_image(self):
+        rng = numpy.random.RandomState(0)
+        data = rng.randint(0, 256, size=(23, 31, 3)).astype(numpy.uint8)
+        return Image.fromarray(data, 'RGB')
+
+    def test_pixels_match_column_major_scan(self):
+        image = self.get_test_image()
+        for threshold in [0, 1, 100, 160, 255, 256]:
+            pixels, size = main.get_source_image_pixels(image,
+                                                        threshold=threshold)
+            self.assertEqual((31, 23), size)
+            self.assertEqual((len(pixels), 2), pixels.shape)
+            self.assertEqual(self.get_reference_pixels(image, threshold),
+                             pixels.tolist())
+
+    def test_pixels_for_other_image_modes(self):
+        rgb = self.get_test_image()
+        images = [
+            rgb.convert('L'),
+            rgb.convert('LA'),
+            rgb.convert('RGBA'),
+            rgb.convert('P', palette=Image.ADAPTIVE, colors=64),
+            rgb.convert('1')
+        ]
+        for image in images:
+            pixels, _ = main.get_source_image_pixels(image, threshold=120)
+            self.assertEqual(self.get_reference_pixels(image, 120),
+                             pixels.tolist(), image.mode)
+
+
+class DoClusterAnalysisTests(TestbedTestCase):
+
+    def setUp(self):
+        super(DoClusterAnalysisTests, self).setUp()
+        imagedata = VALID_PNG_IMAGE_DATA.split(',', 1)[1]
+        self.image = Image.open(BytesIO(base64.b64decode(imagedata)))
+
+    def test_tiled_clustering_matches_untiled(self):
+        expected = main.do_cluster_analysis(self.image, 'rtl', tiled=False)
+        actual = main.do_cluster_analysis(self.image, 'rtl', tiled=True)
+        self.assertEqual(expected, actual)
+
+    def test_only_spread_out_pixels_are_tiled(self):
+        pixels = numpy.array([[0, 0], [10, 10]])
+        self.assertFalse(main.needs_tiles(pixels))
+        pixels = numpy.array([[0, 0], [6000, 6000]])
+        self.assertTrue(main.needs_tiles(pixels))
+        self.assertTrue(main.needs_tiles(pixels, backend='lattice'))
+        # Explicit backends aren't overridden
+        self.assertFalse(main.needs_tiles(pixels, backend='sklearn'))
+
+    def test_backends_agree(self):
+        expected = main.do_cluster_analysis(self.image,
+                                            'ltr',
+                                            backend='sklearn')
+        actual = main.do_cluster_analysis(self.image,
+                                          'ltr',
+                                          backend='lattice')
+        self.assertEqual(expected, actual)
+
+
+class ContainmentCandidatesTests(TestbedTestCase):
+
+    def test_candidates_match_pairwise_inside(self):
+        rng = numpy.random.RandomState(3)
+        corners = rng.randint(0, 60, size=(200, 2))
+        sizes = rng.randint(1, 30, size=(200, 2))
+        boxes = numpy.hstack([corners, corners + sizes]).tolist()
+        # Include some identical boxes
+        boxes += boxes[:10]
+        candidates = main.get_containment_candidates(boxes)
+        for i, box in enumerate(boxes):
+            expected = [
+                j for j, other in enumerate(boxes)
+                if j != i and main.inside(box, other)
+            ]
+            self.assertEqual(expected, candidates[i].tolist())
+
+    def test_no_boxes(self):
+        self.assertEqual([], main.get_containment_candidates([]))
+
+
+class CartoucheTests(TestbedTestCase):
+
+    def test_framed_cartouches(self):
+        merge_dict = {
+            '1': ['2'],
+            '2': ['3'],
+            '3': ['4', '5', '6', '7'],
+            '8': ['9', '10', '11']
+        }
+        self.assertEqual([{
+            'inner': ['9', '10', '11'],
+            'wrapper': ['8'],
+            'frames': []
+        }, {
+            'inner': ['4', '5', '6', '7'],
+            'wrapper': ['3'],
+            'frames': ['1', '2']
+        }], main.get_cartouches(merge_dict, min_glyph_count=3))
+        self.assertEqual(1, len(main.get_cartouches(merge_dict, 4)))
+
+    def test_frames_must_only_enclose_the_cartouche(self):
+        merge_dict = {'1': ['2', '8'], '2': ['3', '4', '5', '6']}
+        self.assertEqual([], main.get_cartouches(merge_dict, 3))
+
+    def test_containment_forest(self):
+        labels, children, parents = main.get_containment_forest({
+            '5': ['3', '4'],
+            '6': ['4']
+        })
+        self.assertEqual(['5', '3', '4', '6'], labels)
+        self.assertEqual([[1, 2], [], [], [2]], children)
+        self.assertEqual([[], [0], [0, 3], []], parents)
+        self.assertEqual({0, 3}, main.get_ancestors(parents, 2))
+
+
+class MergeTests(TestbedTestCase):
+
+    def get_job_dict(self):
+        pixels = [[0, 0], [1, 1], [2, 2], [3, 3], [4, 4], [5, 5]]
+        labels = [0, 0, 1, 1, 2, 3]
+        clusters = ClusterStore.from_labels(pixels, labels)
+        return {'clusters_raw': clusters, 'clusters_processed': clusters.copy()}
+
+    def test_inner_merged_before_its_outer(self):
+        job_dict = self.get_job_dict()
+        main.merge(job_dict, {'1': ['2'], '0': ['1']}, [])
+        self.assertEqual({
+            '0': [[0, 0], [1, 1], [2, 2], [3, 3], [4, 4]],
+            '3': [[5, 5]]
+        }, job_dict['clusters_processed'].to_dict())
+
+    def test_inner_merged_after_its_outer_drops_its_inners(self):
+        job_dict = self.get_job_dict()
+        main.merge(job_dict, {'0': ['1'], '1': ['2']}, [])
+        self.assertEqual({
+            '0': [[0, 0], [1, 1], [2, 2], [3, 3]],
+            '3': [[5, 5]]
+        }, job_dict['clusters_processed'].to_dict())
+
+    def test_cartouche_clusters_are_not_merged(self):
+        job_dict = self.get_job_dict()
+        main.merge(job_dict, {'0': ['1', '2'], '3': ['2']}, [{
+            'wrapper': ['0'],
+            'frames': []
+        }])
+        self.assertEqual({
+            '0': [[0, 0], [1, 1]],
+            '1': [[2, 2], [3, 3]],
+            '3': [[5, 5], [4, 4]]
+        }, job_dict['clusters_processed'].to_dict())
+
+
+class GetLabelsTests(TestbedTestCase):
+
+    def get_column_labels(self, clusters, axis, direction):
+        # Label every column of every bounding box one at a time
+        d = {}
+        for label in clusters:
+            box = main.bounding_box(clusters[label])
+            if axis == 0 and direction == 'rtl':
+                columns = range(box[2], box[0], -1)
+            elif axis == 0:
+                columns = range(box[0], box[2])
+            else:
+                columns = range(box[1], box[3])
+            for i in columns:
+                if i not in d:
+                    d[i] = [label]
+                elif not main.have_overlaps(label, d[i], clusters, axis):
+                    d[i].append(label)
+        keys = sorted(d, reverse=axis == 0 and direction == 'rtl')
+        return [(key, d[key]) for key in keys]
+
+    def test_sweep_matches_column_by_column_labelling(self):
+        rng = numpy.random.RandomState(5)
+        clusters = {}
+        for label in range(60):
+            corner = rng.randint(0, 200, size=2)
+            size = rng.randint(0, 25, size=2)
+            clusters[str(label)] = [corner.tolist(), (corner + size).tolist()]
+        for axis, direction in [(0, 'ltr'), (0, 'rtl'), (1, 'vrtl')]:
+            labels = main.get_labels(clusters, axis=axis, direction=direction)
+            self.assertEqual(self.get_column_labels(clusters, axis, direction),
+                             list(labels.items()))
+
+
+class OrderGroupTests(TestbedTestCase):
+
+    def test_order_group(self):
+        box_dict = {
+            'a': [0, 0, 10, 10],
+            'b': [12, 0, 20, 5],
+            'c': [12, 6, 20, 10],
+            'd': [22, 2, 30, 8],
+            'e': [0, 12, 30, 20]
+        }
+        group = ['e', 'd', 'c', 'b', 'a']
+        for direction in ['rtl', 'vrtl']:
+            self.assertEqual(['d', 'b', 'c', 'a', 'e'],
+                             main.order_group(group, box_dict, direction))
+        for direction in ['ltr', 'vltr']:
+            self.assertEqual(['a', 'b', 'c', 'd', 'e'],
+                             main.order_group(group, box_dict, direction))
+
+    def test_equally_high_clusters_keep_the_last_first(self):
+        box_dict = {'a': [0, 0, 5, 5], 'b': [0, 0, 5, 5], 'c': [0, 6, 5, 9]}
+        self.assertEqual(['b', 'a', 'c'],
+                         main.order_group(['a', 'b', 'c'], box_dict, 'rtl'))
+
+
+class ResponseAssemblyTests(TestbedTestCase):
+
+    def test_get_bounding_boxes(self):
+        clusters = {
+            '0': [[3, 4], [1, 9], [2, 2]],
+            '1': numpy.array([[7, 7]], dtype=numpy.int16)
+        }
+        boxes = main.get_bounding_boxes(clusters)
+        self.assertEqual({'0': [1, 2, 4, 10], '1': [7, 7, 8, 8]}, boxes)
+        for label in clusters:
+            self.assertEqual(main.bounding_box(clusters[label]), boxes[label])
+        self.assertEqual({}, main.get_bounding_boxes({}))
+
+    def test_analysis_records_time_sequencing_and_assembly(self):
+        image = Image.open(
+            BytesIO(base64.b64decode(VALID_PNG_IMAGE_DATA.split(',')[1])))
+        pixels, _ = main.get_source_image_pixels(image)
+        timer = StageTimer()
+        records = list(
+            main.iter_analysis_records(main.prepare_analysis(pixels, 'rtl'),
+                                       timer))
+        self.assertEqual('summary', records[-1]['type'])
+        self.assertEqual(['sequence', 'response'], list(timer.stages))
+
+    def test_get_buffered_points_with_a_centroid_per_point(self):
+        points = [[0, 0], [10, 0], [4, 4], [6, 4]]
+        centroids = [[5, 0], [5, 0], [5, 5], [5, 5]]
+        self.assertEqual([[-1, 0], [11, 0], [4, 4], [6, 4]],
+                         main.get_buffered_points(points,
+                                                  centroid=centroids,
+                                                  factor=1.2).tolist())
+        self.assertEqual(
+            [[0, 0], [10, 0]],
+            main.get_buffered_points(points[:2], centroid=[5, 0],
+                                     factor=1.0).tolist())
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from test.utils import TestbedTestCase
+
+from models.metrics import Histogram, MetricsRegistry, StageTimer
+
+
+class StageTimerTests(TestbedTestCase):
+
+    def test_stages(self):
+        timer = StageTimer()
+        with timer.stage('dbscan'):
+            pass
+        with timer.stage('merge'):
+            pass
+        with timer.stage('dbscan'):
+            pass
+        timer.count('pixels', 10)
+        self.assertEqual(['dbscan', 'merge'], list(timer.stages))
+        other = StageTimer()
+        other.update(timer.to_dict())
+        self.assertEqual(timer.to_dict(), other.to_dict())
+        header = timer.get_server_timing(total=0.5)
+        self.assertTrue(header.startswith('dbscan;dur='))
+        self.assertTrue(header.endswith('total;dur=500.0'))
+
+
+class MetricsRegistryTests(TestbedTestCase):
+
+    def test_histogram_is_cumulative(self):
+        histogram = Histogram([1, 2])
+        for value in [1, 2, 3]:
+            histogram.observe(value)
+        self.assertEqual([
+            'x_bucket{le="1"} 1', 'x_bucket{le="2"} 2',
+            'x_bucket{le="+Inf"} 3', 'x_sum 6.0', 'x_count 3'
+        ], histogram.get_lines('x'))
+
+    def test_render(self):
+        registry = MetricsRegistry()
+        registry.observe({
+            'stages': {
+                'dbscan': 0.002
+            },
+            'counts': {
+                'pixels': 2000,
+                'clusters': 5
+            }
+        })
+        text = registry.render({'pool_busy': 1}, {'pool_completed': 3})
+        self.assertIn(
+            'cluster_analysis_stage_seconds_bucket{stage="dbscan",le="0.0025"} 1',
+            text)
+        self.assertIn('cluster_analysis_pixels_count 1', text)
+        self.assertIn('cluster_analysis_clusters_bucket{le="10"} 1', text)
+        self.assertIn('cluster_analysis_pool_busy 1.0', text)
+        self.assertIn('# TYPE cluster_analysis_pool_completed_total counter',
+                      text)
+        self.assertIn('cluster_analysis_pool_completed_total 3.0', text)
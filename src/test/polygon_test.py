@@ -0,0 +1,68 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from test.utils import TestbedTestCase
+
+import numpy
+from scipy.spatial import ConvexHull
+
+import models.polygon
+from models.polygon import Polygon
+
+
+class PolygonTests(TestbedTestCase):
+
+    def setUp(self):
+        super(PolygonTests, self).setUp()
+        # A concave, clockwise L shape
+        self.l_shape = Polygon([0, 0, 2, 2, 4, 4], [0, 4, 4, 2, 2, 0])
+
+    def test_is_inside_distances(self):
+        self.assertEqual(0.5, self.l_shape.is_inside(0.5, 1))
+        self.assertEqual(0, self.l_shape.is_inside(4, 1))
+        self.assertEqual(-1, self.l_shape.is_inside(5, 1))
+        # Outside, in the concave corner
+        self.assertEqual(-1, self.l_shape.is_inside(3, 3))
+        self.assertAlmostEqual(-2 ** 0.5, self.l_shape.is_inside(5, -1))
+        distances = self.l_shape.is_inside([[0.5, 3], [5, 1]], [[1, 3], [1, 1]])
+        self.assertEqual([[0.5, -1], [-1, 1]], distances.tolist())
+
+    def test_chunked_distances_are_identical(self):
+        rng = numpy.random.RandomState(0)
+        points = rng.uniform(-1, 5, size=(1000, 2))
+        expected = self.l_shape.is_inside(points[:, 0], points[:, 1])
+        chunk_size = models.polygon.CHUNK_SIZE
+        try:
+            models.polygon.CHUNK_SIZE = 13
+            actual = self.l_shape.is_inside(points[:, 0], points[:, 1])
+        finally:
+            models.polygon.CHUNK_SIZE = chunk_size
+        self.assertEqual(expected.tolist(), actual.tolist())
+
+    def test_is_inside_convex_matches_sign_of_is_inside(self):
+        rng = numpy.random.RandomState(1)
+        for _ in range(20):
+            points = rng.randint(0, 30, size=(30, 2))
+            hull = ConvexHull(points)
+            polygon = Polygon(points[hull.vertices, 0],
+                              points[hull.vertices, 1])
+            tests = rng.randint(-2, 32, size=(300, 2))
+            self.assertEqual(
+                numpy.sign(polygon.is_inside(tests[:, 0],
+                                             tests[:, 1])).tolist(),
+                polygon.is_inside_convex(tests[:, 0], tests[:, 1]).tolist())
+        vertex = points[hull.vertices[0]]
+        self.assertEqual(0, polygon.is_inside_convex(vertex[0], vertex[1]))
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from concurrent.futures.process import BrokenProcessPool
+from test.utils import TestbedTestCase
+
+from models.pool import AnalysisPool, PoolFull
+
+
+class AnalysisPoolTests(TestbedTestCase):
+
+    def setUp(self):
+        super(AnalysisPoolTests, self).setUp()
+        self.pool = AnalysisPool(max_workers=1, max_queue=1)
+
+    def tearDown(self):
+        self.pool.shutdown()
+        super(AnalysisPoolTests, self).tearDown()
+
+    def test_run(self):
+        self.assertEqual(8, self.pool.run(pow, 2, 3))
+        stats = self.pool.stats()
+        self.assertEqual(1, stats['completed'])
+        self.assertEqual(0, stats['busy'])
+
+    def test_full_pool_refuses_work(self):
+        with self.pool.slot():
+            with self.pool.slot():
+                stats = self.pool.stats()
+                self.assertEqual(1, stats['busy'])
+                self.assertEqual(1, stats['queued'])
+                self.assertTrue(stats['full'])
+                with self.assertRaises(PoolFull) as context:
+                    self.pool.submit(pow, 2, 3)
+                self.assertGreaterEqual(context.exception.retry_after, 1)
+        self.assertEqual(1, self.pool.stats()['rejected'])
+        self.assertEqual(8, self.pool.run(pow, 2, 3))
+
+    def test_workers_are_replaced_when_one_dies(self):
+        with self.assertRaises(BrokenProcessPool):
+            self.pool.run(os._exit, 1)
+        self.assertEqual(8, self.pool.run(pow, 2, 3))
+        self.assertEqual(0, self.pool.stats()['busy'])
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from test.utils import TestbedTestCase
+
+from models.sessions import SessionStore
+
+
+class SessionStoreTests(TestbedTestCase):
+
+    def test_least_recently_used_sessions_are_dropped(self):
+        store = SessionStore(max_sessions=2)
+        first = store.create({'n': 1})
+        second = store.create({'n': 2})
+        self.assertEqual({'n': 1}, store.get(first))
+        third = store.create({'n': 3})
+        self.assertIsNone(store.get(second))
+        self.assertEqual({'n': 1}, store.get(first))
+        self.assertTrue(store.delete(third))
+        self.assertFalse(store.delete(third))
+
+    def test_sessions_expire(self):
+        store = SessionStore(ttl=-1)
+        self.assertIsNone(store.get(store.create({})))
+
+    def test_sessions_are_dropped_beyond_the_memory_limit(self):
+        store = SessionStore(max_bytes=10, get_size=lambda session: session['n'])
+        first = store.create({'n': 4})
+        second = store.create({'n': 4})
+        self.assertEqual({'n': 4}, store.get(first))
+        session = store.get(second)
+        # Sessions can grow after they are created
+        session['n'] = 7
+        self.assertIsNone(store.get(first))
+        self.assertIs(session, store.get(second))
+        # The most recently used session is kept whatever its size
+        third = store.create({'n': 20})
+        self.assertIsNone(store.get(second))
+        self.assertEqual({'n': 20}, store.get(third))
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from test.utils import TestbedTestCase
+
+import numpy
+from scipy import ndimage
+
+import main
+from models.dbscan import LatticeDBSCAN
+from models.threshold import ThresholdIndex
+
+
+class ThresholdIndexTests(TestbedTestCase):
+
+    def test_fit_matches_lattice_dbscan_at_every_threshold(self):
+        rng = numpy.random.RandomState(11)
+        grey = ndimage.uniform_filter(rng.rand(40, 50), 3) * 766
+        grey = grey.astype(numpy.uint16)
+        index = ThresholdIndex(grey, eps=2, min_samples=3)
+        for threshold in range(90, 170, 4):
+            pixels, db = index.fit(threshold)
+            expected_pixels = main.get_threshold_pixels(grey, threshold)
+            numpy.testing.assert_array_equal(expected_pixels, pixels)
+            if len(pixels) == 0:
+                continue
+            expected = LatticeDBSCAN(eps=2, min_samples=3).fit(pixels)
+            numpy.testing.assert_array_equal(expected.labels_, db.labels_)
+            numpy.testing.assert_array_equal(expected.core_sample_indices_,
+                                             db.core_sample_indices_)
+
+    def test_fit_region_matches_lattice_dbscan_of_the_crop(self):
+        rng = numpy.random.RandomState(12)
+        grey = ndimage.uniform_filter(rng.rand(60, 70), 3) * 766
+        grey = grey.astype(numpy.uint16)
+        index = ThresholdIndex(grey, eps=2, min_samples=3)
+        for threshold in [100, 130, 130, 160]:
+            for _ in range(10):
+                x, y = rng.randint(0, 60), rng.randint(0, 50)
+                width, height = rng.randint(1, 71 - x), rng.randint(1, 61 - y)
+                pixels, db = index.fit_region(threshold,
+                                              (x, y, width, height))
+                expected_pixels = main.get_threshold_pixels(
+                    grey[y:y + height, x:x + width], threshold)
+                numpy.testing.assert_array_equal(expected_pixels, pixels)
+                expected = LatticeDBSCAN(eps=2,
+                                         min_samples=3).fit(expected_pixels)
+                numpy.testing.assert_array_equal(expected.labels_,
+                                                 db.labels_)
+                numpy.testing.assert_array_equal(
+                    expected.core_sample_indices_, db.core_sample_indices_)
+
+    def test_threshold_above_the_index(self):
+        grey = numpy.zeros((3, 3), dtype=numpy.uint16)
+        index = ThresholdIndex(grey, max_threshold=100)
+        self.assertTrue(index.covers(100))
+        self.assertFalse(index.covers(101))
+        with self.assertRaises(ValueError):
+            index.fit(101)
+        pixels, db = index.fit(100)
+        self.assertEqual(9, len(pixels))
+        self.assertEqual([0] * 9, db.labels_.tolist())
+
+    def test_max_pixels_lowers_the_index_maximum(self):
+        grey = numpy.arange(0, 300, 3, dtype=numpy.uint16).reshape(10, 10)
+        # Pixel i enters at threshold i + 1
+        index = ThresholdIndex(grey, max_pixels=50)
+        self.assertEqual(49, index.max_threshold)
+        self.assertEqual(49, len(index.fit(49)[0]))
+        self.assertFalse(index.covers(50))
+
+    def test_nbytes_includes_the_cache(self):
+        grey = numpy.zeros((20, 20), dtype=numpy.uint16)
+        index = ThresholdIndex(grey)
+        nbytes = index.nbytes
+        self.assertGreater(nbytes, 0)
+        index.fit_region(100, (0, 0, 10, 10))
+        self.assertGreater(index.nbytes, nbytes)
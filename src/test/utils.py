@@ -15,10 +15,14 @@
 # limitations under the License.
 
 import logging
+import os
 import unittest
 
 logging.disable(logging.WARNING)  # ndb is noisy
 
+# Keep the jobs of tests out of the shared job database
+os.environ.setdefault('CLUSTER_JOB_DB', ':memory:')
+
 
 class TestbedTestCase(unittest.TestCase):
 